@@ -16,7 +16,7 @@ Here the reformer deals with rare node action spliting into subtokens.
 
 from copy import deepcopy
 
-from transition_amr_parser.amr_machine import AMRStateMachine, peel_pointer, arc_nopointer_regex
+from transition_amr_parser.amr_machine import AMRStateMachine, PersistentList, peel_pointer, parse_action
 from fairseq_ext.utils import join_action_pointer
 
 
@@ -260,15 +260,32 @@ class AMRActionReformerSubtok:
         # import ipdb; ipdb.set_trace(context=30)
         return result
 
+    # append-only lists of decoding states, shared between forks
+    STEP_LISTS = ['actions_nopos_in', 'actions_nopos_out', 'actions_pos', 'token_cursors', 'subtok_origin_index',
+                  'subtok_start_mask']
+
+    def fork(self):
+        """Copy of the reformer sharing state with this one, used to branch hypotheses in beam search.
+        The step lists are append-only PersistentList and the underlying machine is forked, so the cost does not grow
+        with the number of decoded steps.
+        """
+        cls = self.__class__
+        result = cls.__new__(cls)
+        result.__dict__.update(self.__dict__)
+        result.machine = self.machine.fork()
+        for name in self.STEP_LISTS:
+            setattr(result, name, getattr(self, name).copy())
+        return result
+
     def reset(self, tokens):
         self.machine.reset(tokens)
         # model decoding input and output
-        self.actions_nopos_in = []
-        self.actions_nopos_out = []
-        self.actions_pos = []
+        self.actions_nopos_in = PersistentList()
+        self.actions_nopos_out = PersistentList()
+        self.actions_pos = PersistentList()
         # general state information
         self.allowed_base_actions = None    # not used currently
-        self.token_cursors = [0]    # src token cursor BEFORE each action
+        self.token_cursors = PersistentList([0])    # src token cursor BEFORE each action
         self.actions_nodemask = None    # to be rewritten every time
 
         # step counter
@@ -276,8 +293,8 @@ class AMRActionReformerSubtok:
         self.action_step = 0     # on all actions including subtokens
 
         # internal states to facilitate decoding
-        self.subtok_origin_index = []    # the index of the original token for each subtoken
-        self.subtok_start_mask = []    # mark the start of each subtoken sequences
+        self.subtok_origin_index = PersistentList()    # the index of the original token for each subtoken
+        self.subtok_start_mask = PersistentList()    # mark the start of each subtoken sequences
 
     def get_valid_actions(self):
         # return the valid actions for the next subtoken position
@@ -408,7 +425,7 @@ class AMRActionReformerSubtok:
 
             # deal with pointer values
             if act.startswith(dictionary.bpe.INIT):
-                if arc_nopointer_regex.match(act[1:]):
+                if parse_action(act[1:])[0]:
                     rec_actions_pos.append(rec_index_map[pos])
                 else:
                     rec_actions_pos.append(-1)
@@ -1,5 +1,4 @@
 import os
-import itertools
 from multiprocessing import Pool
 import time
 from collections import Counter
@@ -13,19 +12,20 @@ from .action_info_bartsv import get_actions_states
 from ..tokenizer import tokenize_line_tab
 from ..binarize import make_builder    # TODO move this to data folder
 from ..data.data_utils import load_indexed_dataset
+from ..data.vocab_mask_dataset import CanonicalVocabMaskDataset
 from ..utils import time_since
 
 
 # names for all the action states; tensor names and file names MUST be paired in order
 # tensor names should be the same as those returned by `get_actions_states`, except that
-# 'allowed_cano_actions' -> 'vocab_mask'
+# 'allowed_cano_actions' -> 'vocab_mask_code'
 actions_states_tensor_names = [
     # training data
     'actions_nopos_in',
     'actions_nopos_out',
     'actions_pos',
     # general states
-    'vocab_mask',
+    'vocab_mask_code',
     'token_cursors',
     'actions_nodemask',
     # # graph structure
@@ -47,7 +47,7 @@ actions_states_file_names = [
     'nopos_out',
     'pos',
     # general states
-    'vocab_masks',
+    'vocab_mask_codes',
     'src_cursors',
     'actnode_masks',
     # # graph structure
@@ -66,6 +66,16 @@ actions_states_file_names = [
 assert len(actions_states_tensor_names) == len(actions_states_file_names)
 
 
+def get_actstates_dtype(name):
+    if name == 'vocab_mask_codes':
+        # bit codes of the allowed canonical actions, expanded to vocabulary masks with the '.vocab_mask_table' file
+        return np.int16
+    elif 'mask' in name:
+        return np.uint8
+    else:
+        return np.int64
+
+
 # reference: fairseq binarizer.py
 def safe_readline(f):
     pos = f.tell()
@@ -85,6 +95,16 @@ class ActionStatesBinarizer:
         self.machine = AMRStateMachineSubtoken.from_config(machine_config_file)
         self.canonical_actions = self.machine.base_action_vocabulary
         self.canonical_act_ids = self.machine.canonical_action_to_dict(actions_dict)
+        # the canonical actions allowed at each step are saved as a bit code, with bit i for the i-th canonical action
+        self.canonical_act_bits = {act: 1 << i for i, act in enumerate(self.canonical_act_ids)}
+        assert len(self.canonical_act_bits) < 16, 'bit codes of the allowed canonical actions are saved as int16'
+
+    def get_vocab_mask_table(self):
+        """Vocabulary mask of each canonical action, to expand the saved bit codes to the vocabulary masks."""
+        table = torch.zeros(len(self.canonical_act_bits), len(self.actions_dict), dtype=torch.uint8)
+        for i, act in enumerate(self.canonical_act_bits):
+            table[i][self.canonical_act_ids[act]] = 1
+        return table
 
     def binarize(self, en_file, actions_file, machine_config_file, consumer, tokenize=tokenize_line_tab,
                  en_offset=0, en_end=-1,
@@ -123,19 +143,15 @@ class ActionStatesBinarizer:
 
                 allowed_cano_actions = actions_states['allowed_cano_actions']
                 del actions_states['allowed_cano_actions']
-                vocab_mask = torch.zeros(len(allowed_cano_actions), len(self.actions_dict), dtype=torch.uint8)
-                for i, act_allowed in enumerate(allowed_cano_actions):
-                    # vocab_ids_allowed = list(set().union(*[set(canonical_act_ids[act]) for act in act_allowed]))
-                    # this is a bit faster than above
-                    vocab_ids_allowed = list(
-                        itertools.chain.from_iterable(
-                            [self.canonical_act_ids[act] for act in act_allowed]
-                        )
-                    )
-                    vocab_mask[i][vocab_ids_allowed] = 1
+                # instead of the dense vocabulary mask for each step, only save the bit code of the allowed canonical
+                # actions, which is expanded to the vocabulary mask when loading the data
+                vocab_mask_code = torch.tensor([
+                    sum(self.canonical_act_bits[act] for act in set(act_allowed))
+                    for act_allowed in allowed_cano_actions
+                ])
 
                 # convert state vectors to tensors
-                actions_states_tensors['vocab_mask'] = vocab_mask
+                actions_states_tensors['vocab_mask_code'] = vocab_mask_code
                 for k, v in actions_states.items():
                     if 'mask' in k:
                         actions_states_tensors[k] = torch.tensor(v, dtype=torch.uint8)
@@ -230,18 +246,12 @@ def binarize_actstates_tofile(en_file, actions_file, machine_config_file, out_fi
     for name in actions_states_file_names:
         out_file_tgt_list.append(out_file_pref + '.' + name + '.bin')
         index_file_tgt_list.append(out_file_pref + '.' + name + '.idx')
-        if 'mask' in name:
-            ds_tgt_list.append(make_builder(out_file_pref + '.' + name + '.bin', impl=impl, dtype=np.uint8))
-        else:
-            ds_tgt_list.append(make_builder(out_file_pref + '.' + name + '.bin', impl=impl, dtype=np.int64))
+        ds_tgt_list.append(make_builder(out_file_pref + '.' + name + '.bin', impl=impl,
+                                        dtype=get_actstates_dtype(name)))
 
     def consumer(actions_states_tensors):
         for i, name in enumerate(actions_states_tensor_names):
-            if name == 'vocab_mask':
-                # NOTE here we flatten the 2-D tensor
-                ds_tgt_list[i].add_item(actions_states_tensors['vocab_mask'].view(-1))
-            else:
-                ds_tgt_list[i].add_item(actions_states_tensors[name])
+            ds_tgt_list[i].add_item(actions_states_tensors[name])
         return
 
     if action_state_binarizer is None:
@@ -254,9 +264,19 @@ def binarize_actstates_tofile(en_file, actions_file, machine_config_file, out_fi
     for ds, index_file in zip(ds_tgt_list, index_file_tgt_list):
         ds.finalize(index_file)
 
+    write_vocab_mask_table(action_state_binarizer, out_file_pref, impl=impl)
+
     return res
 
 
+def write_vocab_mask_table(action_state_binarizer, out_file_pref, impl='mmap'):
+    """Save the vocabulary mask of each canonical action, one per item, to expand the saved bit codes."""
+    ds = make_builder(out_file_pref + '.vocab_mask_table.bin', impl=impl, dtype=np.uint8)
+    for vocab_mask in action_state_binarizer.get_vocab_mask_table():
+        ds.add_item(vocab_mask)
+    ds.finalize(out_file_pref + '.vocab_mask_table.idx')
+
+
 def binarize_actstates_tofile_workers(en_file, actions_file, machine_config_file, out_file_pref,
                                       actions_dict=None,
                                       action_state_binarizer=None,
@@ -318,18 +338,12 @@ def binarize_actstates_tofile_workers(en_file, actions_file, machine_config_file
     for name in actions_states_file_names:
         out_file_tgt_list.append(out_file_pref + '.' + name + '.bin')
         index_file_tgt_list.append(out_file_pref + '.' + name + '.idx')
-        if 'mask' in name:
-            ds_tgt_list.append(make_builder(out_file_pref + '.' + name + '.bin', impl=impl, dtype=np.uint8))
-        else:
-            ds_tgt_list.append(make_builder(out_file_pref + '.' + name + '.bin', impl=impl, dtype=np.int64))
+        ds_tgt_list.append(make_builder(out_file_pref + '.' + name + '.bin', impl=impl,
+                                        dtype=get_actstates_dtype(name)))
 
     def consumer(actions_states_tensors):
         for i, name in enumerate(actions_states_tensor_names):
-            if name == 'vocab_mask':
-                # NOTE here we flatten the 2-D tensor
-                ds_tgt_list[i].add_item(actions_states_tensors['vocab_mask'].view(-1))
-            else:
-                ds_tgt_list[i].add_item(actions_states_tensors[name])
+            ds_tgt_list[i].add_item(actions_states_tensors[name])
         return
 
     merge_result(
@@ -348,11 +362,15 @@ def binarize_actstates_tofile_workers(en_file, actions_file, machine_config_file
                 ds.merge_file_(out_file_pref_temp + '.' + name)
                 os.remove(out_file_pref_temp + '.' + name + '.bin')
                 os.remove(out_file_pref_temp + '.' + name + '.idx')
+            os.remove(out_file_pref_temp + '.vocab_mask_table.bin')
+            os.remove(out_file_pref_temp + '.vocab_mask_table.idx')
 
     # finalize to save the dtype and size and index info
     for ds, index_file in zip(ds_tgt_list, index_file_tgt_list):
         ds.finalize(index_file)
 
+    write_vocab_mask_table(action_state_binarizer, out_file_pref, impl=impl)
+
     print('finished !')
     print(f'Processed data saved to path with prefix: {out_file_pref}')
     print(f'Total time elapsed: {time_since(start)}')
@@ -369,10 +387,20 @@ def load_actstates_fromfile(file_pref, actions_dict, impl='mmap'):
     """Load the action states from binary files"""
     tgt_actstates = {}
     for name in actions_states_file_names:
+        if name == 'vocab_mask_codes':
+            continue
         tgt_name = 'tgt_' + name
-        if name == 'vocab_masks':
-            tgt_actstates[tgt_name] = load_indexed_dataset(file_pref + '.' + name, actions_dict, impl)
-        else:
-            tgt_actstates[tgt_name] = load_indexed_dataset(file_pref + '.' + name, None, impl)
+        tgt_actstates[tgt_name] = load_indexed_dataset(file_pref + '.' + name, None, impl)
+
+    # vocabulary masks, expanded from the bit codes of the allowed canonical actions
+    vocab_mask_codes = load_indexed_dataset(file_pref + '.vocab_mask_codes', None, impl)
+    if vocab_mask_codes is not None:
+        vocab_mask_table = load_indexed_dataset(file_pref + '.vocab_mask_table', None, impl)
+        vocab_mask_table = torch.stack([vocab_mask_table[i] for i in range(len(vocab_mask_table))])
+        assert vocab_mask_table.size(1) == len(actions_dict)
+        tgt_actstates['tgt_vocab_masks'] = CanonicalVocabMaskDataset(vocab_mask_codes, vocab_mask_table)
+    else:
+        # dense vocabulary masks saved by previous versions
+        tgt_actstates['tgt_vocab_masks'] = load_indexed_dataset(file_pref + '.vocab_masks', actions_dict, impl)
 
     return tgt_actstates
@@ -0,0 +1,137 @@
+"""Batched version of the valid action rules of `transition_amr_parser.amr_machine.AMRStateMachine`.
+
+The state needed to decide the valid actions (token cursor, sentence length, base type of the last action and root) is
+kept in tensors with one row per hypothesis, so that the `(num_hypos, vocab_size)` mask of allowed actions at each
+decoding step is computed with tensor operations instead of a Python loop over the machines.
+"""
+import torch
+
+
+class BatchedAMRStateMachine:
+    """Valid action masks for a batch of AMR state machines.
+
+    Results are identical to `AMRStateMachine.get_valid_actions()` mapped to vocabulary ids by
+    `AMRStateMachine.canonical_action_to_dict()`.
+
+    Args:
+        machine (AMRStateMachine): machine providing the configuration and the base action vocabulary
+        vocab (fairseq.data.Dictionary): target action dictionary
+        max_1root (bool): allow at most one ROOT action, as in `AMRStateMachine.get_valid_actions()`
+    """
+
+    def __init__(self, machine, vocab, max_1root=True):
+        if machine.reduce_nodes:
+            raise NotImplementedError('REDUCE actions are not supported in the valid action rules')
+
+        self.base_actions = list(machine.base_action_vocabulary)
+        self.base_index = {act: i for i, act in enumerate(self.base_actions)}
+        self.use_copy = machine.use_copy
+        self.max_1root = max_1root
+
+        # vocabulary id -> base action index, with len(base_actions) for symbols that are never allowed
+        canonical_act_ids = machine.canonical_action_to_dict(vocab)
+        self.vocab_base = torch.full((len(vocab),), len(self.base_actions), dtype=torch.long)
+        for act, ids in canonical_act_ids.items():
+            self.vocab_base[ids] = self.base_index[act]
+
+        gen_node_actions = ['COPY', 'NODE'] if self.use_copy else ['NODE']
+        self.gen_node_ids = torch.tensor([self.base_index[act] for act in gen_node_actions])
+        self.arc_ids = torch.tensor([self.base_index[act] for act in ['>LA', '>RA']])
+        self.root_id = self.base_index['ROOT']
+        self.close_id = self.base_index['CLOSE']
+        self.shift_id = self.base_index['SHIFT']
+
+        # state, one row per hypothesis
+        self.num_tokens = None
+        self.tok_cursors = None
+        self.last_base = None    # -1 for no action yet
+        self.root = None    # -1 for no root yet
+        self.is_closed = None
+        self.num_actions = None
+
+    def to(self, device):
+        for name in ['vocab_base', 'gen_node_ids', 'arc_ids']:
+            setattr(self, name, getattr(self, name).to(device))
+        return self
+
+    def reset(self, num_tokens):
+        """Set new sentences.
+
+        Args:
+            num_tokens (torch.Tensor): number of source tokens for each hypothesis, size (num_hypos,)
+        """
+        self.to(num_tokens.device)
+        self.num_tokens = num_tokens.long()
+        self.tok_cursors = torch.zeros_like(self.num_tokens)
+        self.last_base = torch.full_like(self.num_tokens, -1)
+        self.root = torch.full_like(self.num_tokens, -1)
+        self.is_closed = torch.zeros_like(self.num_tokens, dtype=torch.bool)
+        # number of actions applied (node ids are positions in the action history)
+        self.num_actions = torch.zeros_like(self.num_tokens)
+
+    def reorder(self, new_order):
+        """Reorder (or reduce) the hypotheses, the equivalent of reordering the list of machines.
+
+        Args:
+            new_order (torch.Tensor): index of the previous hypothesis for each new hypothesis
+        """
+        for name in ['num_tokens', 'tok_cursors', 'last_base', 'root', 'is_closed', 'num_actions']:
+            setattr(self, name, getattr(self, name).index_select(0, new_order))
+
+    def update(self, action_ids, update_mask=None):
+        """Apply one action for each hypothesis.
+
+        Args:
+            action_ids (torch.Tensor): vocabulary ids of the actions, size (num_hypos,); the eos symbol is CLOSE
+            update_mask (torch.Tensor, optional): bool mask of the hypotheses to update, size (num_hypos,)
+        """
+        base = self.vocab_base[action_ids]
+        if update_mask is None:
+            update_mask = torch.ones_like(self.is_closed)
+        # NOTE no checks on the values here, to avoid synchronizing with the device at every decoding step
+
+        self.tok_cursors += (update_mask & (base == self.shift_id)).long()
+        is_root = update_mask & (base == self.root_id)
+        # ROOT labels the node on top of the stack, that is the last generated node (node ids are positions in the
+        # action history and ROOT can only follow a node generation)
+        self.root[is_root] = self.num_actions[is_root] - 1
+        self.is_closed |= update_mask & (base == self.close_id)
+        self.last_base[update_mask] = base[update_mask]
+        self.num_actions += update_mask.long()
+
+    def get_valid_base_actions_mask(self):
+        """Get the mask of valid base actions, size (num_hypos, len(base_actions)), following the rules of
+        `AMRStateMachine.get_valid_actions()`."""
+        num_hypos = self.tok_cursors.size(0)
+        valid = self.tok_cursors.new_zeros(num_hypos, len(self.base_actions), dtype=torch.bool)
+
+        # SHIFT and node generation while there are tokens left
+        not_end = self.tok_cursors < self.num_tokens
+        valid[:, self.shift_id] = not_end
+        valid[:, self.gen_node_ids] = not_end.unsqueeze(1)
+
+        # arcs after node generation, ROOT or other arcs
+        last_gen_node = (self.last_base.unsqueeze(1) == self.gen_node_ids).any(dim=1)
+        last_arcable = last_gen_node \
+            | (self.last_base == self.root_id) \
+            | (self.last_base.unsqueeze(1) == self.arc_ids).any(dim=1)
+        valid[:, self.arc_ids] = last_arcable.unsqueeze(1)
+
+        # ROOT after node generation
+        if self.max_1root:
+            # NOTE the machine checks `not self.root`, which also holds when the root is node 0
+            valid[:, self.root_id] = last_gen_node & (self.root <= 0)
+        else:
+            valid[:, self.root_id] = last_gen_node
+
+        # CLOSE at the end of the sentence
+        valid[:, self.close_id] = self.tok_cursors == self.num_tokens
+
+        return valid
+
+    def get_valid_actions_mask(self):
+        """Get the mask of valid actions in the vocabulary, size (num_hypos, vocab_size)."""
+        valid = self.get_valid_base_actions_mask()
+        # extra column for the symbols that are never allowed
+        valid = torch.cat([valid, valid.new_zeros(valid.size(0), 1)], dim=1)
+        return valid.index_select(1, self.vocab_base)
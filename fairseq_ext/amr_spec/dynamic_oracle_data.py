@@ -0,0 +1,324 @@
+import itertools
+from typing import List, Dict, Tuple
+
+import numpy as np
+import torch
+
+from transition_amr_parser.amr_machine import AMRStateMachine, AMROracle, peel_pointer
+from fairseq_ext.data.data_utils import collate_tokens
+
+
+class DynamicOracleData:
+    """Run the oracle on gold AMRs with alignments and build the target side data of a batch from the oracle actions,
+    for dynamic oracle training.
+
+    This is sent to the dataloader worker processes, where the dataset runs it when collating each batch; the target
+    data of the next batches are then prefetched while the current one trains. Only the target dictionary, the machine
+    configuration and the canonical action ids are pickled, the state machine and the oracle are built on first use in
+    each process.
+
+    Args:
+        tgt_dict (~fairseq.data.Dictionary): dictionary for the target actions
+        machine_config (dict): configuration of the AMR state machine and oracle
+        collate_tgt_states (bool): whether to collate target actions states information
+        collate_tgt_states_graph (bool): whether to collate target actions states information for graph
+    """
+    def __init__(self, tgt_dict, machine_config, collate_tgt_states=True, collate_tgt_states_graph=False):
+        self.tgt_dict = tgt_dict
+        self.machine_config = machine_config
+        self.collate_tgt_states = collate_tgt_states
+        self.collate_tgt_states_graph = collate_tgt_states_graph
+
+        self._machine = None
+        self._oracle = None
+        self.canonical_act_ids = self.machine.canonical_action_to_dict(self.tgt_dict)
+
+    @property
+    def machine(self):
+        if self._machine is None:
+            self._machine = AMRStateMachine(**self.machine_config)
+        return self._machine
+
+    @property
+    def oracle(self):
+        if self._oracle is None:
+            self._oracle = AMROracle(**self.machine_config)
+        return self._oracle
+
+    def __getstate__(self):
+        # the machine and oracle are built again in the receiving process
+        state = self.__dict__.copy()
+        state['_machine'] = None
+        state['_oracle'] = None
+        return state
+
+    def run_oracle_get_data(self, aligned_amr, machine, oracle) -> Tuple[List[str], Dict, Dict]:
+        """Run oracle for a gold AMR graph with alignments, get the needed parser states at the same time, and
+        numericalize the data into Tensors finally.
+
+        Args:
+            aligned_amr ([type]): [description]
+            machine ([type]): [description]
+            oracle ([type]): [description]
+
+        Returns:
+            [type]: [description]
+        """
+        # spawn new machine for this sentence
+        machine.reset(aligned_amr.tokens)
+
+        # initialize new oracle for this AMR
+        oracle.reset(aligned_amr)
+
+        # store needed parser states
+        allowed_cano_actions = []
+        token_cursors = []
+        # proceed left to right throughout the sentence generating nodes
+        while not machine.is_closed:
+
+            # get valid actions
+            act_allowed = machine.get_valid_actions(max_1root=True)
+            allowed_cano_actions.append(act_allowed)
+            token_cursors.append(machine.tok_cursor)
+
+            # oracle
+            actions, scores = oracle.get_actions(machine)
+            # most probable
+            action = actions[np.argmax(scores)]
+
+            # if it is node generation, keep track of original id in gold amr
+            if isinstance(action, tuple):
+                action, gold_node_id = action
+                node_id = len(machine.action_history)
+                oracle.node_map[gold_node_id] = node_id
+                oracle.node_reverse_map[node_id] = gold_node_id
+
+            # check if valid
+            assert machine.get_base_action(
+                action) in act_allowed, 'current action not in the allowed space? check the rules.'
+
+            # update machine
+            machine.update(action)
+
+        assert machine.action_history[-1] == 'CLOSE'
+
+        # NOTE we include 'CLOSE' here, which will be removed later for all data in "get_sample_data()"
+        actions = machine.action_history
+        # actions = machine.action_history[:-1]
+
+        # ===== store all needed numerical data for one sentence/amr
+        data_piece = dict()
+
+        # ===== separate action with pointer values
+        line_actions = [peel_pointer(act) for act in actions]
+        actions_nopos, actions_pos = zip(*line_actions)
+
+        # ===== vocab encoded actions (target)
+        tgt_tensor = self.tgt_dict.encode_line(
+            line=[act if act != 'CLOSE' else self.tgt_dict.eos_word for act in actions_nopos],
+            line_tokenizer=lambda x: x,    # already tokenized
+            add_if_not_exist=False,
+            consumer=None,
+            append_eos=False,
+            reverse_order=False
+            ).long()    # NOTE default return type here is torch.int32, conversion to long is needed
+        data_piece['target'] = tgt_tensor
+
+        # ===== target side pointer values
+        data_piece['tgt_pos'] = torch.tensor(actions_pos)
+
+        # ===== parser state information (NOTE CLOSE action at last step is included)
+        # parser state names mapped to sample attribute names
+        names_states2data = {
+            'allowed_cano_actions': 'tgt_vocab_masks',
+            'token_cursors': 'tgt_src_cursors',
+            'actions_nodemask': 'tgt_actnode_masks',
+            'actions_nopos_in': 'tgt_in',
+            'actions_nopos_out': 'target',
+            'actions_pos': 'tgt_pos',
+            }
+        names_data = [v for v in names_states2data.values()]
+
+        actions_nodemask = machine.get_actions_nodemask()
+        assert len(actions_nodemask) == len(actions)
+
+        actions_states = {'allowed_cano_actions': allowed_cano_actions,
+                          'actions_nodemask': actions_nodemask,
+                          'token_cursors': token_cursors}
+
+        # convert state vectors to tensors
+        allowed_cano_actions = actions_states['allowed_cano_actions']
+        del actions_states['allowed_cano_actions']
+        vocab_mask = torch.zeros(len(allowed_cano_actions), len(self.tgt_dict), dtype=torch.uint8)
+        for i, act_allowed in enumerate(allowed_cano_actions):
+            # vocab_ids_allowed = list(set().union(*[set(canonical_act_ids[act]) for act in act_allowed]))
+            # this is a bit faster than above
+            vocab_ids_allowed = list(
+                itertools.chain.from_iterable(
+                    [self.canonical_act_ids[act] for act in act_allowed]
+                )
+            )
+            vocab_mask[i][vocab_ids_allowed] = 1
+        data_piece['tgt_vocab_masks'] = vocab_mask
+
+        for k, v in actions_states.items():
+            data_key = names_states2data[k]
+            if 'mask' in k:
+                data_piece[data_key] = torch.tensor(v, dtype=torch.uint8)
+            elif 'actions_nopos_in' == k:
+                # input sequence
+                data_piece[data_key] = self.tgt_dict.encode_line(
+                    line=[act if act != 'CLOSE' else self.tgt_dict.eos_word for act in v],
+                    line_tokenizer=lambda x: x,    # already tokenized
+                    add_if_not_exist=False,
+                    consumer=None,
+                    append_eos=False,
+                    reverse_order=False
+                ).long()    # NOTE default return type here is torch.int32, conversion to long is needed
+            elif 'actions_nopos_out' == k:
+                # output sequence
+                data_piece[data_key] = self.tgt_dict.encode_line(
+                    line=[act if act != 'CLOSE' else self.tgt_dict.eos_word for act in v],
+                    line_tokenizer=lambda x: x,    # already tokenized
+                    add_if_not_exist=False,
+                    consumer=None,
+                    append_eos=False,
+                    reverse_order=False
+                ).long()    # NOTE default return type here is torch.int32, conversion to long is needed
+            else:
+                data_piece[data_key] = torch.tensor(v)    # int64
+
+        # shift the target input sequence
+        if 'tgt_in' in data_piece:
+            data_piece['tgt_in'][1:] = data_piece['tgt_in'][:-1]
+            data_piece['tgt_in'][0] = self.tgt_dict.eos()
+
+        # remove the last CLOSE in the action states
+        for k, v in data_piece.items():
+            if k in names_data:
+                data_piece[k] = v[:-1]
+
+        return actions, actions_states, data_piece
+
+    def run_oracle_get_data_batch(self, aligned_amrs) -> Tuple[List[List[str]], List[Dict]]:
+        """Run oracle on the fly and get needed parser states and numerical Tensor data for each batch.
+
+        Args:
+            aligned_amrs ([type]): [description]
+
+        Returns:
+            [type]: [description]
+        """
+        action_sequences = []
+        data_samples = []
+        # for amr in tqdm(aligned_amrs, desc='dynamic_oracle'):
+        for amr in aligned_amrs:
+            # get the action sequence
+            actions, actions_states, data_piece = self.run_oracle_get_data(amr, self.machine, self.oracle)
+            action_sequences.append(actions)
+            # append the numerical data for one sentence/amr
+            data_samples.append(data_piece)
+
+        return action_sequences, data_samples
+
+    def collate_sample_data(self, data_samples):
+        """Collate a batch of data instances, only for the target related data.
+
+        Args:
+            data_samples (List[Dict]): A list of data examples.
+
+        Returns:
+            [type]: [description]
+        """
+        # ===== default hyper-parameters
+        pad_idx = self.tgt_dict.pad()
+        eos_idx = self.tgt_dict.eos()
+        left_pad_target = False
+        input_feeding = True
+        collate_tgt_states = self.collate_tgt_states
+        collate_tgt_states_graph = self.collate_tgt_states_graph
+
+        # ===== collate tensors in the batch
+        if len(data_samples) == 0:
+            return {}
+
+        # TODO make the functions outside for better code reuse
+        def merge(key, left_pad=left_pad_target, move_eos_to_beginning=False, pad_idx=pad_idx, eos_idx=eos_idx):
+            return collate_tokens(
+                [s[key] for s in data_samples],
+                pad_idx, eos_idx, left_pad, move_eos_to_beginning,
+            )
+
+        def merge_tgt_pos(key, left_pad=left_pad_target, move_eos_to_beginning=False):
+            return collate_tokens(
+                [s[key] for s in data_samples],
+                -2, eos_idx, left_pad, move_eos_to_beginning,
+            )
+
+        target = merge('target')
+        # # for sanity checks
+        # tgt_lengths = torch.LongTensor([len(s['target']) for s in data_samples])
+        # tgt_num_tokens = tgt_lengths.sum().item()
+        tgt_pos = merge_tgt_pos('tgt_pos')
+
+        if data_samples[0].get('tgt_in', None) is not None:
+            # NOTE we do not shift here, as it is already shifter 1 position to the right in `self.get_sample_data`
+            tgt_in = merge('tgt_in')
+            prev_output_tokens = tgt_in
+
+        elif input_feeding:
+            # we create a shifted version of targets for feeding the
+            # previous output token(s) into the next decoder step
+            prev_output_tokens = merge('target', move_eos_to_beginning=True)
+
+        else:
+            raise ValueError
+
+        # TODO write a function to collate 2-D matrices, similar to the collate_tokens function
+        def merge_tgt_vocab_masks():
+            # default right padding: left_pad_target should be False
+            # TODO organize the code here
+            masks = [s['tgt_vocab_masks'] for s in data_samples]
+            max_len = max([len(m) for m in masks])
+            merged = masks[0].new(len(masks), max_len, masks[0].size(1)).fill_(pad_idx)
+            for i, v in enumerate(masks):
+                merged[i, :v.size(0), :] = v
+            return merged
+
+        if collate_tgt_states:
+            tgt_vocab_masks = merge_tgt_vocab_masks()
+            tgt_actnode_masks = merge('tgt_actnode_masks', pad_idx=0)
+            tgt_src_cursors = merge('tgt_src_cursors')
+        else:
+            tgt_vocab_masks = None
+            tgt_actnode_masks = None
+            tgt_src_cursors = None
+
+        assert not collate_tgt_states_graph, 'currently not supporting collating graph masks in dynamic batch oracle'
+
+        batch_tgt = {
+            'net_input': {
+                # AMR actions states
+                'tgt_vocab_masks': tgt_vocab_masks,
+                'tgt_actnode_masks': tgt_actnode_masks,
+                'tgt_src_cursors': tgt_src_cursors,
+                # target decoder input
+                'prev_output_tokens': prev_output_tokens,
+            },
+            'target': target,
+            'tgt_pos': tgt_pos
+        }
+
+        return batch_tgt
+
+    def get_batch_tgt(self, aligned_amrs):
+        """Run oracle on the fly for a batch of gold AMRs and collate the target side data.
+
+        Args:
+            aligned_amrs (List[AMR]): gold AMRs with alignments, in batch order
+
+        Returns:
+            dict: the collated target side data, see `collate_sample_data()`
+        """
+        _, data_samples = self.run_oracle_get_data_batch(aligned_amrs)
+        return self.collate_sample_data(data_samples)
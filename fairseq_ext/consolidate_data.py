@@ -0,0 +1,62 @@
+#!/usr/bin/env python3
+"""Consolidate all the indexed data files of each split into a single file, which is then used by the tasks instead
+of the original files, see fairseq_ext/data/consolidated_dataset.py
+
+python fairseq_ext/consolidate_data.py --data-dir $DATA_FOLDER --emb-dir $EMB_FOLDER
+"""
+import argparse
+import glob
+import os
+
+from fairseq_ext.data.consolidated_dataset import consolidate_indexed_datasets
+from fairseq_ext.data.indexed_dataset import MMapIndexedDataset, data_file_path, index_file_path
+
+
+def get_mmap_prefixes(folder, file_prefix):
+    """Path prefixes of the indexed data files in mmap format in a folder, starting with a file prefix"""
+    prefixes = []
+    for index_file in sorted(glob.glob(os.path.join(folder, file_prefix + '*.idx'))):
+        prefix = index_file[:-len('.idx')]
+        if not os.path.exists(data_file_path(prefix)):
+            continue
+        with open(index_file, 'rb') as f:
+            if f.read(len(MMapIndexedDataset.Index._HDR_MAGIC)) != MMapIndexedDataset.Index._HDR_MAGIC:
+                continue
+        prefixes.append(prefix)
+    return prefixes
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Consolidate the indexed data files of each split into one file')
+    parser.add_argument('--data-dir', required=True, help='folder with the preprocessed data')
+    parser.add_argument('--emb-dir', help='folder with the pre-trained embeddings and wordpieces')
+    parser.add_argument('--splits', nargs='+', default=['train', 'valid', 'test'], help='splits to consolidate')
+    parser.add_argument('--source-lang', default='en')
+    parser.add_argument('--target-lang', default='actions')
+    args = parser.parse_args()
+
+    folders = [args.data_dir] if args.emb_dir is None else [args.data_dir, args.emb_dir]
+    for split in args.splits:
+        file_prefix = f'{split}.{args.source_lang}-{args.target_lang}.'
+        out_path = os.path.join(args.data_dir, file_prefix + 'fields')
+
+        field_paths = {}
+        for folder in folders:
+            for prefix in get_mmap_prefixes(folder, file_prefix):
+                if prefix == out_path:
+                    continue
+                name = os.path.basename(prefix)
+                # the fields are found by file name in any of the folders
+                assert name not in field_paths, f'{name} is both in {field_paths[name]} and {prefix}'
+                field_paths[name] = prefix
+        if not field_paths:
+            print(f'| no indexed data files in mmap format for split {split}')
+            continue
+
+        consolidate_indexed_datasets(out_path, field_paths)
+        size = os.path.getsize(data_file_path(out_path)) + os.path.getsize(index_file_path(out_path))
+        print(f'| consolidated {len(field_paths)} files into {out_path} ({size / 2**20:.1f} MB)')
+
+
+if __name__ == '__main__':
+    main()
@@ -81,8 +81,8 @@ def collate(
         # NOTE we do not need to shift target actions pointer since it is associated with the out sequence
 
         if samples[0].get('tgt_in', None) is not None:
-            # NOTE we do not shift here, as it is already shifter 1 position to the right in dataset .__getitem__
-            tgt_in = merge('tgt_in', left_pad=left_pad_target)
+            # shift 1 position to the right while copying into the batch, with <s> (eos) at the beginning
+            tgt_in = merge('tgt_in', left_pad=left_pad_target, move_eos_to_beginning=True)
             prev_output_tokens = tgt_in = tgt_in.index_select(0, sort_order)
 
         elif input_feeding:
@@ -216,19 +216,33 @@ def collate(
         tgt_src_cursors = None
 
     if collate_tgt_states_graph:
-        # graph structure (NOTE the pad_idx is fixed at some special values)
-        tgt_actedge_masks = merge('tgt_actedge_masks', left_pad=left_pad_target, pad_idx=0)
+        # graph structure is tied with the tgt input: the vectors are shifted 1 position to the right while copying
+        # into the batch, with the padding values for the <s> position at the beginning
+        # (NOTE the pad_idx is fixed at some special values)
+        def merge_shift(key, pad_idx):
+            return data_utils.collate_tokens(
+                [s[key] for s in samples],
+                pad_idx, pad_idx, left_pad_target, move_eos_to_beginning=True,
+            )
+
+        tgt_actedge_masks = merge_shift('tgt_actedge_masks', 0)
+        tgt_actedge_cur_nodes = merge_shift('tgt_actedge_cur_nodes', pad_tgt_actedge_cur_nodes)
+        tgt_actedge_pre_nodes = merge_shift('tgt_actedge_pre_nodes', pad_tgt_actedge_pre_nodes)
+        tgt_actedge_directions = merge_shift('tgt_actedge_directions', pad_tgt_actedge_directions)
+        tgt_actnode_masks_shift = merge_shift('tgt_actnode_masks', 0)    # node mask on the tgt input side
+
+        # the values referring to node positions should be shifted 1 to the right as well, excluding the <s>
+        # position and the padding
+        tgt_lengths = torch.LongTensor([len(s['tgt_actedge_cur_nodes']) for s in samples])
+        positions = torch.arange(tgt_actedge_cur_nodes.size(1))
+        shifted_mask = (positions >= 1) & (positions < tgt_lengths.unsqueeze(1))
+        tgt_actedge_cur_nodes[shifted_mask & (tgt_actedge_cur_nodes >= 0)] += 1
+        tgt_actedge_pre_nodes[shifted_mask & (tgt_actedge_pre_nodes >= 0)] += 1
+
         tgt_actedge_masks = tgt_actedge_masks.index_select(0, sort_order)
-        tgt_actedge_cur_nodes = merge('tgt_actedge_cur_nodes', left_pad=left_pad_target,
-                                      pad_idx=pad_tgt_actedge_cur_nodes)
         tgt_actedge_cur_nodes = tgt_actedge_cur_nodes.index_select(0, sort_order)
-        tgt_actedge_pre_nodes = merge('tgt_actedge_pre_nodes', left_pad=left_pad_target,
-                                      pad_idx=pad_tgt_actedge_pre_nodes)
         tgt_actedge_pre_nodes = tgt_actedge_pre_nodes.index_select(0, sort_order)
-        tgt_actedge_directions = merge('tgt_actedge_directions', left_pad=left_pad_target,
-                                       pad_idx=pad_tgt_actedge_directions)
         tgt_actedge_directions = tgt_actedge_directions.index_select(0, sort_order)
-        tgt_actnode_masks_shift = merge('tgt_actnode_masks_shift', left_pad=left_pad_target, pad_idx=0)
         tgt_actnode_masks_shift = tgt_actnode_masks_shift.index_select(0, sort_order)
     else:
         # graph structure
@@ -413,9 +427,10 @@ class AMRActionPointerDataset(FairseqDataset):
         tgt_in_item = self.tgt_in[index] if self.tgt_in is not None else None
         tgt_pos_item = self.tgt_pos[index]
 
-        src_wordpieces_item = self.src_wordpieces[index].type(torch.long)    # TODO type conversion here is needed
-        src_wp2w_item = self.src_wp2w[index].type(torch.long)
-        # TODO type conversion above is needed; change in preprocessing while saving data
+        # NOTE preprocessing saves these as int64, for which this is a no-op returning the memory mapped tensor;
+        #      data saved as int32 with older code is still converted here
+        src_wordpieces_item = self.src_wordpieces[index].long()
+        src_wp2w_item = self.src_wp2w[index].long()
 
         # Deduce pretrained embeddings size; the src_fix_emb is NOT averaged to words
         if self.src_fix_emb_use:
@@ -451,50 +466,10 @@ class AMRActionPointerDataset(FairseqDataset):
             if self.tgt_actedge_pre_nodes is not None else None
         tgt_actedge_directions_item = self.tgt_actedge_directions[index] \
             if self.tgt_actedge_directions is not None else None
-        tgt_actnode_mask_shift_item = None
-
-        # ========== shift the tgt input vector to be fed into model ==========
-        # NOTE we must clone first -- modification in their original place is not allowed
-        # if not using .clone(), there is an error:
-        #      RuntimeError: unsupported operation: some elements of the input tensor and the written-to tensor refer to
-        #      a single memory location. Please clone() the tensor before performing the operation.
-        if tgt_in_item is not None:
-            tgt_in_item = tgt_in_item.clone()
-            tgt_in_item[1:] = tgt_in_item[:-1].clone()
-            # for the <s> position at the beginning
-            tgt_in_item[0] = self.tgt_dict.eos()
-
-        # =====================================================================
-
-        # ========== tgt graph structure information should be tied with the tgt input ==========
-        if self.collate_tgt_states_graph:
-            # a) the vectors should be shifted to the right
-            tgt_actedge_masks_item = tgt_actedge_masks_item.clone()
-            tgt_actedge_cur_nodes_item = tgt_actedge_cur_nodes_item.clone()
-            tgt_actedge_pre_nodes_item = tgt_actedge_pre_nodes_item.clone()
-            tgt_actedge_directions_item = tgt_actedge_directions_item.clone()
-            tgt_actnode_mask_shift_item = tgt_actnode_mask_item.clone()    # node mask on the tgt input side
-            # NOTE we must clone first -- modification in their original place is not allowed
-            # if not using .clone(), there is an error:
-            #      RuntimeError: unsupported operation: some elements of the input tensor and the written-to tensor refer to
-            #      a single memory location. Please clone() the tensor before performing the operation.
-            for tgt_actedge_x in (tgt_actedge_masks_item, tgt_actedge_cur_nodes_item,
-                                tgt_actedge_pre_nodes_item, tgt_actedge_directions_item,
-                                tgt_actnode_mask_shift_item):
-                tgt_actedge_x[1:] = tgt_actedge_x[:-1].clone()
-
-            # b) the values referring to node positions should be shifted 1 to the right as well
-            tgt_actedge_cur_nodes_item[tgt_actedge_cur_nodes_item >= 0] += 1
-            tgt_actedge_pre_nodes_item[tgt_actedge_pre_nodes_item >= 0] += 1
-
-            # c) for the <s> position at the beginning
-            tgt_actedge_masks_item[0] = 0
-            tgt_actedge_cur_nodes_item[0] = self.pad_tgt_actedge_cur_nodes
-            tgt_actedge_pre_nodes_item[0] = self.pad_tgt_actedge_pre_nodes
-            tgt_actedge_directions_item[0] = self.pad_tgt_actedge_directions
-            tgt_actnode_mask_shift_item[0] = 0
-
-        # ========================================================================================
+
+        # NOTE the tgt input and the tgt graph structure information tied with it are NOT shifted here, but in the
+        #      collate function while copying into the batch, so that all the items are views of the memory mapped
+        #      data without any copy
 
         # Append EOS to end of tgt sentence if it does not have an EOS and remove
         # EOS from end of src sentence if it exists. This is useful when we use
@@ -518,8 +493,6 @@ class AMRActionPointerDataset(FairseqDataset):
                 if tgt_actedge_pre_nodes_item is not None else None
             tgt_actedge_directions_item = tgt_actedge_directions_item[:-1] \
                 if tgt_actedge_directions_item is not None else None
-            tgt_actnode_mask_shift_item = tgt_actnode_mask_shift_item[:-1] \
-                if tgt_actnode_mask_shift_item is not None else None
 
         if self.remove_eos_from_source:
             eos = self.src_dict.eos()
@@ -544,8 +517,7 @@ class AMRActionPointerDataset(FairseqDataset):
             'tgt_actedge_masks': tgt_actedge_masks_item,
             'tgt_actedge_cur_nodes': tgt_actedge_cur_nodes_item,
             'tgt_actedge_pre_nodes': tgt_actedge_pre_nodes_item,
-            'tgt_actedge_directions': tgt_actedge_directions_item,
-            'tgt_actnode_masks_shift': tgt_actnode_mask_shift_item
+            'tgt_actedge_directions': tgt_actedge_directions_item
         }
 
     def __len__(self):
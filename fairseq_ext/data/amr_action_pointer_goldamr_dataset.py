@@ -310,6 +310,7 @@ class AMRActionPointerGoldAMRDataset(FairseqDataset):
                  tgt_pos_sizes=None,
                  # gold AMR with alignments (to enable running oracle on the fly)
                  gold_amrs=None,
+                 oracle_data=None,
                  # core state info
                  tgt_vocab_masks=None,
                  tgt_actnode_masks=None,    # for the valid pointer positions
@@ -353,6 +354,8 @@ class AMRActionPointerGoldAMRDataset(FairseqDataset):
         self.tgt_pos_sizes = tgt_pos_sizes
 
         self.gold_amrs = gold_amrs
+        # to run the oracle on the gold AMRs of each batch when collating, see DynamicOracleData
+        self.oracle_data = oracle_data
 
         # additional dataset variables
 
@@ -597,7 +600,7 @@ class AMRActionPointerGoldAMRDataset(FairseqDataset):
                   target sentence of shape `(bsz, tgt_len)`. Padding will appear
                   on the left if *left_pad_target* is ``True``.
         """
-        return collate(
+        batch = collate(
             samples, pad_idx=self.tgt_dict.pad(), eos_idx=self.tgt_dict.eos(),
             left_pad_source=self.left_pad_source, left_pad_target=self.left_pad_target,
             input_feeding=self.input_feeding,
@@ -607,6 +610,10 @@ class AMRActionPointerGoldAMRDataset(FairseqDataset):
             pad_tgt_actedge_pre_nodes=self.pad_tgt_actedge_pre_nodes,
             pad_tgt_actedge_directions=self.pad_tgt_actedge_directions
         )
+        # target data from the oracle run on the fly, in the dataloader workers ahead of the training step
+        if self.oracle_data is not None and batch.get('gold_amrs', None) is not None:
+            batch['oracle_tgt'] = self.oracle_data.get_batch_tgt(batch['gold_amrs'])
+        return batch
 
     def num_tokens(self, index):
         """Return the number of tokens in a sample. This value is used to
@@ -0,0 +1,230 @@
+"""Single file container for all the indexed data files of a split.
+
+The many parallel `MMapIndexedDataset` files of a split (`en.wordpieces`, `en.wp2w`, `actions.src_cursors`, ...) are
+concatenated into one data file with one index, keeping the data type of each field. The container is memory mapped
+once per process and shared by all its fields and by the copies of the dataset in the dataloader workers; all the
+processes of a node share the same pages through the page cache.
+
+After opening the container with `open_consolidated_dataset()`, `load_indexed_dataset()` returns its fields instead
+of opening the original files. The header keeps the size and modification time of the original files, the container is
+ignored if any of them changed since it was written.
+"""
+import json
+import mmap
+import os
+import shutil
+import struct
+
+import numpy as np
+import torch
+
+from fairseq_ext.data.indexed_dataset import (
+    MMapIndexedDataset,
+    data_file_path,
+    index_file_path
+)
+
+
+_HDR_MAGIC = b'CONSIDX\x00\x00'
+# alignment of the data of each field in the data file, in bytes
+_ALIGNMENT = 64
+
+# containers opened in this process, by path
+_opened = {}
+# fields of the opened containers, by the path of the original indexed data file they replace
+_fields = {}
+
+
+def get_source_stats(path):
+    """Size and modification time (ns) of the data and index files of an indexed data file"""
+    stats = {}
+    for kind, file_path in (('bin', data_file_path(path)), ('idx', index_file_path(path))):
+        stat = os.stat(file_path)
+        stats[kind] = [stat.st_size, stat.st_mtime_ns]
+    return stats
+
+
+def is_source_changed(path, stats):
+    """Whether an indexed data file changed since its `get_source_stats()` were taken"""
+    for kind, (size, mtime) in get_source_stats(path).items():
+        if size != stats[kind][0] or mtime > stats[kind][1]:
+            return True
+    return False
+
+
+def consolidate_indexed_datasets(path, field_paths):
+    """Concatenate indexed data files in mmap format into a single container.
+
+    Args:
+        path (str): path prefix of the container, to write '.bin' and '.idx' files.
+        field_paths (dict): path prefix of the indexed data file of each field, by field name. The field name is the
+            base name of the file by default, e.g. 'train.en-actions.en.wp2w'.
+    """
+    fields = []
+    with open(data_file_path(path), 'wb') as data_file:
+        for name, field_path in field_paths.items():
+            source = get_source_stats(field_path)
+            index = MMapIndexedDataset.Index(index_file_path(field_path))
+            offset = data_file.tell()
+            with open(data_file_path(field_path), 'rb') as f:
+                shutil.copyfileobj(f, data_file)
+            # pad to align the data of the next field
+            data_file.write(b'\x00' * (-data_file.tell() % _ALIGNMENT))
+            fields.append({
+                'name': name,
+                'source': source,
+                'dtype': np.dtype(index.dtype).name,
+                'sizes': np.array(index.sizes),
+                'pointers': index._pointers + offset
+            })
+            del index
+
+    header = json.dumps([
+        {'name': field['name'], 'source': field['source'], 'dtype': field['dtype'], 'len': len(field['sizes'])}
+        for field in fields
+    ]).encode('utf-8')
+    with open(index_file_path(path), 'wb') as index_file:
+        index_file.write(_HDR_MAGIC)
+        index_file.write(struct.pack('<Q', len(header)))
+        index_file.write(header)
+        # sizes and pointers of each field, in order
+        for field in fields:
+            index_file.write(np.asarray(field['sizes'], dtype=np.int32).tobytes(order='C'))
+            index_file.write(np.asarray(field['pointers'], dtype=np.int64).tobytes(order='C'))
+
+
+class ConsolidatedDataset:
+    """Memory mapped container of several indexed data fields, stored in one data file and one index file.
+
+    Args:
+        path (str): path prefix of the container '.bin' and '.idx' files.
+    """
+    def __init__(self, path):
+        self.path = path
+
+        with open(index_file_path(path), 'rb') as stream:
+            magic_test = stream.read(len(_HDR_MAGIC))
+            assert magic_test == _HDR_MAGIC, f'{index_file_path(path)} is not a consolidated dataset index file'
+            header_len, = struct.unpack('<Q', stream.read(8))
+            header = json.loads(stream.read(header_len).decode('utf-8'))
+            index = np.frombuffer(stream.read(), dtype=np.uint8)
+
+        self.fields = {}
+        # size and modification time of the original files of each field, see `get_source_stats()`
+        self.sources = {}
+        offset = 0
+        for field in header:
+            self.sources[field['name']] = field.get('source', None)
+            num = field['len']
+            sizes = np.frombuffer(index, dtype=np.int32, count=num, offset=offset)
+            offset += sizes.nbytes
+            pointers = np.frombuffer(index, dtype=np.int64, count=num, offset=offset)
+            offset += pointers.nbytes
+            self.fields[field['name']] = ConsolidatedField(self, field['name'], np.dtype(field['dtype']), sizes,
+                                                           pointers)
+
+        self._bin_buffer_mmap = np.memmap(data_file_path(path), mode='r', order='C')
+        self._bin_buffer = memoryview(self._bin_buffer_mmap)
+        # ask for the file to be read ahead in the background, instead of reading it all through in every process;
+        # pages already in the page cache of the node are not read again
+        if hasattr(mmap, 'MADV_WILLNEED'):
+            self._bin_buffer_mmap._mmap.madvise(mmap.MADV_WILLNEED)
+
+    def __getitem__(self, name):
+        return self.fields[name]
+
+    def __contains__(self, name):
+        return name in self.fields
+
+    def get_changed_fields(self, data_dirs):
+        """Names of the fields whose original files in any of the folders changed after the container was written"""
+        changed = []
+        for name, source in self.sources.items():
+            for data_dir in data_dirs:
+                field_path = os.path.join(data_dir, name)
+                if not (os.path.exists(index_file_path(field_path)) and os.path.exists(data_file_path(field_path))):
+                    continue
+                # containers written before the sources were recorded can not be checked
+                if source is None or is_source_changed(field_path, source):
+                    changed.append(name)
+                    break
+        return changed
+
+    def get_item(self, field, i):
+        np_array = np.frombuffer(self._bin_buffer, dtype=field.dtype, count=field.sizes[i], offset=field.pointers[i])
+        return torch.from_numpy(np_array)
+
+    @staticmethod
+    def exists(path):
+        return os.path.exists(index_file_path(path)) and os.path.exists(data_file_path(path))
+
+
+class ConsolidatedField(torch.utils.data.Dataset):
+    """One field of a `ConsolidatedDataset`, with the same interface as `MMapIndexedDataset`."""
+    def __init__(self, container, name, dtype, sizes, pointers):
+        super().__init__()
+        self.container = container
+        self.name = name
+        self.dtype = dtype
+        self._sizes = sizes
+        self.pointers = pointers
+
+    def __getstate__(self):
+        # only the path is pickled, e.g. for the dataloader workers, which open the container once for all the fields
+        return self.container.path, self.name
+
+    def __setstate__(self, state):
+        path, name = state
+        self.__dict__.update(get_consolidated_dataset(path)[name].__dict__)
+
+    def __len__(self):
+        return len(self._sizes)
+
+    def __getitem__(self, i):
+        return self.container.get_item(self, i)
+
+    @property
+    def sizes(self):
+        return self._sizes
+
+    @property
+    def supports_prefetch(self):
+        return False
+
+
+def get_consolidated_dataset(path):
+    """Open a container, only once per process"""
+    if path not in _opened:
+        _opened[path] = ConsolidatedDataset(path)
+    return _opened[path]
+
+
+def open_consolidated_dataset(path, data_dirs):
+    """Open a container, if it exists, so that `load_indexed_dataset()` loads its fields from it.
+
+    Args:
+        path (str): path prefix of the container.
+        data_dirs (List[str]): folders where the original indexed data files of the fields were.
+
+    Returns:
+        ConsolidatedDataset: the container, or None if it does not exist or is older than the original files.
+    """
+    if not ConsolidatedDataset.exists(path):
+        return None
+    container = get_consolidated_dataset(path)
+    changed = container.get_changed_fields(data_dirs)
+    if changed:
+        # the original files are loaded instead
+        print(f'| WARNING: ignoring consolidated dataset {path}, the original files of {len(changed)} fields changed '
+              f'after it was written ({", ".join(changed)}); re-run fairseq_ext/consolidate_data.py')
+        return None
+    for data_dir in data_dirs:
+        for name, field in container.fields.items():
+            _fields[os.path.normpath(os.path.join(data_dir, name))] = field
+    print(f'| opened consolidated dataset with {len(container.fields)} fields: {path}')
+    return container
+
+
+def get_consolidated_field(path):
+    """Field of an opened container replacing the indexed data file with the given path prefix, or None"""
+    return _fields.get(os.path.normpath(path), None)
@@ -229,6 +229,13 @@ def load_indexed_dataset(path, dictionary, dataset_impl=None, combine=False, def
     """
     from fairseq.data.concat_dataset import ConcatDataset
     from . import indexed_dataset
+    from .consolidated_dataset import get_consolidated_field
+
+    # field of an opened consolidated dataset replacing the file
+    field = get_consolidated_field(path)
+    if field is not None:
+        print('| loaded {} examples from: {} (consolidated in {})'.format(len(field), path, field.container.path))
+        return field
 
     datasets = []
     for k in itertools.count():
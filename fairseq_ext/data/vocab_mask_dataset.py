@@ -0,0 +1,41 @@
+import torch
+
+
+class CanonicalVocabMaskDataset(torch.utils.data.Dataset):
+    """Target vocabulary masks for each action step, expanded on the fly from the canonical actions allowed at each
+    step. Only one small integer per step is stored on disk, instead of a dense row over the action vocabulary.
+
+    Args:
+        codes (MMapIndexedDataset): bit codes of the allowed canonical actions at each step of each example, where bit
+            i is set if canonical action i is allowed
+        table (torch.Tensor): vocabulary mask of each canonical action, of size (num_canonical_actions, vocab_size)
+
+    Note:
+        - items are returned flattened, the same as the dense masks saved by previous versions, to be reshaped into
+          (num_steps, vocab_size) by the dataset.
+    """
+    def __init__(self, codes, table):
+        super().__init__()
+        self.codes = codes
+        self.table = table.bool()
+        self.vocab_size = table.size(1)
+        self.bits = 1 << torch.arange(table.size(0))
+
+    def __len__(self):
+        return len(self.codes)
+
+    def __getitem__(self, i):
+        codes = self.codes[i].long()
+        # only a handful of different sets of canonical actions are allowed along a sentence
+        unique_codes, inverse = torch.unique(codes, return_inverse=True)
+        allowed = (unique_codes.unsqueeze(1) & self.bits) != 0    # size (num_unique_codes, num_canonical_actions)
+        masks = (allowed.unsqueeze(2) & self.table).any(dim=1)    # size (num_unique_codes, vocab_size)
+        return masks[inverse].to(torch.uint8).view(-1)
+
+    @property
+    def sizes(self):
+        return self.codes.sizes * self.vocab_size
+
+    @property
+    def supports_prefetch(self):
+        return False
@@ -1,10 +1,20 @@
+import os
 import numpy as np
 import torch
 import shutil
 import time
+from multiprocessing import Pool
+
+from fairseq.binarizer import Binarizer, safe_readline
 
 from ..data import indexed_dataset
 from ..utils import time_since
+from ..roberta.binarize_embeddings import read_sentences, prefetch, iter_extracted
+
+
+# BART sentence encoder of this process, set by make_binary_bart_encodings()
+# in the main process and by init_encoding_worker() in the workers
+sentence_encoder = None
 
 
 def dataset_dest_prefix(args, output_prefix, lang):
@@ -34,6 +44,125 @@ def get_scatter_indices(word2piece, reverse=False):
     return torch.tensor(wp_indices)
 
 
+def encode_sentences(input_file, offset, end, tokenize, indexed_wordpieces, indexed_wp2w):
+    """Encode the lines of input_file between byte offsets offset and end (0 for end of file)"""
+    num_sents = 0
+    with open(input_file, 'r') as fid:
+        fid.seek(offset)
+        # next line start, if offset is not at one
+        line = safe_readline(fid)
+        while line:
+            if end > 0 and fid.tell() > end:
+                break
+
+            # we only have tokenized data so we feed whitespace separated
+            # tokens
+            sentence = " ".join(tokenize(str(line).rstrip()))
+            wordpieces_roberta, word2piece = sentence_encoder.encode_sentence(sentence)
+
+            # just store the `wordpieces_roberta` indices, including BOS/EOS tokens
+            # `word2piece` excluding BOS/EOS tokens
+            indexed_wordpieces.add_item(wordpieces_roberta)
+            indexed_wp2w.add_item(
+                get_scatter_indices(word2piece, reverse=True)
+            )
+            num_sents += 1
+            line = fid.readline()
+
+    return num_sents
+
+
+def init_encoding_worker(pretrained_embed):
+    """Worker initializer: load the BART encoder on CPU, as the workers only do the BPE encoding"""
+    global sentence_encoder
+    from .sentence_encoding import SentenceEncodingBART
+    sentence_encoder = SentenceEncodingBART(pretrained_embed, use_gpu=False)
+
+
+def encode_shard(args, input_file, output_prefix, offset, end, tokenize):
+    """Worker: encode a part of the input file into separate .bin/.idx files, to be merged"""
+    indexed_wordpieces = indexed_dataset.make_builder(
+        dataset_dest_file(args, output_prefix, 'en.wordpieces', "bin"),
+        impl=args.dataset_impl,
+        dtype=np.int64
+    )
+    indexed_wp2w = indexed_dataset.make_builder(
+        dataset_dest_file(args, output_prefix, 'en.wp2w', "bin"),
+        impl=args.dataset_impl,
+        dtype=np.int64
+    )
+    num_sents = encode_sentences(input_file, offset, end, tokenize, indexed_wordpieces, indexed_wp2w)
+    indexed_wordpieces.finalize(dataset_dest_file(args, output_prefix, 'en.wordpieces', "idx"))
+    indexed_wp2w.finalize(dataset_dest_file(args, output_prefix, 'en.wp2w', "idx"))
+    return num_sents
+
+
+def make_binary_bart_encodings(args, input_prefix, output_prefix, tokenize):
+    """Encode sentences in BART bpe vocabulary, with the file split across --workers processes"""
+    global sentence_encoder
+    from .sentence_encoding import SentenceEncodingBART
+
+    input_file = input_prefix + '.en'
+    num_workers = args.workers
+
+    start = time.time()
+    offsets = Binarizer.find_offsets(input_file, num_workers)
+    pool = None
+    if num_workers > 1:
+        # each worker loads its own encoder, which does not rely on the pool forking this process
+        pool = Pool(processes=num_workers - 1, initializer=init_encoding_worker,
+                    initargs=(args.pretrained_embed,))
+        worker_results = [
+            pool.apply_async(
+                encode_shard,
+                (args, input_file, "{}{}".format(output_prefix, worker_id), offsets[worker_id],
+                 offsets[worker_id + 1], tokenize)
+            )
+            for worker_id in range(1, num_workers)
+        ]
+        pool.close()
+
+    # NOTE only encode token ids in BART bpe vocabulary, not the pretrained embedding features
+    # loaded after starting the workers, so that they do not inherit it (and its CUDA context) when forked
+    sentence_encoder = SentenceEncodingBART(args.pretrained_embed)
+
+    # first part in this process, written directly to the final files
+    indexed_wordpieces = indexed_dataset.make_builder(
+        dataset_dest_file(args, output_prefix, 'en.wordpieces', "bin"),
+        impl=args.dataset_impl,
+        dtype=np.int64
+    )
+    indexed_wp2w = indexed_dataset.make_builder(
+        dataset_dest_file(args, output_prefix, 'en.wp2w', "bin"),
+        impl=args.dataset_impl,
+        dtype=np.int64
+    )
+    num_sents = encode_sentences(input_file, 0, offsets[1], tokenize, indexed_wordpieces, indexed_wp2w)
+
+    # append the other parts in file order
+    if num_workers > 1:
+        pool.join()
+        for worker_id, worker_result in zip(range(1, num_workers), worker_results):
+            num_sents += worker_result.get()
+            prefix = "{}{}".format(output_prefix, worker_id)
+            for indexed, name in [(indexed_wordpieces, 'en.wordpieces'), (indexed_wp2w, 'en.wp2w')]:
+                temp_file_path = dataset_dest_prefix(args, prefix, name)
+                indexed.merge_file_(temp_file_path)
+                os.remove(indexed_dataset.data_file_path(temp_file_path))
+                os.remove(indexed_dataset.index_file_path(temp_file_path))
+    print("%d sentences (time: %s)" % (num_sents, time_since(start)))
+
+    indexed_wordpieces.finalize(
+        dataset_dest_file(args, output_prefix, 'en.wordpieces', "idx")
+    )
+    indexed_wp2w.finalize(
+        dataset_dest_file(args, output_prefix, 'en.wp2w', "idx")
+    )
+
+    # copy the source sentence file to go together with the embeddings
+    shutil.copyfile(input_file, dataset_dest_prefix(args, output_prefix, 'en'))
+
+
 def make_binary_bert_features(args, input_prefix, output_prefix, tokenize):
 
     # Load pretrained embeddings extractor
@@ -46,7 +175,6 @@ def make_binary_bert_features(args, input_prefix, output_prefix, tokenize):
             remove_be=False,
             avg_word=False
         )
-        no_embeddings = False
     elif args.pretrained_embed.startswith('bert'):
         from ..roberta.pretrained_embeddings_bert import PretrainedEmbeddings
 
@@ -54,81 +182,65 @@ def make_binary_bert_features(args, input_prefix, output_prefix, tokenize):
             args.pretrained_embed,
             args.bert_layers
         )
-        no_embeddings = False
     elif args.pretrained_embed.startswith('bart'):
-        from .sentence_encoding import SentenceEncodingBART
-
         # NOTE only encode token ids in BART bpe vocabulary, not the pretrained embedding features
-        pretrained_embeddings = SentenceEncodingBART(
-            args.pretrained_embed
-        )
-        no_embeddings = True
+        return make_binary_bart_encodings(args, input_prefix, output_prefix, tokenize)
     else:
         raise ValueError('arg.pretrained_embed should be either roberta.* or bert-*')
 
     # will store pre-extracted BERT layer
-    if not no_embeddings:
-        indexed_data = indexed_dataset.make_builder(
-            dataset_dest_file(args, output_prefix, 'en.bert', "bin"),
-            impl=args.dataset_impl,
-            dtype=np.float32
-        )
+    indexed_data = indexed_dataset.make_builder(
+        dataset_dest_file(args, output_prefix, 'en.bert', "bin"),
+        impl=args.dataset_impl,
+        dtype=np.float32
+    )
 
     # will store wordpieces and wordpiece to word mapping
     indexed_wordpieces = indexed_dataset.make_builder(
         dataset_dest_file(args, output_prefix, 'en.wordpieces', "bin"),
         impl=args.dataset_impl,
+        dtype=np.int64
     )
 
     indexed_wp2w = indexed_dataset.make_builder(
         dataset_dest_file(args, output_prefix, 'en.wp2w', "bin"),
         impl=args.dataset_impl,
+        dtype=np.int64
     )
 
     num_sents = 0
     input_file = input_prefix + '.en'
 
     start = time.time()
-    with open(input_file, 'r') as fid:
-        for sentence in fid:
-
-            # we only have tokenized data so we feed whitespace separated
-            # tokens
-            sentence = " ".join(tokenize(str(sentence).rstrip()))
-
-            # extract embeddings, average them per token and return
-            # wordpieces anyway
-            if not no_embeddings:
-                word_features, wordpieces_roberta, word2piece = \
-                    pretrained_embeddings.extract(sentence)
-            else:
-                wordpieces_roberta, word2piece = pretrained_embeddings.encode_sentence(sentence)
-
-            # note that data needs to be stored as a 1d array. Also check
-            # that number nof woprds matches with embedding size
-            if not no_embeddings:
-                assert word_features.shape[1] == len(wordpieces_roberta)    # not average to words and keep BOS/EOS
-                # assert word_features.shape[1] == len(sentence.split())    # average to words and remove BOS/EOS
-                indexed_data.add_item(word_features.cpu().view(-1))
-
-            # just store the `wordpieces_roberta` indices, including BOS/EOS tokens
-            # `word2piece` excluding BOS/EOS tokens
-            indexed_wordpieces.add_item(wordpieces_roberta)
-            indexed_wp2w.add_item(
-                get_scatter_indices(word2piece, reverse=True)
-            )
+    # extract embeddings and return wordpieces anyway; batched by length,
+    # while the next sentences are read
+    sentences = prefetch(read_sentences(input_file, tokenize))
+    for sentence, (word_features, wordpieces_roberta, word2piece) in \
+            iter_extracted(pretrained_embeddings, sentences, getattr(args, 'embed_batch_size', 1)):
+
+        # note that data needs to be stored as a 1d array. Also check
+        # that number nof woprds matches with embedding size
+        assert word_features.shape[1] == len(wordpieces_roberta)    # not average to words and keep BOS/EOS
+        # assert word_features.shape[1] == len(sentence.split())    # average to words and remove BOS/EOS
+        indexed_data.add_item(word_features.cpu().view(-1))
+
+        # just store the `wordpieces_roberta` indices, including BOS/EOS tokens
+        # `word2piece` excluding BOS/EOS tokens
+        indexed_wordpieces.add_item(wordpieces_roberta)
+        indexed_wp2w.add_item(
+            get_scatter_indices(word2piece, reverse=True)
+        )
 
-            # udpate number of sents
-            num_sents += 1
-            if not num_sents % 100:
-                print("\r%d sentences (time: %s)" % (num_sents, time_since(start)), end='')
-        print("")
+        # udpate number of sents
+        num_sents += 1
+        if not num_sents % 100:
+            print("\r%d sentences (time: %s)" % (num_sents, time_since(start)), end='')
+    print("")
 
     # close indexed data files
-    if not no_embeddings:
-        indexed_data.finalize(
-            dataset_dest_file(args, output_prefix, 'en.bert', "idx")
-        )
+    indexed_data.finalize(
+        dataset_dest_file(args, output_prefix, 'en.bert', "idx")
+    )
 
     indexed_wordpieces.finalize(
         dataset_dest_file(args, output_prefix, 'en.wordpieces', "idx")
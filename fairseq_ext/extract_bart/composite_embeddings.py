@@ -96,6 +96,10 @@ class CompositeEmbeddingBART(CompositeEmbedding):
         self.embedding_dim = bart_embeddings.embedding_dim
         # NOTE bart_embeddings is torch.nn.Embedding
 
+        # embeddings computed without autograd (inference, or fixed base embeddings) are reused until the parameters
+        # may have changed, see reset_cache()
+        self.embedding_weight = None
+        self.mixed_weights = {}    # id(weight) -> (weight, mixed weight), see mix_weight()
         self.update_embeddings()    # initialize the embeddings based on base embeddings
 
     def map_symbol(self, sym, transform=None):
@@ -133,7 +137,61 @@ class CompositeEmbeddingBART(CompositeEmbedding):
         return emb
 
     def update_embeddings(self):
+        if self.is_reusable(self.embedding_weight, self.get_base_weight()):
+            return
         self.embedding_weight = self.scatter_embeddings(self.extract_index, self.scatter_index)
+        self.mixed_weights = {}
+
+    def mix_weight(self, weight):
+        """Embedding matrix with the rows of the PRED node actions taken from the compositional embeddings and the other
+        rows from `weight`. Call `update_embeddings()` first.
+
+        Args:
+            weight (torch.Tensor): embedding matrix over the same dictionary, of size (num_embeddings, embedding_dim)
+
+        Returns:
+            torch.Tensor: mixed embedding matrix, of the same size
+        """
+        cached_weight, mixed_weight = self.mixed_weights.get(id(weight), (None, None))
+        if cached_weight is weight and self.is_reusable(mixed_weight, weight, self.get_base_weight()):
+            return mixed_weight
+        mixed_weight = torch.where(self.dict_pred_mask.unsqueeze(1), self.embedding_weight, weight)
+        self.mixed_weights[id(weight)] = (weight, mixed_weight)
+        return mixed_weight
+
+    def get_base_weight(self):
+        if isinstance(self.base_embeddings, torch.nn.Embedding):
+            return self.base_embeddings.weight
+        return self.base_embeddings
+
+    @staticmethod
+    def is_reusable(cached, *params):
+        """A cached tensor is reused if it was computed without autograd and no gradient is needed for its parameters
+        now; during training it is computed again for each forward pass"""
+        return (
+            cached is not None
+            and cached.grad_fn is None
+            and not (torch.is_grad_enabled() and any(param.requires_grad for param in params))
+        )
+
+    def reset_cache(self):
+        """Compute the embeddings again at next use, after the parameters may have changed"""
+        self.embedding_weight = None
+        self.mixed_weights = {}
+
+    def set_num_updates(self, num_updates):
+        # called by the model after each optimizer update
+        self.reset_cache()
+
+    def _load_from_state_dict(self, *args, **kwargs):
+        # new parameters from a checkpoint
+        self.reset_cache()
+        super()._load_from_state_dict(*args, **kwargs)
+
+    def _apply(self, fn):
+        # parameters moved to another device or data type
+        self.reset_cache()
+        return super()._apply(fn)
 
     def get_dictionary_mask(self):
         # mask on the dictionary elements that we'd like to keep using the BART compositional embeddings
@@ -100,3 +100,50 @@ def get_graph_self_attn_mask(tgt_actedge_masks, tgt_actedge_cur_nodes,
         bsz_head_mask = bsz_head_mask.bool()
 
     return bsz_head_mask, bsz_head_mask_post_softmax
+
+
+def get_graph_self_attn_mask_last_step(tgt_actedge_masks, tgt_actedge_cur_nodes,
+                                       tgt_actedge_pre_nodes, tgt_actedge_directions,
+                                       tgt_actnode_masks_shift,
+                                       mask_num_heads, num_heads,
+                                       tgt_graph_mask='e1c1p1'):
+    """Only the last row of the mask from `get_graph_self_attn_mask()`, for incremental decoding.
+
+    Each row of the mask only depends on the graph structure at its own target position, so the row of the newest
+    position is built directly in O(tgt_max_len), instead of building the full (tgt_max_len, tgt_max_len) masks for
+    all the heads and taking out the last row. The arguments are the same as for `get_graph_self_attn_mask()`.
+
+    Returns:
+        mask_pre_softmax (torch.BoolTensor): size (batch_size * num_heads, 1, tgt_max_len).
+        mask_post_softmax (torch.FloatTensor): size (batch_size * num_heads, 1, 1).
+    """
+    assert len(tgt_graph_mask) == 6
+    assert tgt_graph_mask[0] == 'e' and tgt_graph_mask[2] == 'c' and tgt_graph_mask[4] == 'p'
+
+    bsz, tgt_max_len = tgt_actedge_masks.size()
+    last = tgt_max_len - 1
+
+    # node diagonal mask at the last position, size (batch_size, tgt_max_len)
+    mask = tgt_actedge_masks.new_zeros(bsz, tgt_max_len, dtype=torch.uint8)
+    mask[:, last] = tgt_actnode_masks_shift[:, last] != 0
+
+    # edge diagonal mask at the last position
+    if tgt_graph_mask[1] == '1':
+        mask[:, last] |= (tgt_actedge_masks[:, last] != 0).to(torch.uint8)
+
+    # make the mask: at edge position, attend to the edge and two nodes
+    if tgt_graph_mask[3] == '1':
+        # NOTE root node is not added by any action, the cur_node is denoted as -2
+        edge_idx_noroot = torch.nonzero(tgt_actedge_cur_nodes[:, last] >= 0).squeeze(1)
+        mask[edge_idx_noroot, tgt_actedge_cur_nodes[edge_idx_noroot, last]] = 1
+    if tgt_graph_mask[5] == '1':
+        edge_idx = torch.nonzero(tgt_actedge_masks[:, last]).squeeze(1)
+        mask[edge_idx, tgt_actedge_pre_nodes[edge_idx, last]] = 1
+
+    # put the mask into heads; the row is causal already as it is the last one
+    bsz_head_mask = mask.new_ones(bsz, num_heads, tgt_max_len)
+    bsz_head_mask[:, :mask_num_heads, :] = mask.unsqueeze(1)
+    bsz_head_mask = bsz_head_mask.view(-1, 1, tgt_max_len)
+
+    # modify the mask to prevent NAN
+    return modify_mask_pre_post_softmax(bsz_head_mask)
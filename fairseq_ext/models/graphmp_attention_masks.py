@@ -147,3 +147,85 @@ def get_graph_self_attn_mask(tgt_actedge_masks,
         bsz_head_mask = bsz_head_mask.bool()
 
     return bsz_head_mask, bsz_head_mask_post_softmax
+
+
+def get_graph_self_attn_mask_last_step(tgt_actedge_masks,
+                                       tgt_actedge_1stnode_masks,
+                                       tgt_actedge_indexes,
+                                       tgt_actedge_cur_node_indexes,
+                                       tgt_actedge_cur_1stnode_indexes,
+                                       tgt_actedge_pre_node_indexes,
+                                       tgt_actedge_directions,
+                                       # graph structure to connect with all previous nodes
+                                       tgt_actedge_allpre_indexes,
+                                       tgt_actedge_allpre_pre_node_indexes,
+                                       tgt_actedge_allpre_directions,
+                                       # mask generation control
+                                       mask_num_heads,
+                                       num_heads,
+                                       tgt_graph_mask='1prev'
+                                       ):
+    """Only the last row of the mask from `get_graph_self_attn_mask()`, for incremental decoding.
+
+    Each row of the mask only depends on the edges at its own target position, so the row of the newest position is
+    built directly from the entries at that position, instead of building the full (tgt_max_len, tgt_max_len) masks for
+    all the heads and taking out the last row. The arguments are the same as for `get_graph_self_attn_mask()`.
+
+    Returns:
+        mask_pre_softmax (torch.BoolTensor): size (batch_size * num_heads, 1, tgt_max_len).
+        mask_post_softmax (torch.FloatTensor): size (batch_size * num_heads, 1, 1).
+    """
+    assert tgt_graph_mask in ['1prev', 'allprev', '1prev_in', 'allprev_in', '1prev_1in1out', 'allprev_1in1out']
+    if tgt_graph_mask in ['1prev_1in1out', 'allprev_1in1out']:
+        assert mask_num_heads == 2
+
+    bsz, tgt_max_len = tgt_actedge_masks.size()
+    last = tgt_max_len - 1
+
+    def set_last_row(mask, indexes, node_indexes, selected=None):
+        # `indexes` are over the batch_size * tgt_max_len dimension; only keep the ones at the last position
+        at_last = indexes % tgt_max_len == last
+        if selected is not None:
+            at_last &= selected
+        mask[indexes[at_last] // tgt_max_len, node_indexes[at_last]] = 1
+
+    # node diagonal mask at the last position, size (batch_size, tgt_max_len)
+    mask = tgt_actedge_1stnode_masks.new_zeros(bsz, tgt_max_len)
+    mask[:, last] = tgt_actedge_1stnode_masks[:, last]
+
+    # encode the current node into the edge position; for input swap edges for nodes, this is just diagonal
+    set_last_row(mask, tgt_actedge_indexes, tgt_actedge_cur_node_indexes)
+
+    if tgt_graph_mask == '1prev':
+        set_last_row(mask, tgt_actedge_indexes, tgt_actedge_pre_node_indexes)
+    elif tgt_graph_mask == 'allprev':
+        set_last_row(mask, tgt_actedge_allpre_indexes, tgt_actedge_allpre_pre_node_indexes)
+    elif tgt_graph_mask == '1prev_in':
+        set_last_row(mask, tgt_actedge_indexes, tgt_actedge_pre_node_indexes, tgt_actedge_directions == 1)
+    elif tgt_graph_mask == 'allprev_in':
+        set_last_row(mask, tgt_actedge_allpre_indexes, tgt_actedge_allpre_pre_node_indexes,
+                     tgt_actedge_allpre_directions == 1)
+    elif tgt_graph_mask == '1prev_1in1out':
+        mask_in = mask.clone()
+        set_last_row(mask_in, tgt_actedge_indexes, tgt_actedge_pre_node_indexes, tgt_actedge_directions == 1)
+        mask_out = mask.clone()
+        set_last_row(mask_out, tgt_actedge_indexes, tgt_actedge_pre_node_indexes, tgt_actedge_directions != 1)
+        mask = torch.stack([mask_in, mask_out], dim=1)
+    elif tgt_graph_mask == 'allprev_1in1out':
+        mask_in = mask.clone()
+        set_last_row(mask_in, tgt_actedge_allpre_indexes, tgt_actedge_allpre_pre_node_indexes,
+                     tgt_actedge_allpre_directions == 1)
+        mask_out = mask.clone()
+        set_last_row(mask_out, tgt_actedge_allpre_indexes, tgt_actedge_allpre_pre_node_indexes,
+                     tgt_actedge_allpre_directions != 1)
+        mask = torch.stack([mask_in, mask_out], dim=1)
+    else:
+        raise NotImplementedError
+
+    # put the mask into heads; the row is causal already as it is the last one
+    bsz_head_mask = tgt_actedge_masks.new_ones(bsz, num_heads, tgt_max_len, dtype=torch.uint8)
+    bsz_head_mask[:, :mask_num_heads, :] = mask.unsqueeze(1) if mask.dim() == 2 else mask    # else mask.dim() == 3
+    bsz_head_mask = bsz_head_mask.view(-1, 1, tgt_max_len)
+
+    # modify the mask to prevent NAN
+    return modify_mask_pre_post_softmax(bsz_head_mask)
@@ -34,6 +34,7 @@ from fairseq.modules.transformer_sentence_encoder import init_bert_params
 from torch_scatter import scatter_mean
 
 from ..modules.transformer_layer import TransformerEncoderLayer, TransformerDecoderLayer
+from ..modules.multihead_attention import SharedKVIndex
 from .attention_masks import get_cross_attention_mask_heads
 from ..extract_bart.composite_embeddings import CompositeEmbeddingBART
 
@@ -1011,6 +1012,7 @@ class TransformerDecoder(FairseqIncrementalDecoder):
         tgt_vocab_masks=None,
         tgt_actnode_masks=None,
         tgt_src_cursors=None,
+        encoder_out_index=None,
         # unused
         **unused
     ):
@@ -1026,6 +1028,10 @@ class TransformerDecoder(FairseqIncrementalDecoder):
                 applying output layer (default: False).
             full_context_alignment (bool, optional): don't apply
                 auto-regressive mask to self-attention (default: False).
+            encoder_out_index (LongTensor, optional): batch index in
+                *encoder_out* of each decoded sequence, of shape `(batch,)`,
+                when the encoder output is shared by several sequences
+                (e.g. the beams of a sentence) instead of repeated
         Returns:
             tuple:
                 - the decoder's output of shape `(batch, tgt_len, vocab)`
@@ -1040,7 +1046,8 @@ class TransformerDecoder(FairseqIncrementalDecoder):
             alignment_heads=alignment_heads,
             # customized for APT
             tgt_src_cursors=tgt_src_cursors,
-            tgt_actnode_masks=tgt_actnode_masks
+            tgt_actnode_masks=tgt_actnode_masks,
+            encoder_out_index=encoder_out_index
         )
         if not features_only:
             x = self.output_layer(
@@ -1060,7 +1067,8 @@ class TransformerDecoder(FairseqIncrementalDecoder):
         alignment_heads: Optional[int] = None,
         # customized for APT
         tgt_src_cursors=None,
-        tgt_actnode_masks=None
+        tgt_actnode_masks=None,
+        encoder_out_index=None
     ):
         return self.extract_features_scriptable(
             prev_output_tokens,
@@ -1071,7 +1079,8 @@ class TransformerDecoder(FairseqIncrementalDecoder):
             alignment_heads,
             # customized for APT
             tgt_src_cursors=tgt_src_cursors,
-            tgt_actnode_masks=tgt_actnode_masks
+            tgt_actnode_masks=tgt_actnode_masks,
+            encoder_out_index=encoder_out_index
         )
 
     """
@@ -1090,7 +1099,8 @@ class TransformerDecoder(FairseqIncrementalDecoder):
         alignment_heads: Optional[int] = None,
         # customized for APT
         tgt_src_cursors=None,
-        tgt_actnode_masks=None
+        tgt_actnode_masks=None,
+        encoder_out_index=None
     ):
         """
         Similar to *forward* but only return features.
@@ -1111,6 +1121,13 @@ class TransformerDecoder(FairseqIncrementalDecoder):
         if alignment_layer is None:
             alignment_layer = self.num_layers - 1
 
+        # source padding mask of each decoded sequence
+        encoder_padding_mask = encoder_out.encoder_padding_mask if encoder_out is not None else None
+        if encoder_out_index is not None and encoder_padding_mask is not None:
+            encoder_padding_mask = encoder_padding_mask.index_select(0, encoder_out_index)
+        # grouping of the sequences sharing the encoder output, built once for all the layers
+        shared_kv_index = SharedKVIndex.from_index(encoder_out_index) if encoder_out_index is not None else None
+
         # embed positions
         positions = (
             self.embed_positions(
@@ -1133,13 +1150,9 @@ class TransformerDecoder(FairseqIncrementalDecoder):
 
             # use the compositional embedding for PRED node actions
             if self.args.bart_emb_composition_pred:
+                # at inference both are computed once and reused across steps and batches
                 self.composite_embed.update_embeddings()
-
-                embedding_weight_mixed = torch.zeros_like(self.embed_tokens.weight)
-                embedding_weight_mixed[self.composite_embed.dict_pred_mask] = self.composite_embed.embedding_weight[
-                    self.composite_embed.dict_pred_mask]
-                embedding_weight_mixed[~self.composite_embed.dict_pred_mask] = self.embed_tokens.weight[
-                    ~self.composite_embed.dict_pred_mask]
+                embedding_weight_mixed = self.composite_embed.mix_weight(self.embed_tokens.weight)
 
                 x = self.embed_scale * nn.functional.embedding(prev_output_tokens,
                                                                embedding_weight_mixed,
@@ -1170,8 +1183,8 @@ class TransformerDecoder(FairseqIncrementalDecoder):
             # 2) align the source embeddings to the tgt input actions
             assert tgt_src_cursors is not None
             tgt_src_index = tgt_src_cursors.clone()    # size (bsz, tgt_max_len)
-            if encoder_out.encoder_padding_mask is not None:
-                src_num_pads = encoder_out.encoder_padding_mask.sum(dim=1, keepdim=True)
+            if encoder_padding_mask is not None:
+                src_num_pads = encoder_padding_mask.sum(dim=1, keepdim=True)
                 tgt_src_index = tgt_src_index + src_num_pads    # NOTE this is key to left padding!
 
             # NOTE due to padding value is 1, the indexes could be out of range of src_max_len ->
@@ -1179,10 +1192,6 @@ class TransformerDecoder(FairseqIncrementalDecoder):
             #      and when the src sentence has max length 1)
             tgt_src_index[tgt_src_index >= src_embs.size(1)] = src_embs.size(1) - 1
 
-            tgt_src_index = tgt_src_index.unsqueeze(-1).repeat(1, 1, src_embs.size(-1))
-            # or
-            # tgt_src_index = tgt_src_index.unsqueeze(-1).expand(-1, -1, src_embs.size(-1))
-
             # # NOTE deal with the corner case when the max_src_len in the whole batch is only 1 ->
             # #      already dealt with above!
             # if encoder_out.encoder_out.size(0) == 1:
@@ -1190,7 +1199,15 @@ class TransformerDecoder(FairseqIncrementalDecoder):
             #     #      (the default padding value is 1, which would cause an index out of range error hard to debug)
             #     tgt_src_index.fill_(0)
 
-            src_embs = torch.gather(src_embs, 1, tgt_src_index)
+            if encoder_out_index is not None:
+                # source embeddings shared by several decoded sequences: index them directly
+                src_embs = src_embs[encoder_out_index.unsqueeze(1), tgt_src_index]
+            else:
+                tgt_src_index = tgt_src_index.unsqueeze(-1).repeat(1, 1, src_embs.size(-1))
+                # or
+                # tgt_src_index = tgt_src_index.unsqueeze(-1).expand(-1, -1, src_embs.size(-1))
+
+                src_embs = torch.gather(src_embs, 1, tgt_src_index)
             # size (bsz, tgt_max_len, src_embs.size(-1))
 
             # 3) combine the action embeddings with the aligned source token embeddings
@@ -1224,7 +1241,7 @@ class TransformerDecoder(FairseqIncrementalDecoder):
             assert tgt_src_cursors is not None
             cross_attention_mask = get_cross_attention_mask_heads(tgt_src_cursors,
                                                                   encoder_out.encoder_out.size(0),
-                                                                  encoder_out.encoder_padding_mask,
+                                                                  encoder_padding_mask,
                                                                   self.args.tgt_src_align_focus,
                                                                   self.args.tgt_src_align_heads,
                                                                   self.layers[0].encoder_attn.num_heads)
@@ -1267,6 +1284,7 @@ class TransformerDecoder(FairseqIncrementalDecoder):
                 cross_attention_mask=(cross_attention_mask
                                       if idx in self.args.tgt_src_align_layers
                                       else None),
+                encoder_out_index=shared_kv_index
             )
             inner_states.append(x)
             if layer_attn is not None and idx == alignment_layer:
@@ -1339,25 +1357,49 @@ class TransformerDecoder(FairseqIncrementalDecoder):
 
             # use the composite embeddings
             if not self.args.bart_emb_decoder:
-                # separate embeddings
-                out = self.output_projection(features)    # original output_projection has a different output size
-
                 # use the compositional embedding for PRED node actions
                 if self.args.bart_emb_composition_pred:
-                    out_comp = nn.functional.linear(features, self.composite_embed.embedding_weight)
-                    out[:, :, self.composite_embed.dict_pred_mask] = out_comp[:, :, self.composite_embed.dict_pred_mask]
+                    # output projection with the PRED rows replaced, in a single product
+                    weight = self.composite_embed.mix_weight(self.output_projection.weight)
+                else:
+                    # separate embeddings
+                    weight = self.output_projection.weight    # original output_projection has a different output size
             else:
                 # compositional embeddings based on BART embeddings
-                out = nn.functional.linear(features, self.composite_embed.embedding_weight)
+                weight = self.composite_embed.embedding_weight
 
             if self.args.apply_tgt_vocab_masks:
                 assert tgt_vocab_masks is not None
-                out[tgt_vocab_masks == 0] = float('-inf')
-            return out
+                return self.project_allowed_actions(features, weight, tgt_vocab_masks)
+            return nn.functional.linear(features, weight)
         else:
             assert not self.args.apply_tgt_vocab_masks
             return features
 
+    def project_allowed_actions(self, features, weight, tgt_vocab_masks):
+        """Project features to the vocabulary size, with -inf logits for the actions not allowed by the target
+        vocabulary masks.
+
+        When decoding, only a few actions are allowed at each step by the state machine (SHIFT, some arcs, the nodes
+        that can be copied), so the product is done only with the output embeddings of the actions allowed for any of
+        the hypotheses. The allowed logits, and thus the normalized scores, are the same as with the full product.
+
+        Args:
+            features (torch.Tensor): decoder output features, size (batch_size, tgt_len, embed_dim)
+            weight (torch.Tensor): output embeddings, size (vocab_size, embed_dim)
+            tgt_vocab_masks (torch.Tensor): allowed actions, size (batch_size, tgt_len, vocab_size)
+        """
+        allowed = tgt_vocab_masks != 0
+        indices = allowed.reshape(-1, allowed.size(-1)).any(dim=0).nonzero(as_tuple=True)[0]
+        # with teacher forcing most of the vocabulary is allowed at some step
+        if self.training or 2 * indices.numel() > weight.size(0):
+            out = nn.functional.linear(features, weight)
+        else:
+            out = features.new_full(features.shape[:-1] + weight.shape[:1], float('-inf'))
+            out[..., indices] = nn.functional.linear(features, weight.index_select(0, indices))
+        out[~allowed] = float('-inf')
+        return out
+
     def max_positions(self):
         """Maximum output length supported by the decoder."""
         if self.embed_positions is None:
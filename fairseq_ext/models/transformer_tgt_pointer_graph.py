@@ -31,7 +31,7 @@ from torch_scatter import scatter_mean
 
 from ..modules.transformer_layer import TransformerEncoderLayer, TransformerDecoderLayer
 from .attention_masks import get_cross_attention_mask, get_cross_attention_mask_heads
-from .graph_attention_masks import get_graph_self_attn_mask
+from .graph_attention_masks import get_graph_self_attn_mask, get_graph_self_attn_mask_last_step
 
 
 DEFAULT_MAX_SOURCE_POSITIONS = 1024
@@ -585,14 +585,16 @@ class TransformerDecoder(FairseqIncrementalDecoder):
         """
         # breakpoint()
 
-        graph_self_attn_mask = get_graph_self_attn_mask(tgt_actedge_masks=tgt_actedge_masks,
-                                                        tgt_actedge_cur_nodes=tgt_actedge_cur_nodes,
-                                                        tgt_actedge_pre_nodes=tgt_actedge_pre_nodes,
-                                                        tgt_actedge_directions=tgt_actedge_directions,
-                                                        tgt_actnode_masks_shift=tgt_actnode_masks_shift,
-                                                        mask_num_heads=self.args.tgt_graph_heads,
-                                                        num_heads=self.layers[0].self_attn.num_heads,
-                                                        tgt_graph_mask=self.args.tgt_graph_mask)
+        # incremental decoding only needs the mask row of the newest position
+        get_mask = get_graph_self_attn_mask if incremental_state is None else get_graph_self_attn_mask_last_step
+        graph_self_attn_mask = get_mask(tgt_actedge_masks=tgt_actedge_masks,
+                                        tgt_actedge_cur_nodes=tgt_actedge_cur_nodes,
+                                        tgt_actedge_pre_nodes=tgt_actedge_pre_nodes,
+                                        tgt_actedge_directions=tgt_actedge_directions,
+                                        tgt_actnode_masks_shift=tgt_actnode_masks_shift,
+                                        mask_num_heads=self.args.tgt_graph_heads,
+                                        num_heads=self.layers[0].self_attn.num_heads,
+                                        tgt_graph_mask=self.args.tgt_graph_mask)
 
         x, extra = self.extract_features(
             prev_output_tokens,
@@ -648,7 +650,7 @@ class TransformerDecoder(FairseqIncrementalDecoder):
             memory_pos = memory_pos[:, :, -1:] if memory_pos is not None else None
             # graph structure mask on the decoder self-attention: take out the last row of (tgt_len, tgt_len)
             # for only one step
-            if graph_self_attn_mask is not None:
+            if graph_self_attn_mask is not None and graph_self_attn_mask[0].size(1) > 1:
                 graph_self_attn_mask = (graph_self_attn_mask[0][:, -1, :].unsqueeze(1),
                                         graph_self_attn_mask[1][:, -1].unsqueeze(1))
 
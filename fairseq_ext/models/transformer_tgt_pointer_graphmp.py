@@ -31,7 +31,7 @@ from torch_scatter import scatter_mean
 
 from ..modules.transformer_layer import TransformerEncoderLayer, TransformerDecoderLayer
 from .attention_masks import get_cross_attention_mask, get_cross_attention_mask_heads
-from .graphmp_attention_masks import get_graph_self_attn_mask
+from .graphmp_attention_masks import get_graph_self_attn_mask, get_graph_self_attn_mask_last_step
 
 
 DEFAULT_MAX_SOURCE_POSITIONS = 1024
@@ -601,7 +601,9 @@ class TransformerDecoder(FairseqIncrementalDecoder):
         """
         # breakpoint()
 
-        graph_self_attn_mask = get_graph_self_attn_mask(
+        # incremental decoding only needs the mask row of the newest position
+        get_mask = get_graph_self_attn_mask if incremental_state is None else get_graph_self_attn_mask_last_step
+        graph_self_attn_mask = get_mask(
             tgt_actedge_masks=tgt_actedge_masks,
             tgt_actedge_1stnode_masks=tgt_actedge_1stnode_masks,
             tgt_actedge_indexes=tgt_actedge_indexes,
@@ -673,7 +675,7 @@ class TransformerDecoder(FairseqIncrementalDecoder):
             memory_pos = memory_pos[:, :, -1:] if memory_pos is not None else None
             # graph structure mask on the decoder self-attention: take out the last row of (tgt_len, tgt_len)
             # for only one step
-            if graph_self_attn_mask is not None:
+            if graph_self_attn_mask is not None and graph_self_attn_mask[0].size(1) > 1:
                 graph_self_attn_mask = (graph_self_attn_mask[0][:, -1, :].unsqueeze(1),
                                         graph_self_attn_mask[1][:, -1].unsqueeze(1))
 
@@ -4,7 +4,7 @@
 # LICENSE file in the root directory of this source tree.
 
 import math
-from typing import Dict, Optional, Tuple
+from typing import Dict, NamedTuple, Optional, Tuple
 
 import torch
 import torch.nn.functional as F
@@ -16,6 +16,34 @@ from torch import Tensor, nn
 from torch.nn import Parameter
 
 
+class SharedKVIndex(NamedTuple):
+    """Batch index in the shared keys and values of each query, grouped for `MultiheadAttention._bmm_shared()`.
+
+    The consecutive queries with the same index (e.g. the beams of a sentence) form a group. Built once with
+    `from_index()`, e.g. at each decoding step, and used by all the layers.
+    """
+    index: Tensor                   # batch index in the keys of each query, size (bsz,)
+    group: Tensor                   # group of each query, size (bsz,)
+    slot: Tensor                    # position of each query in its group, size (bsz,)
+    num_groups: int
+    group_size: int                 # size of the largest group
+    group_index: Optional[Tensor]   # batch index in the keys of each group, None if it is range(num_groups)
+
+    @classmethod
+    def from_index(cls, index: Tensor) -> 'SharedKVIndex':
+        bsz = index.size(0)
+        is_start = torch.ones_like(index, dtype=torch.bool)
+        is_start[1:] = index[1:] != index[:-1]
+        starts = is_start.nonzero().squeeze(1)
+        group = torch.cumsum(is_start.long(), dim=0) - 1
+        slot = torch.arange(bsz, device=index.device) - starts[group]
+        num_groups = starts.size(0)
+        group_index = index[starts]
+        if torch.equal(group_index, torch.arange(num_groups, device=index.device)):
+            group_index = None
+        return cls(index, group, slot, num_groups, int(slot.max()) + 1, group_index)
+
+
 @with_incremental_state
 class MultiheadAttention(nn.Module):
     """Multi-headed attention.
@@ -138,7 +166,8 @@ class MultiheadAttention(nn.Module):
         # customized for masking
         cross_attention_mask=None,
         ptr_self_attn_mask=None,
-        graph_self_attn_mask=None
+        graph_self_attn_mask=None,
+        kv_index: Optional[SharedKVIndex] = None
     ) -> Tuple[Tensor, Optional[Tensor]]:
         """Input shape: Time x Batch x Channel
         Args:
@@ -155,6 +184,11 @@ class MultiheadAttention(nn.Module):
             need_head_weights (bool, optional): return the attention
                 weights for each head. Implies *need_weights*. Default:
                 return the average attention weights over all heads.
+            kv_index (SharedKVIndex, optional): for encoder-decoder attention,
+                the batch index in *key* and *value* (and in
+                *key_padding_mask*) of each query, so that the keys and
+                values are computed and cached only once for all the queries
+                sharing them, e.g. the beams of the same sentence.
         """
         if need_head_weights:
             need_weights = True
@@ -168,6 +202,7 @@ class MultiheadAttention(nn.Module):
             and not self.tpu  # don't use PyTorch version on TPUs
             and incremental_state is None
             and not static_kv
+            and kv_index is None
             # A workaround for quantization to work. Otherwise JIT compilation
             # treats bias in linear module as method.
             and not torch.jit.is_scripting()
@@ -198,7 +233,12 @@ class MultiheadAttention(nn.Module):
             )
 
         if incremental_state is not None:
-            saved_state = self._get_input_buffer(incremental_state)
+            if kv_index is None:
+                saved_state = self._get_input_buffer(incremental_state)
+            else:
+                # shared keys and values are never reordered
+                assert self.encoder_decoder_attention and static_kv
+                saved_state = self._get_shared_input_buffer(incremental_state)
             if saved_state is not None and "prev_key" in saved_state:
                 # previous time steps are cached - no need to recompute
                 # key and value if they are static
@@ -208,6 +248,15 @@ class MultiheadAttention(nn.Module):
         else:
             saved_state = None
 
+        # batch size of the keys and values
+        kv_bsz = bsz
+        if kv_index is not None:
+            if key is not None:
+                kv_bsz = key.size(1)
+            else:
+                assert saved_state is not None
+                kv_bsz = saved_state["prev_key"].size(0)
+
         if self.self_attention:
             q = self.q_proj(query)
             k = self.k_proj(query)
@@ -231,8 +280,8 @@ class MultiheadAttention(nn.Module):
 
         if self.bias_k is not None:
             assert self.bias_v is not None
-            k = torch.cat([k, self.bias_k.repeat(1, bsz, 1)])
-            v = torch.cat([v, self.bias_v.repeat(1, bsz, 1)])
+            k = torch.cat([k, self.bias_k.repeat(1, kv_bsz, 1)])
+            v = torch.cat([v, self.bias_v.repeat(1, kv_bsz, 1)])
             if attn_mask is not None:
                 attn_mask = torch.cat(
                     [attn_mask, attn_mask.new_zeros(attn_mask.size(0), 1)], dim=1
@@ -270,13 +319,13 @@ class MultiheadAttention(nn.Module):
         if k is not None:
             k = (
                 k.contiguous()
-                .view(-1, bsz * self.num_heads, self.head_dim)
+                .view(-1, kv_bsz * self.num_heads, self.head_dim)
                 .transpose(0, 1)
             )
         if v is not None:
             v = (
                 v.contiguous()
-                .view(-1, bsz * self.num_heads, self.head_dim)
+                .view(-1, kv_bsz * self.num_heads, self.head_dim)
                 .transpose(0, 1)
             )
 
@@ -285,7 +334,7 @@ class MultiheadAttention(nn.Module):
             if "prev_key" in saved_state:
                 _prev_key = saved_state["prev_key"]
                 assert _prev_key is not None
-                prev_key = _prev_key.view(bsz * self.num_heads, -1, self.head_dim)
+                prev_key = _prev_key.view(kv_bsz * self.num_heads, -1, self.head_dim)
                 if static_kv:
                     k = prev_key
                 else:
@@ -294,7 +343,7 @@ class MultiheadAttention(nn.Module):
             if "prev_value" in saved_state:
                 _prev_value = saved_state["prev_value"]
                 assert _prev_value is not None
-                prev_value = _prev_value.view(bsz * self.num_heads, -1, self.head_dim)
+                prev_value = _prev_value.view(kv_bsz * self.num_heads, -1, self.head_dim)
                 if static_kv:
                     v = prev_value
                 else:
@@ -307,17 +356,20 @@ class MultiheadAttention(nn.Module):
             key_padding_mask = MultiheadAttention._append_prev_key_padding_mask(
                 key_padding_mask=key_padding_mask,
                 prev_key_padding_mask=prev_key_padding_mask,
-                batch_size=bsz,
+                batch_size=kv_bsz,
                 src_len=k.size(1),
                 static_kv=static_kv,
             )
 
-            saved_state["prev_key"] = k.view(bsz, self.num_heads, -1, self.head_dim)
-            saved_state["prev_value"] = v.view(bsz, self.num_heads, -1, self.head_dim)
+            saved_state["prev_key"] = k.view(kv_bsz, self.num_heads, -1, self.head_dim)
+            saved_state["prev_value"] = v.view(kv_bsz, self.num_heads, -1, self.head_dim)
             saved_state["prev_key_padding_mask"] = key_padding_mask
             # In this branch incremental_state is never None
             assert incremental_state is not None
-            incremental_state = self._set_input_buffer(incremental_state, saved_state)
+            if kv_index is None:
+                incremental_state = self._set_input_buffer(incremental_state, saved_state)
+            else:
+                incremental_state = self._set_shared_input_buffer(incremental_state, saved_state)
         assert k is not None
         src_len = k.size(1)
 
@@ -327,7 +379,7 @@ class MultiheadAttention(nn.Module):
             key_padding_mask = None
 
         if key_padding_mask is not None:
-            assert key_padding_mask.size(0) == bsz
+            assert key_padding_mask.size(0) == kv_bsz
             assert key_padding_mask.size(1) == src_len
 
         if self.add_zero_attn:
@@ -355,7 +407,12 @@ class MultiheadAttention(nn.Module):
         # k              (batch_size * num_heads, source_size, target_emb_size / num_heads)
         # ->
         # attn_weights   (batch_size * num_heads, target_size, source_size)
-        attn_weights = torch.bmm(q, k.transpose(1, 2))
+        if kv_index is None:
+            attn_weights = torch.bmm(q, k.transpose(1, 2))
+        else:
+            attn_weights = self._bmm_shared(q, k.transpose(1, 2), kv_index, self.num_heads)
+            if key_padding_mask is not None:
+                key_padding_mask = key_padding_mask.index_select(0, kv_index.index)
 
         # mask out cross attention
         if cross_attention_mask is not None:
@@ -438,7 +495,10 @@ class MultiheadAttention(nn.Module):
         # if cross_attention_mask is not None:
         #     breakpoint()
         assert v is not None
-        attn = torch.bmm(attn_probs, v)
+        if kv_index is None:
+            attn = torch.bmm(attn_probs, v)
+        else:
+            attn = self._bmm_shared(attn_probs, v, kv_index, self.num_heads)
         assert list(attn.size()) == [bsz * self.num_heads, tgt_len, self.head_dim]
         if self.onnx_trace and attn.size(1) == 1:
             # when ONNX tracing a single decoder step (sequence length == 1)
@@ -462,6 +522,37 @@ class MultiheadAttention(nn.Module):
 
         return attn, attn_weights
 
+    @staticmethod
+    def _bmm_shared(x: Tensor, y: Tensor, kv_index: SharedKVIndex, num_heads: int) -> Tensor:
+        """Batched matrix product of x, of shape `(bsz * num_heads, n, m)`, with the rows of y, of shape
+        `(kv_bsz * num_heads, m, p)`, given by kv_index, without copying y for every row of x.
+
+        The rows of x of each group of kv_index are stacked along the dimension n, and multiplied at once with their
+        row of y.
+        """
+        bsz = kv_index.index.size(0)
+        num_groups = kv_index.num_groups
+        group_size = kv_index.group_size
+        group, slot = kv_index.group, kv_index.slot
+
+        # only the rows of y that are used, e.g. once some sentences are finished
+        y = y.view(-1, num_heads, y.size(1), y.size(2))
+        if kv_index.group_index is None:
+            y = y[:num_groups]
+        else:
+            y = y.index_select(0, kv_index.group_index)
+
+        # size (num_groups, num_heads, group_size * n, m), padded with zeros for smaller groups
+        x = x.view(bsz, num_heads, x.size(1), x.size(2))
+        n = x.size(2)
+        grid = x.new_zeros(num_groups, group_size, num_heads, n, x.size(3))
+        grid[group, slot] = x
+        grid = grid.transpose(1, 2).reshape(num_groups, num_heads, group_size * n, x.size(3))
+
+        out = torch.matmul(grid, y)
+        out = out.view(num_groups, num_heads, group_size, n, -1).transpose(1, 2)[group, slot]
+        return out.reshape(bsz * num_heads, n, -1)
+
     @staticmethod
     def _append_prev_key_padding_mask(
         key_padding_mask: Optional[Tensor],
@@ -537,6 +628,24 @@ class MultiheadAttention(nn.Module):
     ):
         return self.set_incremental_state(incremental_state, "attn_state", buffer)
 
+    def _get_shared_input_buffer(
+        self, incremental_state: Optional[Dict[str, Dict[str, Optional[Tensor]]]]
+    ) -> Dict[str, Optional[Tensor]]:
+        # keys and values shared through `kv_index`, which are not reordered with the queries
+        result = self.get_incremental_state(incremental_state, "shared_attn_state")
+        if result is not None:
+            return result
+        else:
+            empty_result: Dict[str, Optional[Tensor]] = {}
+            return empty_result
+
+    def _set_shared_input_buffer(
+        self,
+        incremental_state: Dict[str, Dict[str, Optional[Tensor]]],
+        buffer: Dict[str, Optional[Tensor]],
+    ):
+        return self.set_incremental_state(incremental_state, "shared_attn_state", buffer)
+
     def apply_sparse_mask(self, attn_weights, tgt_len: int, src_len: int, bsz: int):
         return attn_weights
 
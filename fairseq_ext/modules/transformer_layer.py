@@ -14,7 +14,7 @@ from fairseq.modules.fairseq_dropout import FairseqDropout
 from fairseq.modules.quant_noise import quant_noise
 from torch import Tensor
 
-from .multihead_attention import MultiheadAttention
+from .multihead_attention import MultiheadAttention, SharedKVIndex
 
 
 class TransformerEncoderLayer(nn.Module):
@@ -288,7 +288,8 @@ class TransformerDecoderLayer(nn.Module):
         # customized to control attention
         cross_attention_mask=None,
         ptr_self_attn_mask=None,
-        graph_self_attn_mask=None
+        graph_self_attn_mask=None,
+        encoder_out_index: Optional[SharedKVIndex] = None
     ):
         """
         Args:
@@ -296,6 +297,10 @@ class TransformerDecoderLayer(nn.Module):
             encoder_padding_mask (ByteTensor, optional): binary
                 ByteTensor of shape `(batch, src_len)` where padding
                 elements are indicated by ``1``.
+            encoder_out_index (SharedKVIndex, optional): batch index in
+                *encoder_out* of each element of *x*, when the encoder output
+                is shared, e.g. by the beams of the same sentence; built once
+                for all the layers.
             need_attn (bool, optional): return attention weights
             need_head_weights (bool, optional): return attention weights
                 for each head (default: return average over heads).
@@ -339,6 +344,7 @@ class TransformerDecoderLayer(nn.Module):
                     (encoder_padding_mask, self_attn_padding_mask), dim=1
                 )
             assert encoder_out is not None
+            assert encoder_out_index is None, 'shared encoder output is not supported with cross self attention'
             y = torch.cat((encoder_out, x), dim=0)
         else:
             y = x
@@ -385,7 +391,8 @@ class TransformerDecoderLayer(nn.Module):
                 need_weights=need_attn or (not self.training and self.need_attn),
                 need_head_weights=need_head_weights,
                 # customized
-                cross_attention_mask=cross_attention_mask
+                cross_attention_mask=cross_attention_mask,
+                kv_index=encoder_out_index
             )
             x = self.dropout_module(x)
             x = self.residual_connection(x, residual)
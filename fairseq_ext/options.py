@@ -266,6 +266,9 @@ def add_preprocess_args(parser):
     # NOTE: Previous default "17 18 19 20 21 22 23 24"
     group.add_argument('--bert-layers', nargs='+', type=int,
                        help='RoBERTa layers to extract (default last)')
+    group.add_argument('--embed-batch-size', default=1, type=int,
+                       help='number of sentences of similar length per forward pass when extracting pretrained '
+                            'embeddings (BART encodings are parallelized over --workers instead)')
 
     # for stack-transformer
     add_state_machine_args(group)
@@ -544,6 +547,9 @@ def add_generation_args(parser):
                        help='whether to use predicate statistics rules from training oracle to restrict PRED actions')
     group.add_argument('--clean-arcs', type=int, default=0,
                        help='whether to clean the pointer arcs by removing self-loops and multi-edges')
+    group.add_argument('--adaptive-max-len', type=int, default=0,
+                       help='whether to bound the number of actions of each sentence by its own length, growing the '
+                            'decoding buffers on demand (only for graph models)')
     return group
 
 
@@ -2,6 +2,9 @@ import numpy as np
 import torch
 import shutil
 import time
+import queue
+import threading
+from itertools import islice
 
 from ..data import indexed_dataset
 from ..utils import time_since
@@ -34,6 +37,75 @@ def get_scatter_indices(word2piece, reverse=False):
     return torch.tensor(wp_indices)
 
 
+def read_sentences(input_file, tokenize):
+    with open(input_file, 'r') as fid:
+        for sentence in fid:
+            # we only have tokenized data so we feed whitespace separated
+            # tokens
+            yield " ".join(tokenize(str(sentence).rstrip()))
+
+
+class _PrefetchError:
+    """Exception raised while reading in the background thread, to be re-raised by the consumer"""
+    def __init__(self, exception):
+        self.exception = exception
+
+
+def prefetch(iterable, size=1024):
+    """Iterate in a background thread, to overlap reading with extraction
+
+    An exception raised while reading is raised again in the consumer, so that a failed read is never taken for the
+    end of the input.
+    """
+    items = queue.Queue(maxsize=size)
+    end = object()
+
+    def produce():
+        try:
+            for item in iterable:
+                items.put(item)
+        except BaseException as exception:
+            items.put(_PrefetchError(exception))
+        else:
+            items.put(end)
+
+    threading.Thread(target=produce, daemon=True).start()
+    while True:
+        item = items.get()
+        if item is end:
+            break
+        if isinstance(item, _PrefetchError):
+            raise item.exception
+        yield item
+
+
+def iter_extracted(pretrained_embeddings, sentences, batch_size=1, chunk_batches=10):
+    """Extract embeddings in batches of sentences of similar length
+
+    Sentences are read in chunks of batch_size * chunk_batches and sorted by length inside each chunk. Results are
+    yielded in input order as (sentence, output of pretrained_embeddings.extract(sentence))
+    """
+    if batch_size == 1 or not hasattr(pretrained_embeddings, 'extract_list'):
+        for sentence in sentences:
+            yield sentence, pretrained_embeddings.extract(sentence)
+        return
+
+    sentences = iter(sentences)
+    while True:
+        chunk = list(islice(sentences, batch_size * chunk_batches))
+        if not chunk:
+            break
+        order = sorted(range(len(chunk)), key=lambda index: len(chunk[index].split()))
+        results = [None] * len(chunk)
+        for start in range(0, len(order), batch_size):
+            batch_indices = order[start:start + batch_size]
+            batch_results = pretrained_embeddings.extract_list([chunk[index] for index in batch_indices])
+            for index, result in zip(batch_indices, batch_results):
+                results[index] = result
+        # back to input order
+        yield from zip(chunk, results)
+
+
 def make_binary_bert_features(args, input_prefix, output_prefix, tokenize):
 
     # Load pretrained embeddings extractor
@@ -65,45 +137,41 @@ def make_binary_bert_features(args, input_prefix, output_prefix, tokenize):
     indexed_wordpieces = indexed_dataset.make_builder(
         dataset_dest_file(args, output_prefix, 'en.wordpieces', "bin"),
         impl=args.dataset_impl,
+        dtype=np.int64
     )
 
     indexed_wp2w = indexed_dataset.make_builder(
         dataset_dest_file(args, output_prefix, 'en.wp2w', "bin"),
         impl=args.dataset_impl,
+        dtype=np.int64
     )
 
     num_sents = 0
     input_file = input_prefix + '.en'
 
     start = time.time()
-    with open(input_file, 'r') as fid:
-        for sentence in fid:
+    # extract embeddings, average them per token and return wordpieces
+    # anyway; batched by length, while the next sentences are read
+    sentences = prefetch(read_sentences(input_file, tokenize))
+    for sentence, (word_features, worpieces_roberta, word2piece) in \
+            iter_extracted(pretrained_embeddings, sentences, getattr(args, 'embed_batch_size', 1)):
+
+        # note that data needs to be stored as a 1d array. Also check
+        # that number nof woprds matches with embedding size
+        assert word_features.shape[1] == len(sentence.split())
+        indexed_data.add_item(word_features.cpu().view(-1))
+
+        # just store the wordpiece indices, ignore BOS/EOS tokens
+        indexed_wordpieces.add_item(worpieces_roberta)
+        indexed_wp2w.add_item(
+            get_scatter_indices(word2piece, reverse=True)
+        )
 
-            # we only have tokenized data so we feed whitespace separated
-            # tokens
-            sentence = " ".join(tokenize(str(sentence).rstrip()))
-
-            # extract embeddings, average them per token and return
-            # wordpieces anyway
-            word_features, worpieces_roberta, word2piece = \
-                pretrained_embeddings.extract(sentence)
-
-            # note that data needs to be stored as a 1d array. Also check
-            # that number nof woprds matches with embedding size
-            assert word_features.shape[1] == len(sentence.split())
-            indexed_data.add_item(word_features.cpu().view(-1))
-
-            # just store the wordpiece indices, ignore BOS/EOS tokens
-            indexed_wordpieces.add_item(worpieces_roberta)
-            indexed_wp2w.add_item(
-                get_scatter_indices(word2piece, reverse=True)
-            )
-
-            # udpate number of sents
-            num_sents += 1
-            if not num_sents % 100:
-                print("\r%d sentences (time: %s)" % (num_sents, time_since(start)), end='')
-        print("")
+        # udpate number of sents
+        num_sents += 1
+        if not num_sents % 100:
+            print("\r%d sentences (time: %s)" % (num_sents, time_since(start)), end='')
+    print("")
 
     # close indexed data files
     indexed_data.finalize(
@@ -0,0 +1,166 @@
+"""Cache of extracted pretrained embeddings, keyed by sentence and extraction configuration.
+
+Entries are kept in an in-memory LRU and, optionally, in a directory on disk with one folder of `.npy` files per entry,
+that are memory mapped when read, so that repeated sentences (boilerplate, headlines, retries) skip the RoBERTa forward
+pass across calls and processes.
+"""
+import hashlib
+import os
+import shutil
+from collections import OrderedDict
+
+import numpy as np
+import torch
+
+
+# fields of an entry, as returned by PretrainedEmbeddings.extract_batch() for each sentence
+FIELDS = ['word_features', 'wordpieces_roberta', 'word2piece_scattered_indices']
+
+
+def get_entry_bytes(entry):
+    return sum(tensor.numel() * tensor.element_size() for tensor in entry)
+
+
+def get_checkpoint_id(checkpoint):
+    """Path, size and modification time of a checkpoint file, to tell apart checkpoints of the same model name in the
+    cache keys without reading them"""
+    stat = os.stat(checkpoint)
+    return f'{os.path.abspath(checkpoint)} {stat.st_size} {stat.st_mtime_ns}'
+
+
+def get_dir_bytes(path):
+    try:
+        return sum(entry.stat().st_size for entry in os.scandir(path) if entry.is_file())
+    except FileNotFoundError:
+        # removed by another process
+        return 0
+
+
+class EmbeddingCache:
+    """In-memory LRU cache of embeddings, optionally backed by memory mapped files on disk.
+
+    Entries read from disk are not copied to the in-memory LRU, their tensors are backed by the memory maps of the
+    files; the disk entries are removed whole, so the memory maps of a removed entry remain valid.
+
+    Args:
+        cache_dir (str, optional): folder to store the entries on disk, one folder of `.npy` files each; None for
+            in-memory only.
+        max_memory_bytes (int): size limit of the in-memory LRU, in bytes of tensor data.
+        max_disk_bytes (int, optional): size limit of the disk cache, least recently used entries are removed first;
+            None for no limit.
+    """
+
+    def __init__(self, cache_dir=None, max_memory_bytes=2**30, max_disk_bytes=None):
+        self.cache_dir = cache_dir
+        self.max_memory_bytes = max_memory_bytes
+        self.max_disk_bytes = max_disk_bytes
+
+        self.memory = OrderedDict()    # key -> tuple of tensors, least recently used first
+        self.memory_bytes = 0
+
+        self.disk_bytes = 0
+        if cache_dir is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+            self.disk_bytes = sum(get_dir_bytes(entry.path) for entry in self.get_disk_entries())
+
+        # statistics
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.bytes_saved = 0
+
+    @staticmethod
+    def get_key(config, sentence):
+        """Key of a sentence for a given extraction configuration (model name, layers, `get_checkpoint_id()`)"""
+        return hashlib.sha1(f'{config}\t{sentence}'.encode('utf-8')).hexdigest()
+
+    def get_path(self, key):
+        return os.path.join(self.cache_dir, key)
+
+    def get_disk_entries(self):
+        # NOTE: folders being written by other processes end in .tmp
+        return [entry for entry in os.scandir(self.cache_dir) if entry.is_dir() and not entry.name.endswith('.tmp')]
+
+    def get(self, key):
+        """Get the entry (word_features, wordpieces_roberta, word2piece_scattered_indices) or None"""
+        if key in self.memory:
+            self.memory.move_to_end(key)
+            entry = self.memory[key]
+            self.memory_hits += 1
+            self.bytes_saved += get_entry_bytes(entry)
+            return entry
+
+        if self.cache_dir is not None:
+            path = self.get_path(key)
+            try:
+                entry = tuple(
+                    torch.from_numpy(np.load(os.path.join(path, f'{field}.npy'), mmap_mode='r')) for field in FIELDS
+                )
+                # mark as recently used for disk eviction
+                os.utime(path)
+            except FileNotFoundError:
+                # not cached, or evicted by another process
+                entry = None
+            if entry is not None:
+                self.disk_hits += 1
+                self.bytes_saved += get_entry_bytes(entry)
+                return entry
+
+        self.misses += 1
+        return None
+
+    def put(self, key, entry):
+        """Store an entry (word_features, wordpieces_roberta, word2piece_scattered_indices)"""
+        entry = tuple(tensor.detach().cpu() for tensor in entry)
+        self.put_memory(key, entry)
+        if self.cache_dir is not None:
+            self.put_disk(key, entry)
+
+    def put_memory(self, key, entry):
+        if key in self.memory:
+            return
+        self.memory[key] = entry
+        self.memory_bytes += get_entry_bytes(entry)
+        while self.memory_bytes > self.max_memory_bytes and self.memory:
+            _, evicted = self.memory.popitem(last=False)
+            self.memory_bytes -= get_entry_bytes(evicted)
+
+    def put_disk(self, key, entry):
+        # write to a temporary folder and rename it, so that other processes never read partial entries
+        path = self.get_path(key)
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        os.makedirs(tmp_path, exist_ok=True)
+        for field, tensor in zip(FIELDS, entry):
+            np.save(os.path.join(tmp_path, f'{field}.npy'), tensor.numpy())
+        size = get_dir_bytes(tmp_path)
+        try:
+            os.rename(tmp_path, path)
+            self.disk_bytes += size
+        except OSError:
+            # already written by another process
+            shutil.rmtree(tmp_path, ignore_errors=True)
+        if self.max_disk_bytes is not None and self.disk_bytes > self.max_disk_bytes:
+            self.evict_disk()
+
+    def evict_disk(self):
+        # remove least recently used entries until under 90% of the limit, to not do this at every write
+        entries = sorted(self.get_disk_entries(), key=lambda entry: entry.stat().st_mtime)
+        sizes = [get_dir_bytes(entry.path) for entry in entries]
+        self.disk_bytes = sum(sizes)
+        for entry, size in zip(entries, sizes):
+            if self.disk_bytes <= 0.9 * self.max_disk_bytes:
+                break
+            # the whole entry; also if removed by another process
+            shutil.rmtree(entry.path, ignore_errors=True)
+            self.disk_bytes -= size
+
+    @property
+    def hit_rate(self):
+        total = self.memory_hits + self.disk_hits + self.misses
+        return (self.memory_hits + self.disk_hits) / total if total else 0.
+
+    def report(self):
+        total = self.memory_hits + self.disk_hits + self.misses
+        return (f'embedding cache: {self.memory_hits + self.disk_hits}/{total} hits ({100 * self.hit_rate:.1f} %, '
+                f'{self.memory_hits} memory, {self.disk_hits} disk), {self.bytes_saved / 2**20:.1f} MB saved, '
+                f'{self.memory_bytes / 2**20:.1f} MB in memory, {self.disk_bytes / 2**20:.1f} MB on disk')
@@ -3,31 +3,69 @@ import copy
 import torch
 
 from ..data.data_utils import collate_tokens
+from .embedding_cache import FIELDS, get_checkpoint_id
 from ..utils_font import yellow_font
 
 
 def get_average_embeddings(final_layer, word2piece):
+    """Average wordpiece representations to get word representations.
 
-    # Average worpiece representations to get word representations
+    Args:
+        final_layer (torch.Tensor): wordpiece features of one sentence, size (1, num_wordpieces, hidden_size)
+        word2piece (List[List[int]]): wordpiece indices of each word
+
+    Returns:
+        torch.Tensor: word features, size (1, num_words, hidden_size)
+    """
+    batch_dim = final_layer.shape[0]
+    assert batch_dim == 1, "batch_size must be 1, see get_average_embeddings_batched"
     num_words = len(word2piece)
-    batch_dim, num_wordpieces, hidden_size = final_layer.shape
-    assert batch_dim == 1, "batch_size must be 1"
-    if num_words < num_wordpieces:
-        word_features = torch.zeros(
-            (1, num_words, hidden_size)
-        ).to(final_layer.device)
-        for word_idx, wordpiece_idx in enumerate(word2piece):
-            # column of features for all involved worpieces
-            column = final_layer[0:1, wordpiece_idx, :]
-            if isinstance(wordpiece_idx, list):
-                column = column.mean(1, keepdim=True)
-            word_features[0:1, word_idx, :] = column
+    if num_words < final_layer.shape[1]:
+        word_features = get_average_embeddings_batched(final_layer, [word2piece])
     else:
         word_features = final_layer
 
     return word_features
 
 
+def get_average_embeddings_batched(final_layer, word2piece_batch):
+    """Average wordpiece representations to get word representations, for a padded batch of sentences in one
+    scatter operation.
+
+    Args:
+        final_layer (torch.Tensor): wordpiece features, size (batch_size, num_wordpieces, hidden_size)
+        word2piece_batch (List[List[List[int]]]): for each sentence, wordpiece indices of each word; wordpieces not
+            in any word (e.g. padding) are ignored
+
+    Returns:
+        torch.Tensor: word features, size (batch_size, max_num_words, hidden_size), zeros for padding words
+    """
+    batch_size, num_wordpieces, hidden_size = final_layer.shape
+    max_num_words = max(len(word2piece) for word2piece in word2piece_batch)
+
+    # word index of each wordpiece, with the extra index max_num_words for the ones not in any word
+    spans = [span if isinstance(span, list) else [span] for word2piece in word2piece_batch for span in word2piece]
+    span_lengths = torch.tensor([len(span) for span in spans])
+    num_words = torch.tensor([len(word2piece) for word2piece in word2piece_batch])
+    # sentence and word index of each word, repeated for each of its wordpieces
+    sent_index = torch.repeat_interleave(torch.arange(batch_size), num_words)
+    word_index = torch.arange(len(spans)) - torch.repeat_interleave(num_words.cumsum(0) - num_words, num_words)
+    wordpiece_index = torch.tensor([wp_idx for span in spans for wp_idx in span], dtype=torch.long)
+    scatter_index = torch.full((batch_size, num_wordpieces), max_num_words, dtype=torch.long)
+    scatter_index[sent_index.repeat_interleave(span_lengths), wordpiece_index] = \
+        word_index.repeat_interleave(span_lengths)
+    scatter_index = scatter_index.to(final_layer.device)
+
+    # scatter mean
+    word_features = final_layer.new_zeros((batch_size, max_num_words + 1, hidden_size))
+    word_features.scatter_add_(1, scatter_index.unsqueeze(2).expand(-1, -1, hidden_size), final_layer)
+    counts = final_layer.new_zeros((batch_size, max_num_words + 1))
+    counts.scatter_add_(1, scatter_index, final_layer.new_ones((batch_size, num_wordpieces)))
+    word_features = word_features / counts.clamp(min=1).unsqueeze(2)
+
+    return word_features[:, :max_num_words]
+
+
 def get_wordpiece_to_word_map(sentence, roberta_bpe):
 
     # Get word and wordpiece tokens according to GPT2BPE (used by RoBERTa/BART)
@@ -49,25 +87,37 @@ def get_wordpiece_to_word_map(sentence, roberta_bpe):
     # assert isinstance(wordpiece_tokens, list)
     # assert len(wordpiece_tokens) == len(wordpiece_bpe_ids)
 
+    # NOTE we match utf8 bytes rather than decoding the growing wordpiece sequence at each step, which is quadratic
+    #      on long words. Each wordpiece is converted to bytes once, as `roberta_bpe.bpe.decode()` does
+    bpe = roberta_bpe.bpe
+
     w_index = 0
     word_to_wordpiece = []    # List[List[int]]
     subword_sequence = []
-    bpe_id_sequence = []
+    bytes_from_pieces = bytearray()
+    word = None
 
     for wp_index, bpe_id in enumerate(wordpiece_bpe_ids):
-        word = word_tokens[w_index]
-        # only the initial word doesn't need whitespace at the beginning to be matched
-        if w_index > 0:
-            word = ' ' + word
+        if word is None:
+            word = word_tokens[w_index]
+            # only the initial word doesn't need whitespace at the beginning to be matched
+            if w_index > 0:
+                word = ' ' + word
+            word_bytes = word.encode('utf-8')
 
         subword_sequence.append(wp_index)
-        bpe_id_sequence.append(bpe_id)
-        word_from_pieces = roberta_bpe.bpe.decode(bpe_id_sequence)    # this recovers any original characters
-        if word == word_from_pieces:
+        bytes_from_pieces.extend(bpe.byte_decoder[c] for c in bpe.decoder.get(bpe_id, bpe_id))
+        # this recovers any original characters
+        if (
+            bytes_from_pieces == word_bytes
+            # decoding replaces invalid bytes, only then can different bytes decode to the word
+            or ('\ufffd' in word and word == bytes_from_pieces.decode('utf-8', errors=bpe.errors))
+        ):
             word_to_wordpiece.append(subword_sequence)
             w_index += 1
             subword_sequence = []
-            bpe_id_sequence = []
+            bytes_from_pieces = bytearray()
+            word = None
 
     assert len(word_tokens) == len(word_to_wordpiece), 'word_to_wordpiece must be of the same size of the word_tokens'
     assert word_to_wordpiece[0][0] == 0 and word_to_wordpiece[-1][-1] == len(wordpiece_bpe_ids) - 1, \
@@ -102,12 +152,14 @@ def get_scatter_indices(word2piece, reverse=False):
 
 class PretrainedEmbeddings():
 
-    def __init__(self, name, bert_layers, model=None):
+    def __init__(self, name, bert_layers, model=None, cache=None, checkpoint=None):
 
         # embedding type name
         self.name = name
         # select some layers for averaging
         self.bert_layers = bert_layers
+        # optional EmbeddingCache of extract_batch() results
+        self.cache = cache
 
         if model is None:
             if name in ['roberta.base', 'roberta.large']:
@@ -128,6 +180,13 @@ class PretrainedEmbeddings():
         else:
             self.roberta = model
 
+        # extraction configuration in the cache keys; checkpoint is the file of a model not loaded from torch hub by
+        # name, told apart from other checkpoints by path, size and modification time
+        if cache is not None:
+            self.cache_config = f'{name} {bert_layers}'
+            if checkpoint is not None:
+                self.cache_config += f' {get_checkpoint_id(checkpoint)}'
+
     def extract_features(self, worpieces):
         """Extract features from wordpieces"""
 
@@ -205,14 +264,8 @@ class PretrainedEmbeddings():
         # FIXME: this should not bee needed using roberta.eval()
         last_layer = last_layer.detach()
 
-        # Ignore start and end symbols
-        last_layer = last_layer[0:1, 1:-1, :]
-
-        # average over wordpieces of same word
-        word_features = get_average_embeddings(
-            last_layer,
-            word2piece
-        )
+        # Ignore start and end symbols, average over wordpieces of same word
+        word_features = self.postprocess_features(last_layer, word2piece)
 
 #        # sanity check differentiable and non differentiable averaging
 #        match
@@ -227,7 +280,60 @@ class PretrainedEmbeddings():
 
         return word_features, worpieces_roberta, word2piece
 
+    def postprocess_features(self, last_layer, word2piece):
+        """From the features of the wordpieces of a sentence, BOS/EOS included, to the word features returned by
+        extract()"""
+        # Ignore start and end symbols
+        last_layer = last_layer[0:1, 1:-1, :]
+
+        # average over wordpieces of same word
+        return get_average_embeddings(last_layer, word2piece)
+
+    def extract_list(self, sentence_string_batch):
+        """Batched extract(): same outputs for each sentence in a list, with one forward pass for all of them.
+
+        Sentences are padded to the longest one, so the list should contain sentences of similar lengths. Sentences
+        above the max number of positions of RoBERTa go through extract().
+        """
+        word2pieces = [get_wordpiece_to_word_map(sentence, self.roberta.bpe) for sentence in sentence_string_batch]
+        wordpieces = [self.roberta.encode(sentence) for sentence in sentence_string_batch]
+
+        results = [None] * len(sentence_string_batch)
+        fit_indices = [index for index, worpieces_roberta in enumerate(wordpieces) if len(worpieces_roberta) <= 512]
+        if fit_indices:
+            src_wordpieces_collated = collate_tokens([wordpieces[index] for index in fit_indices], pad_idx=1)
+            batch_features = self.extract_features(src_wordpieces_collated.to(self.roberta.device)).detach()
+            for i, index in enumerate(fit_indices):
+                last_layer = batch_features[i:i + 1, :len(wordpieces[index])]
+                word_features = self.postprocess_features(last_layer, word2pieces[index])
+                results[index] = (word_features, wordpieces[index], word2pieces[index])
+
+        for index, result in enumerate(results):
+            if result is None:
+                results[index] = self.extract(sentence_string_batch[index])
+
+        return results
+
     def extract_batch(self, sentence_string_batch):
+        if self.cache is None:
+            return self.extract_batch_nocache(sentence_string_batch)
+
+        # look up the cache, extract only the missing sentences
+        keys = [self.cache.get_key(self.cache_config, sentence) for sentence in sentence_string_batch]
+        entries = [self.cache.get(key) for key in keys]
+        missing = [index for index, entry in enumerate(entries) if entry is None]
+        if missing:
+            new_data = self.extract_batch_nocache([sentence_string_batch[index] for index in missing])
+            for i, index in enumerate(missing):
+                entries[index] = tuple(new_data[field][i] for field in FIELDS)
+                self.cache.put(keys[index], entries[index])
+
+        bert_data = {}
+        for j, field in enumerate(FIELDS):
+            bert_data[field] = [entry[j] for entry in entries]
+        return bert_data
+
+    def extract_batch_nocache(self, sentence_string_batch):
         bert_data = {}
         bert_data["word_features"] = []
         bert_data["wordpieces_roberta"] = []
@@ -243,13 +349,15 @@ class PretrainedEmbeddings():
 
         src_wordpieces_collated = collate_tokens(src_wordpieces, pad_idx=1)
         roberta_batch_features = self.extract_features(src_wordpieces_collated)
-        roberta_batch_features = roberta_batch_features.detach().cpu()
-        for index,(word2piece, wordpieces_roberta) in enumerate(zip(src_word2piece, src_wordpieces)):
-            roberta_features = roberta_batch_features[index]
-            roberta_features = roberta_features[1:len(wordpieces_roberta)-1]
-            word_features = get_average_embeddings(roberta_features.unsqueeze(0), word2piece)
+        roberta_batch_features = roberta_batch_features.detach()
+        # average over wordpieces of same word, for the whole batch
+        # NOTE: remove BOS, word2piece indices do not consider it. EOS and
+        # padding are not in any word and are ignored
+        batch_word_features = get_average_embeddings_batched(roberta_batch_features[:, 1:], src_word2piece).cpu()
+        for index, (word2piece, wordpieces_roberta) in enumerate(zip(src_word2piece, src_wordpieces)):
+            word_features = batch_word_features[index, :len(word2piece)].clone()
             word2piece_scattered_indices = get_scatter_indices(word2piece, reverse=True)
-            bert_data["word_features"].append(word_features[0])
+            bert_data["word_features"].append(word_features)
             bert_data["wordpieces_roberta"].append(wordpieces_roberta)
             bert_data["word2piece_scattered_indices"].append(word2piece_scattered_indices)
 
@@ -5,8 +5,8 @@
 # the root directory of this source tree. An additional grant of patent rights
 # can be found in the PATENTS file in the same directory.
 
+import inspect
 import math
-from copy import deepcopy
 import json
 import os
 
@@ -17,7 +17,8 @@ from fairseq import search, utils
 from fairseq.models import FairseqIncrementalDecoder
 
 from transition_amr_parser.amr_machine import AMRStateMachine
-from fairseq_ext.utils import join_action_pointer
+from fairseq_ext.utils import join_action_pointer, reorder_state_machines
+from fairseq_ext.amr_spec.batched_state_machine import BatchedAMRStateMachine
 
 
 BOOL_TENSOR_TYPE = torch.bool if version.parse(torch.__version__) >= version.parse('1.2.0') else torch.uint8
@@ -190,7 +191,12 @@ class SequenceGenerator(object):
         new_order = torch.arange(bsz).view(-1, 1).repeat(1, beam_size).view(-1)
         new_order = new_order.to(src_tokens.device).long()
         # "new_order": [0, 0, 0, 1, 1, 1, 2, 2, 2, 3, 3, 3, 4, 4, 4] if bsz is 5 and beam_size is 3
-        encoder_outs = model.reorder_encoder_out(encoder_outs, new_order)
+        if model.shares_encoder_out:
+            # the encoder outputs are kept once per sentence, and the decoder is given the sentence of each beam
+            encoder_out_index = new_order
+        else:
+            encoder_out_index = None
+            encoder_outs = model.reorder_encoder_out(encoder_outs, new_order)
 
         # initialize buffers
         scores = src_tokens.new(bsz * beam_size, max_len + 1).float().fill_(0)
@@ -230,9 +236,15 @@ class SequenceGenerator(object):
                 amr_state_machines.append(sm)
 
             canonical_act_ids = amr_state_machines[0].canonical_action_to_dict(self.tgt_dict)
+
+            # valid action masks for all beams at once; the machines above are still needed for the action-to-node
+            # masks and to build the graph
+            batched_state_machine = BatchedAMRStateMachine(amr_state_machines[0], self.tgt_dict)
+            batched_state_machine.reset(src_lengths.new([len(sample['src_sents'][i]) for i in new_order]))
         else:
             amr_state_machines = None
             canonical_act_ids = None
+            batched_state_machine = None
 
         # setup for modify the arc action scores based on pointer scores
         if modify_arcact_score:
@@ -459,7 +471,10 @@ class SequenceGenerator(object):
 
                 # reorder/reduce the states
                 model.reorder_incremental_state(reorder_state)
-                encoder_outs = model.reorder_encoder_out(encoder_outs, reorder_state)
+                if encoder_out_index is not None:
+                    encoder_out_index = encoder_out_index.index_select(0, reorder_state)
+                else:
+                    encoder_outs = model.reorder_encoder_out(encoder_outs, reorder_state)
 
                 # get the new index mapping from full bsz * beam_size to valid size for next step reordering
                 if valid_bbsz_mask.all():
@@ -486,32 +501,37 @@ class SequenceGenerator(object):
             # ==========> bug: self.tgt_dict is somehow changed with an additional token '<<unk>>' at the end
 
             if amr_state_machines is not None:
-                for i, j in enumerate(valid_bbsz_idx):
-                    sm = amr_state_machines[j]
-                    act_allowed = sm.get_valid_actions()
-                    # use predicate rules to further restrict the action space for PRED actions
-                    pred_allowed = None
-                    if use_pred_rules:
-                        assert self.pred_rules is not None
-                        # TODO update below (currently not used)
-                        #      we use "NODE" keyword instead of "PRED"
-                        if 'PRED' in act_allowed:
-                            src_token = sm.get_current_token()
-                            if src_token in self.pred_rules:
-                                act_allowed.remove('PRED')
-                                pred_allowed = list(self.pred_rules[src_token].keys())
-
-                    vocab_ids_allowed = set().union(*[set(canonical_act_ids[act]) for act in act_allowed])
-
-                    # TODO update below
-                    # use predicate rules to further restrict the action space for PRED actions
-                    if pred_allowed is not None:
-                        pred_ids_allowed = set(self.tgt_dict.index(f'PRED({sym})') for sym in pred_allowed)
-                        vocab_ids_allowed = vocab_ids_allowed.union(pred_ids_allowed)
-
-                    allowed_mask[i, list(vocab_ids_allowed)] = 1
-
-                    tok_cursors[i] = sm.tok_cursor
+                if not use_pred_rules:
+                    # all beams at once with tensor operations
+                    allowed_mask = batched_state_machine.get_valid_actions_mask()[valid_bbsz_mask]
+                    tok_cursors = batched_state_machine.tok_cursors[valid_bbsz_mask]
+                else:
+                    for i, j in enumerate(valid_bbsz_idx):
+                        sm = amr_state_machines[j]
+                        act_allowed = sm.get_valid_actions()
+                        # use predicate rules to further restrict the action space for PRED actions
+                        pred_allowed = None
+                        if use_pred_rules:
+                            assert self.pred_rules is not None
+                            # TODO update below (currently not used)
+                            #      we use "NODE" keyword instead of "PRED"
+                            if 'PRED' in act_allowed:
+                                src_token = sm.get_current_token()
+                                if src_token in self.pred_rules:
+                                    act_allowed.remove('PRED')
+                                    pred_allowed = list(self.pred_rules[src_token].keys())
+
+                        vocab_ids_allowed = set().union(*[set(canonical_act_ids[act]) for act in act_allowed])
+
+                        # TODO update below
+                        # use predicate rules to further restrict the action space for PRED actions
+                        if pred_allowed is not None:
+                            pred_ids_allowed = set(self.tgt_dict.index(f'PRED({sym})') for sym in pred_allowed)
+                            vocab_ids_allowed = vocab_ids_allowed.union(pred_ids_allowed)
+
+                        allowed_mask[i, list(vocab_ids_allowed)] = 1
+
+                        tok_cursors[i] = sm.tok_cursor
 
                 # NOTE blocking <unk> separately is needed when `use_pred_rules` is True, as the possible predicates
                 #      generated by training oracle are not fully contained in the dictionary
@@ -531,6 +551,8 @@ class SequenceGenerator(object):
 
             actions_states = {'tgt_vocab_masks': allowed_mask.unsqueeze(1),
                               'tgt_src_cursors': tok_cursors.unsqueeze(1)}
+            if encoder_out_index is not None:
+                actions_states['encoder_out_index'] = encoder_out_index
 
             # lprobs, avg_attn_scores = model.forward_decoder(
             #     tokens[:, :step + 1], encoder_outs, temperature=self.temperature,
@@ -856,6 +878,9 @@ class SequenceGenerator(object):
                     batch_idxs_list = batch_idxs.tolist()
                     amr_state_machines = [sm for i, sm in enumerate(amr_state_machines)
                                           if i // beam_size in batch_idxs_list]
+                    batched_state_machine.reorder(
+                        (batch_idxs.unsqueeze(1) * beam_size + torch.arange(beam_size).to(batch_idxs)).view(-1)
+                    )
 
                 if tgt_pointers is not None:
                     tgt_pointers = tgt_pointers.view(bsz, -1)[batch_idxs].view(new_bsz * beam_size, -1)
@@ -943,8 +968,8 @@ class SequenceGenerator(object):
             if amr_state_machines is not None:
                 if step > 0:
                     # NOTE here must use copy since there could be same ids from active_bbsz_idx
-                    # (from the same last beam)
-                    amr_state_machines = [deepcopy(amr_state_machines[i]) for i in active_bbsz_idx]
+                    # (from the same last beam); only the repeated ones are copied
+                    amr_state_machines = reorder_state_machines(amr_state_machines, active_bbsz_idx.tolist())
 
                 # add and apply new action tokens to state machine
                 for i, (sm, act_id, act_pos, is_valid) in enumerate(zip(amr_state_machines,
@@ -960,6 +985,9 @@ class SequenceGenerator(object):
                     sm.update(join_action_pointer(act, act_pos.item()))
                     # sm.update(act)
 
+                batched_state_machine.reorder(active_bbsz_idx)
+                batched_state_machine.update(tokens_buf[:, step + 1], valid_bbsz_mask)
+
             # ============================================================
 
             if step > 0:
@@ -1015,6 +1043,12 @@ class EnsembleModel(torch.nn.Module):
         self.incremental_states = None
         if all(isinstance(m.decoder, FairseqIncrementalDecoder) for m in models):
             self.incremental_states = {m: {} for m in models}
+        # whether the decoders can attend to encoder outputs shared by the beams of a sentence, instead of copies
+        self.shares_encoder_out = (
+            self.incremental_states is not None
+            and self.has_encoder()
+            and all('encoder_out_index' in inspect.signature(m.decoder.forward).parameters for m in models)
+        )
 
     def has_encoder(self):
         return hasattr(self.models[0], 'encoder')
@@ -6,7 +6,6 @@
 # can be found in the PATENTS file in the same directory.
 
 import math
-from copy import deepcopy
 import json
 
 import torch
@@ -16,10 +15,15 @@ from fairseq import search, utils
 from fairseq.models import FairseqIncrementalDecoder
 
 from transition_amr_parser.action_pointer.o8_state_machine import AMRStateMachine
+from fairseq_ext.utils import reorder_state_machines
 
 
 BOOL_TENSOR_TYPE = torch.bool if version.parse(torch.__version__) >= version.parse('1.2.0') else torch.uint8
 
+# bound on the number of actions per source token, to set the maximum length of the action sequences
+# (the max ratio for train, dev and test is around 3)
+MAX_ACTIONS_PER_TOKEN = 4
+
 
 class SequenceGenerator(object):
     def __init__(
@@ -132,6 +136,7 @@ class SequenceGenerator(object):
         run_amr_sm=True,
         modify_arcact_score=True,
         use_pred_rules=False,
+        adaptive_max_len=False,
         **kwargs
     ):
         """Generate a batch of translations.
@@ -142,6 +147,8 @@ class SequenceGenerator(object):
             prefix_tokens (torch.LongTensor, optional): force decoder to begin
                 with these tokens
             run_amr_sm (bool): whether to run AMR state machine to restrict the next allowable actions.
+            adaptive_max_len (bool): whether to bound the number of actions of each sentence by its own number of
+                source tokens, instead of by the padded source length of the batch, and grow the buffers on demand.
         """
         model = EnsembleModel(models)
         if not self.retain_dropout:
@@ -162,19 +169,32 @@ class SequenceGenerator(object):
         src_len = input_size[1]
         beam_size = self.beam_size
 
+        # maximum length of each sentence, for adaptive max_len
+        max_lens = None
         if self.match_source_len:
             max_len = src_lengths.max().item()
+        elif adaptive_max_len:
+            # the state machine has to shift through all the tokens of a sentence, with at most
+            # MAX_ACTIONS_PER_TOKEN actions for each on average
+            max_lens = (src_lengths * MAX_ACTIONS_PER_TOKEN).clamp(max=model.max_decoder_positions() - 1)
+            max_len = max_lens.max().item()
         else:
             # max_len = min(
             #     int(self.max_len_a * src_len + self.max_len_b),
             #     # exclude the EOS marker
             #     model.max_decoder_positions() - 1,    # model.max_decoder_positions() is 1024 by default
             # )
-            max_len = min(src_len * 4,    # the max ratio for train, dev and test is around 3
+            max_len = min(src_len * MAX_ACTIONS_PER_TOKEN,
                           # exclude the EOS marker
                           model.max_decoder_positions() - 1)
             # model.max_decoder_positions() is 1024 by default; it also limits the max of model's positional embeddings
 
+        # length of the buffers below; with adaptive max_len, they are grown when needed
+        if max_lens is not None:
+            buf_len = min(max_len, 2 * src_lengths.max().item())
+        else:
+            buf_len = max_len
+
         # compute the encoder output for each beam
         encoder_outs = model.forward_encoder(encoder_input)
         new_order = torch.arange(bsz).view(-1, 1).repeat(1, beam_size).view(-1)
@@ -183,9 +203,9 @@ class SequenceGenerator(object):
         encoder_outs = model.reorder_encoder_out(encoder_outs, new_order)
 
         # initialize buffers
-        scores = src_tokens.new(bsz * beam_size, max_len + 1).float().fill_(0)
+        scores = src_tokens.new(bsz * beam_size, buf_len + 1).float().fill_(0)
         scores_buf = scores.clone()
-        tokens = src_tokens.data.new(bsz * beam_size, max_len + 2).long().fill_(self.pad)
+        tokens = src_tokens.data.new(bsz * beam_size, buf_len + 2).long().fill_(self.pad)
         tokens_buf = tokens.clone()
         tokens[:, 0] = bos_token or self.eos
         attn, attn_buf = None, None
@@ -246,6 +266,12 @@ class SequenceGenerator(object):
                 buffers[name] = type_of.new()
             return buffers[name]
 
+        def grow(buf, length, fill_value):
+            """Copy of a buffer with the last dimension extended to the given length"""
+            new_buf = buf.new_full(buf.size()[:-1] + (length,), fill_value)
+            new_buf[..., :buf.size(-1)] = buf
+            return new_buf
+
         def is_finished(sent, step, unfin_idx, unfinalized_scores=None):
             """
             Check whether we've finished generation for a given sentence, by
@@ -377,6 +403,8 @@ class SequenceGenerator(object):
                     return {
                         'tokens': tokens_clone[i],
                         'score': score,
+                        # ended at the adaptive max_len before the state machine allowed EOS
+                        'truncated': truncated_mask is not None and bool(truncated_mask[idx]),
                         'attention': hypo_attn,  # src_len x tgt_len
                         'alignment': alignment,
                         'positional_scores': pos_scores[i],
@@ -412,6 +440,8 @@ class SequenceGenerator(object):
             return newly_finished
 
         reorder_state = None
+        # hypotheses forced to end at this step with adaptive max_len while EOS was not allowed, size (bsz * beam_size,)
+        truncated_mask = None
         batch_idxs = None
         # mask for valid beams after search selection: size (bsz * beam_size, )
         # valid_bbsz_mask = tokens.new_ones(bsz * beam_size, dtype=torch.uint8)
@@ -421,6 +451,17 @@ class SequenceGenerator(object):
         # index mapping from full bsz * beam_size vector to the valid-only vector with reduced size
         bbsz_to_valid_idxs = None
         for step in range(max_len + 1):  # one extra step for EOS marker
+            # grow the buffers by doubling their length, before the step reaches it
+            if step >= buf_len and buf_len < max_len:
+                buf_len = min(2 * buf_len, max_len)
+                scores, scores_buf = grow(scores, buf_len + 1, 0), grow(scores_buf, buf_len + 1, 0)
+                tokens, tokens_buf = grow(tokens, buf_len + 2, self.pad), grow(tokens_buf, buf_len + 2, self.pad)
+                if attn is not None:
+                    attn, attn_buf = grow(attn, buf_len + 2, 0), grow(attn_buf, buf_len + 2, 0)
+                if tgt_pointers is not None:
+                    tgt_pointers = grow(tgt_pointers, buf_len + 2, -1)
+                    scores_tgt_pointers = grow(scores_tgt_pointers, buf_len + 1, 0)
+
             # reorder decoder internal states based on the prev choice of beams
             if reorder_state is not None:
                 # this is equivalent to "if step >= 1" since "reorder_state" will never be None after the 0-th step
@@ -562,7 +603,7 @@ class SequenceGenerator(object):
             # Record attention scores
             if avg_attn_scores is not None:
                 if attn is None:
-                    attn = scores.new(bsz * beam_size, src_tokens.size(1), max_len + 2)
+                    attn = scores.new(bsz * beam_size, src_tokens.size(1), tokens.size(1))
                     attn_buf = attn.clone()
                     nonpad_idxs = src_tokens.ne(self.pad)
                 if valid_bbsz_num == bsz * beam_size:
@@ -590,7 +631,7 @@ class SequenceGenerator(object):
             if tgt_pointers is None:
                 tgt_pointers = torch.zeros_like(tokens).fill_(-1)
             if scores_tgt_pointers is None:
-                scores_tgt_pointers = scores.new(bsz * beam_size, max_len + 1).fill_(0)
+                scores_tgt_pointers = scores.new(bsz * beam_size, scores.size(1)).fill_(0)
 
             # 1) get a mask for valid previous actions that can generate nodes
             # mask for (previous + current) actions (generated tgt tokens) that are corresponding to AMR nodes
@@ -680,6 +721,28 @@ class SequenceGenerator(object):
 
             # ====================================================
 
+            # ========== adaptive max_len: end the sentences that reached their own maximum length ==========
+            # only EOS is allowed for their valid hypotheses, so that they are all finalized at this step and the
+            # sentences are removed from the batch; as when reaching max_len, EOS is scored by the model, and the
+            # hypotheses whose EOS is not allowed by the state machine yet are truncated: they end with a 0 log prob,
+            # to be finalized at all, and are ranked below all the complete hypotheses of their sentence
+            truncated_mask = None
+            if max_lens is not None and step < max_len:
+                at_max_len = max_lens.le(step)    # size (bsz,)
+                if at_max_len.any():
+                    import warnings
+                    warnings.warn(f'max step reached for {at_max_len.sum().item()} sentences with adaptive max_len; '
+                                  'the hypotheses that can not end yet are truncated.')
+
+                    forced_mask = at_max_len.unsqueeze(1).repeat(1, beam_size).view(-1) & valid_bbsz_mask
+                    eos_lprobs = lprobs[forced_mask, self.eos]
+                    truncated_mask = torch.zeros_like(forced_mask)
+                    truncated_mask[forced_mask] = eos_lprobs == -math.inf
+                    lprobs[forced_mask] = -math.inf
+                    lprobs[forced_mask, self.eos] = eos_lprobs.masked_fill(eos_lprobs == -math.inf, 0)
+
+            # ====================================================
+
             scores = scores.type_as(lprobs)
             scores_buf = scores_buf.type_as(lprobs)
             eos_bbsz_idx = buffer('eos_bbsz_idx')
@@ -834,6 +897,8 @@ class SequenceGenerator(object):
                     prefix_tokens = prefix_tokens[batch_idxs]
                     partial_prefix_mask_buf = partial_prefix_mask_buf[batch_idxs]
                 src_lengths = src_lengths[batch_idxs]
+                if max_lens is not None:
+                    max_lens = max_lens[batch_idxs]
 
                 scores = scores.view(bsz, -1)[batch_idxs].view(new_bsz * beam_size, -1)
                 scores_buf.resize_as_(scores)
@@ -948,8 +1013,8 @@ class SequenceGenerator(object):
             if amr_state_machines is not None:
                 if step > 0:
                     # NOTE here must use copy since there could be same ids from active_bbsz_idx
-                    # (from the same last beam)
-                    amr_state_machines = [deepcopy(amr_state_machines[i]) for i in active_bbsz_idx]
+                    # (from the same last beam); only the repeated ones are copied
+                    amr_state_machines = reorder_state_machines(amr_state_machines, active_bbsz_idx.tolist())
 
                 # add and apply new action tokens to state machine
                 for i, (sm, act_id, act_pos, is_valid) in enumerate(zip(amr_state_machines,
@@ -1006,9 +1071,9 @@ class SequenceGenerator(object):
             # reorder incremental state in decoder
             reorder_state = active_bbsz_idx
 
-        # sort by score descending
+        # sort by score descending, truncated hypotheses last
         for sent in range(len(finalized)):
-            finalized[sent] = sorted(finalized[sent], key=lambda r: r['score'], reverse=True)
+            finalized[sent] = sorted(finalized[sent], key=lambda r: (not r['truncated'], r['score']), reverse=True)
 
         return finalized
 
@@ -6,7 +6,6 @@
 # can be found in the PATENTS file in the same directory.
 
 import math
-from copy import deepcopy
 import json
 
 import torch
@@ -17,6 +16,7 @@ from fairseq.models import FairseqIncrementalDecoder
 
 from transition_amr_parser.action_pointer.o8_state_machine import AMRStateMachine
 from transition_amr_parser.action_pointer.o8_state_machine_reformer import AMRActionReformer
+from fairseq_ext.utils import reorder_state_machines
 
 
 BOOL_TENSOR_TYPE = torch.bool if version.parse(torch.__version__) >= version.parse('1.2.0') else torch.uint8
@@ -1023,8 +1023,8 @@ class SequenceGenerator(object):
             if amr_state_machines is not None:
                 if step > 0:
                     # NOTE here must use copy since there could be same ids from active_bbsz_idx
-                    # (from the same last beam)
-                    amr_state_machines = [deepcopy(amr_state_machines[i]) for i in active_bbsz_idx]
+                    # (from the same last beam); only the repeated ones are copied
+                    amr_state_machines = reorder_state_machines(amr_state_machines, active_bbsz_idx.tolist())
 
                 # add and apply new action tokens to state machine
                 for i, (sm, act_id, act_pos, is_valid) in enumerate(zip(amr_state_machines,
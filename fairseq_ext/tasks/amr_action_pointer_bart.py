@@ -21,6 +21,7 @@ from fairseq.tasks import FairseqTask, register_task
 from fairseq_ext.data.language_pair_dataset import LanguagePairDataset
 from fairseq_ext.data.amr_action_pointer_dataset import AMRActionPointerDataset
 from fairseq_ext.data.data_utils import load_indexed_dataset
+from fairseq_ext.data.consolidated_dataset import open_consolidated_dataset
 from fairseq_ext.amr_spec.action_info_binarize import (
     ActionStatesBinarizer,
     binarize_actstates_tofile_workers,
@@ -59,6 +60,10 @@ def load_amr_action_pointer_dataset(data_path, emb_dir, split, src, tgt, src_dic
     filename_prefix = os.path.join(data_path, f'{split}.{src}-{tgt}.')
     embfile_prefix = os.path.join(emb_dir, f'{split}.{src}-{tgt}.')
 
+    # all the indexed data files consolidated into a single file (fairseq_ext/consolidate_data.py), if it exists;
+    # the indexed data below are then loaded from it
+    open_consolidated_dataset(filename_prefix + 'fields', [data_path, emb_dir])
+
     # src: en tokens
     with open(embfile_prefix + src, 'r', encoding='utf-8') as f:
         src_tokens = []
@@ -518,7 +523,8 @@ class AMRActionPointerBARTParsingTask(FairseqTask):
             return generator.generate(models, sample, prefix_tokens=prefix_tokens,
                                       run_amr_sm=args.run_amr_sm,
                                       modify_arcact_score=args.modify_arcact_score,
-                                      use_pred_rules=args.use_pred_rules)
+                                      use_pred_rules=args.use_pred_rules,
+                                      adaptive_max_len=args.adaptive_max_len)
 
     def max_positions(self):
         """Return the max sentence length allowed by the task."""
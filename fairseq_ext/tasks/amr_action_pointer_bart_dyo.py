@@ -25,6 +25,7 @@ from fairseq.tasks import FairseqTask, register_task
 from fairseq_ext.data.language_pair_dataset import LanguagePairDataset
 from fairseq_ext.data.amr_action_pointer_goldamr_dataset import AMRActionPointerGoldAMRDataset as AMRActionPointerDataset
 from fairseq_ext.data.data_utils import load_indexed_dataset
+from fairseq_ext.data.consolidated_dataset import open_consolidated_dataset
 from fairseq_ext.amr_spec.action_info_binarize import (
     ActionStatesBinarizer,
     binarize_actstates_tofile_workers,
@@ -34,7 +35,7 @@ from fairseq_ext.binarize import binarize_file
 from transition_amr_parser.io import read_amr
 from transition_amr_parser.amr_machine import AMRStateMachine, AMROracle, peel_pointer
 from fairseq_ext.amr_spec.action_info import get_actions_states
-from fairseq_ext.data.data_utils import collate_tokens
+from fairseq_ext.amr_spec.dynamic_oracle_data import DynamicOracleData
 from fairseq_ext.utils import time_since
 
 
@@ -42,7 +43,7 @@ def load_amr_action_pointer_dataset(data_path, emb_dir, split, src, tgt, src_dic
                                     max_source_positions, max_target_positions, shuffle,
                                     append_eos_to_target,
                                     collate_tgt_states, collate_tgt_states_graph,
-                                    src_fix_emb_use):
+                                    src_fix_emb_use, oracle_data=None):
     src_tokens = None
     src_dataset = None
     src_fixed_embeddings = None
@@ -68,6 +69,10 @@ def load_amr_action_pointer_dataset(data_path, emb_dir, split, src, tgt, src_dic
     filename_prefix = os.path.join(data_path, f'{split}.{src}-{tgt}.')
     embfile_prefix = os.path.join(emb_dir, f'{split}.{src}-{tgt}.')
 
+    # all the indexed data files consolidated into a single file (fairseq_ext/consolidate_data.py), if it exists;
+    # the indexed data below are then loaded from it
+    open_consolidated_dataset(filename_prefix + 'fields', [data_path, emb_dir])
+
     # src: en tokens
     with open(embfile_prefix + src, 'r', encoding='utf-8') as f:
         src_tokens = []
@@ -113,7 +118,7 @@ def load_amr_action_pointer_dataset(data_path, emb_dir, split, src, tgt, src_dic
 
     # gold AMR with alignments (to enable running oracle on the fly)
     aligned_amr_path = os.path.join(data_path, f'{split}.aligned.gold-amr')
-    gold_amrs = read_amr2(aligned_amr_path, ibm_format=True)
+    gold_amrs = read_amr(aligned_amr_path, ibm_format=True)
 
     # build dataset
     dataset = AMRActionPointerDataset(src_tokens=src_tokens,
@@ -142,6 +147,7 @@ def load_amr_action_pointer_dataset(data_path, emb_dir, split, src, tgt, src_dic
                                       tgt_actedge_directions=tgt_actstates.get('tgt_actedge_directions', None),
                                       # gold AMR with alignments (to enable running oracle on the fly)
                                       gold_amrs=gold_amrs,
+                                      oracle_data=oracle_data,
                                       # batching
                                       left_pad_source=True,
                                       left_pad_target=False,
@@ -221,6 +227,9 @@ class AMRActionPointerBARTDyOracleParsingTask(FairseqTask):
                             help='Starting number of updates for the first run of on-the-fly oracle')
         parser.add_argument('--on-the-fly-oracle-run-freq', default=1, type=int,
                             help='Number of updates until next run of on-the-fly oracle')
+        parser.add_argument('--on-the-fly-oracle-prefetch', default=1, type=int,
+                            help='whether to run on-the-fly oracle when collating the training batches, in the '
+                                 'dataloader workers (--num-workers) ahead of the training step')
 
     def __init__(self, args, src_dict=None, tgt_dict=None, bart=None, machine_config_file=None):
         super().__init__(args)
@@ -245,6 +254,11 @@ class AMRActionPointerBARTDyOracleParsingTask(FairseqTask):
         self.canonical_actions = self.machine.base_action_vocabulary
         self.canonical_act_ids = self.machine.canonical_action_to_dict(self.tgt_dict)
 
+        # oracle runs and target data for the batches, also sent to the dataloader workers
+        self.oracle_data = DynamicOracleData(self.tgt_dict, self.machine_config,
+                                             collate_tgt_states=self.args.collate_tgt_states,
+                                             collate_tgt_states_graph=self.args.collate_tgt_states_graph)
+
     @ classmethod
     def setup_task(cls, args, **kwargs):
         """Setup the task (e.g., load dictionaries).
@@ -423,6 +437,13 @@ class AMRActionPointerBARTDyOracleParsingTask(FairseqTask):
         # infer langcode
         src, tgt = self.args.source_lang, self.args.target_lang
 
+        # run the oracle for the training batches in the dataloader workers, prefetching them
+        if (self.args.on_the_fly_oracle and self.args.on_the_fly_oracle_prefetch
+                and split == getattr(self.args, 'train_subset', 'train')):
+            oracle_data = self.oracle_data
+        else:
+            oracle_data = None
+
         self.datasets[split] = load_amr_action_pointer_dataset(
             data_path, self.args.emb_dir, split,
             src, tgt, self.src_dict, self.tgt_dict,
@@ -434,7 +455,8 @@ class AMRActionPointerBARTDyOracleParsingTask(FairseqTask):
             append_eos_to_target=self.args.append_eos_to_target,
             collate_tgt_states=self.args.collate_tgt_states,
             collate_tgt_states_graph=self.args.collate_tgt_states_graph,
-            src_fix_emb_use=self.args.src_fix_emb_use
+            src_fix_emb_use=self.args.src_fix_emb_use,
+            oracle_data=oracle_data
         )
 
     def build_dataset_for_inference(self, src_tokens, src_lengths):
@@ -654,262 +676,16 @@ class AMRActionPointerBARTDyOracleParsingTask(FairseqTask):
 
     def run_oracle_get_data(self, aligned_amr, machine, oracle) -> Tuple[List[str], Dict, Dict]:
         """Run oracle for a gold AMR graph with alignments, get the needed parser states at the same time, and
-        numericalize the data into Tensors finally.
-
-        Args:
-            aligned_amr ([type]): [description]
-            machine ([type]): [description]
-            oracle ([type]): [description]
-
-        Returns:
-            [type]: [description]
-        """
-        # spawn new machine for this sentence
-        machine.reset(aligned_amr.tokens)
-
-        # initialize new oracle for this AMR
-        oracle.reset(aligned_amr)
-
-        # store needed parser states
-        allowed_cano_actions = []
-        token_cursors = []
-        # proceed left to right throughout the sentence generating nodes
-        while not machine.is_closed:
-
-            # get valid actions
-            act_allowed = machine.get_valid_actions(max_1root=True)
-            allowed_cano_actions.append(act_allowed)
-            token_cursors.append(machine.tok_cursor)
-
-            # oracle
-            actions, scores = oracle.get_actions(machine)
-            # most probable
-            action = actions[np.argmax(scores)]
-
-            # if it is node generation, keep track of original id in gold amr
-            if isinstance(action, tuple):
-                action, gold_node_id = action
-                node_id = len(machine.action_history)
-                oracle.node_map[gold_node_id] = node_id
-                oracle.node_reverse_map[node_id] = gold_node_id
-
-            # check if valid
-            assert machine.get_base_action(
-                action) in act_allowed, 'current action not in the allowed space? check the rules.'
-
-            # update machine
-            machine.update(action)
-
-        assert machine.action_history[-1] == 'CLOSE'
-
-        # NOTE we include 'CLOSE' here, which will be removed later for all data in "get_sample_data()"
-        actions = machine.action_history
-        # actions = machine.action_history[:-1]
-
-        # ===== store all needed numerical data for one sentence/amr
-        data_piece = dict()
-
-        # ===== separate action with pointer values
-        line_actions = [peel_pointer(act) for act in actions]
-        actions_nopos, actions_pos = zip(*line_actions)
-
-        # ===== vocab encoded actions (target)
-        tgt_tensor = self.tgt_dict.encode_line(
-            line=[act if act != 'CLOSE' else self.tgt_dict.eos_word for act in actions_nopos],
-            line_tokenizer=lambda x: x,    # already tokenized
-            add_if_not_exist=False,
-            consumer=None,
-            append_eos=False,
-            reverse_order=False
-            ).long()    # NOTE default return type here is torch.int32, conversion to long is needed
-        data_piece['target'] = tgt_tensor
-
-        # ===== target side pointer values
-        data_piece['tgt_pos'] = torch.tensor(actions_pos)
-
-        # ===== parser state information (NOTE CLOSE action at last step is included)
-        # parser state names mapped to sample attribute names
-        names_states2data = {
-            'allowed_cano_actions': 'tgt_vocab_masks',
-            'token_cursors': 'tgt_src_cursors',
-            'actions_nodemask': 'tgt_actnode_masks',
-            'actions_nopos_in': 'tgt_in',
-            'actions_nopos_out': 'target',
-            'actions_pos': 'tgt_pos',
-            }
-        names_data = [v for v in names_states2data.values()]
-
-        actions_nodemask = machine.get_actions_nodemask()
-        assert len(actions_nodemask) == len(actions)
-
-        actions_states = {'allowed_cano_actions': allowed_cano_actions,
-                          'actions_nodemask': actions_nodemask,
-                          'token_cursors': token_cursors}
-
-        # convert state vectors to tensors
-        allowed_cano_actions = actions_states['allowed_cano_actions']
-        del actions_states['allowed_cano_actions']
-        vocab_mask = torch.zeros(len(allowed_cano_actions), len(self.tgt_dict), dtype=torch.uint8)
-        for i, act_allowed in enumerate(allowed_cano_actions):
-            # vocab_ids_allowed = list(set().union(*[set(canonical_act_ids[act]) for act in act_allowed]))
-            # this is a bit faster than above
-            vocab_ids_allowed = list(
-                itertools.chain.from_iterable(
-                    [self.canonical_act_ids[act] for act in act_allowed]
-                )
-            )
-            vocab_mask[i][vocab_ids_allowed] = 1
-        data_piece['tgt_vocab_masks'] = vocab_mask
-
-        for k, v in actions_states.items():
-            data_key = names_states2data[k]
-            if 'mask' in k:
-                data_piece[data_key] = torch.tensor(v, dtype=torch.uint8)
-            elif 'actions_nopos_in' == k:
-                # input sequence
-                data_piece[data_key] = self.tgt_dict.encode_line(
-                    line=[act if act != 'CLOSE' else self.tgt_dict.eos_word for act in v],
-                    line_tokenizer=lambda x: x,    # already tokenized
-                    add_if_not_exist=False,
-                    consumer=None,
-                    append_eos=False,
-                    reverse_order=False
-                ).long()    # NOTE default return type here is torch.int32, conversion to long is needed
-            elif 'actions_nopos_out' == k:
-                # output sequence
-                data_piece[data_key] = self.tgt_dict.encode_line(
-                    line=[act if act != 'CLOSE' else self.tgt_dict.eos_word for act in v],
-                    line_tokenizer=lambda x: x,    # already tokenized
-                    add_if_not_exist=False,
-                    consumer=None,
-                    append_eos=False,
-                    reverse_order=False
-                ).long()    # NOTE default return type here is torch.int32, conversion to long is needed
-            else:
-                data_piece[data_key] = torch.tensor(v)    # int64
-
-        # shift the target input sequence
-        if 'tgt_in' in data_piece:
-            data_piece['tgt_in'][1:] = data_piece['tgt_in'][:-1]
-            data_piece['tgt_in'][0] = self.tgt_dict.eos()
-
-        # remove the last CLOSE in the action states
-        for k, v in data_piece.items():
-            if k in names_data:
-                data_piece[k] = v[:-1]
-
-        return actions, actions_states, data_piece
+        numericalize the data into Tensors finally. See `DynamicOracleData.run_oracle_get_data()`."""
+        return self.oracle_data.run_oracle_get_data(aligned_amr, machine, oracle)
 
     def run_oracle_get_data_batch(self, aligned_amrs) -> Tuple[List[List[str]], List[Dict]]:
-        """Run oracle on the fly and get needed parser states and numerical Tensor data for each batch.
-
-        Args:
-            aligned_amrs ([type]): [description]
-
-        Returns:
-            [type]: [description]
-        """
-        action_sequences = []
-        data_samples = []
-        # for amr in tqdm(aligned_amrs, desc='dynamic_oracle'):
-        for amr in aligned_amrs:
-            # get the action sequence
-            actions, actions_states, data_piece = self.run_oracle_get_data(amr, self.machine, self.oracle)
-            action_sequences.append(actions)
-            # append the numerical data for one sentence/amr
-            data_samples.append(data_piece)
-
-        return action_sequences, data_samples
+        """Run oracle on the fly and get needed parser states and numerical Tensor data for each batch."""
+        return self.oracle_data.run_oracle_get_data_batch(aligned_amrs)
 
     def collate_sample_data(self, data_samples):
-        """Collate a batch of data instances, only for the target related data.
-
-        Args:
-            data_samples (List[Dict]): A list of data examples.
-
-        Returns:
-            [type]: [description]
-        """
-        # ===== default hyper-parameters
-        pad_idx = self.tgt_dict.pad()
-        eos_idx = self.tgt_dict.eos()
-        left_pad_target = False
-        input_feeding = True
-        collate_tgt_states = self.args.collate_tgt_states
-        collate_tgt_states_graph = self.args.collate_tgt_states_graph
-
-        # ===== collate tensors in the batch
-        if len(data_samples) == 0:
-            return {}
-
-        # TODO make the functions outside for better code reuse
-        def merge(key, left_pad=left_pad_target, move_eos_to_beginning=False, pad_idx=pad_idx, eos_idx=eos_idx):
-            return collate_tokens(
-                [s[key] for s in data_samples],
-                pad_idx, eos_idx, left_pad, move_eos_to_beginning,
-            )
-
-        def merge_tgt_pos(key, left_pad=left_pad_target, move_eos_to_beginning=False):
-            return collate_tokens(
-                [s[key] for s in data_samples],
-                -2, eos_idx, left_pad, move_eos_to_beginning,
-            )
-
-        target = merge('target')
-        # # for sanity checks
-        # tgt_lengths = torch.LongTensor([len(s['target']) for s in data_samples])
-        # tgt_num_tokens = tgt_lengths.sum().item()
-        tgt_pos = merge_tgt_pos('tgt_pos')
-
-        if data_samples[0].get('tgt_in', None) is not None:
-            # NOTE we do not shift here, as it is already shifter 1 position to the right in `self.get_sample_data`
-            tgt_in = merge('tgt_in')
-            prev_output_tokens = tgt_in
-
-        elif input_feeding:
-            # we create a shifted version of targets for feeding the
-            # previous output token(s) into the next decoder step
-            prev_output_tokens = merge('target', move_eos_to_beginning=True)
-
-        else:
-            raise ValueError
-
-        # TODO write a function to collate 2-D matrices, similar to the collate_tokens function
-        def merge_tgt_vocab_masks():
-            # default right padding: left_pad_target should be False
-            # TODO organize the code here
-            masks = [s['tgt_vocab_masks'] for s in data_samples]
-            max_len = max([len(m) for m in masks])
-            merged = masks[0].new(len(masks), max_len, masks[0].size(1)).fill_(pad_idx)
-            for i, v in enumerate(masks):
-                merged[i, :v.size(0), :] = v
-            return merged
-
-        if collate_tgt_states:
-            tgt_vocab_masks = merge_tgt_vocab_masks()
-            tgt_actnode_masks = merge('tgt_actnode_masks', pad_idx=0)
-            tgt_src_cursors = merge('tgt_src_cursors')
-        else:
-            tgt_vocab_masks = None
-            tgt_actnode_masks = None
-            tgt_src_cursors = None
-
-        assert not collate_tgt_states_graph, 'currently not supporting collating graph masks in dynamic batch oracle'
-
-        batch_tgt = {
-            'net_input': {
-                # AMR actions states
-                'tgt_vocab_masks': tgt_vocab_masks,
-                'tgt_actnode_masks': tgt_actnode_masks,
-                'tgt_src_cursors': tgt_src_cursors,
-                # target decoder input
-                'prev_output_tokens': prev_output_tokens,
-            },
-            'target': target,
-            'tgt_pos': tgt_pos
-        }
-
-        return batch_tgt
+        """Collate a batch of data instances, only for the target related data."""
+        return self.oracle_data.collate_sample_data(data_samples)
 
     def update_sample(self, sample_tgt, sample):
         """Update the batched sample as a final step, with the combination of dynamically generated target side data
@@ -929,7 +705,7 @@ class AMRActionPointerBARTDyOracleParsingTask(FairseqTask):
 
         # ===== combine with the src data to generate the complete new sample batch
         for k, v in sample.items():
-            if k not in ['target', 'tgt_pos', 'net_input', 'gold_amrs']:
+            if k not in ['target', 'tgt_pos', 'net_input', 'gold_amrs', 'oracle_tgt']:
                 sample_new[k] = v
 
         for k, v in sample['net_input'].items():
@@ -965,15 +741,20 @@ class AMRActionPointerBARTDyOracleParsingTask(FairseqTask):
         # print('time for getting data', time.time() - start)
         # print('time for running oracle and getting data', time.time() - start0)
 
-        # run oracle, extract parser states, convert everything to tensors
-        # start = time.time()
-        action_sequences, data_samples = self.run_oracle_get_data_batch(sample['gold_amrs'])
-        # print('time for running oracle and getting data', time.time() - start)
+        if sample.get('oracle_tgt', None) is not None:
+            # already run by the dataloader workers when collating the batch
+            sample_tgt = sample['oracle_tgt']
+            data_samples = None
+        else:
+            # run oracle, extract parser states, convert everything to tensors
+            # start = time.time()
+            action_sequences, data_samples = self.run_oracle_get_data_batch(sample['gold_amrs'])
+            # print('time for running oracle and getting data', time.time() - start)
 
-        # collate tensors into batch, with paddings
-        # start = time.time()
-        sample_tgt = self.collate_sample_data(data_samples)
-        # print('time for collating', time.time() - start)
+            # collate tensors into batch, with paddings
+            # start = time.time()
+            sample_tgt = self.collate_sample_data(data_samples)
+            # print('time for collating', time.time() - start)
 
         # get the new complete batch, move to device
         # start = time.time()
@@ -1083,7 +864,8 @@ class AMRActionPointerBARTDyOracleParsingTask(FairseqTask):
             return generator.generate(models, sample, prefix_tokens=prefix_tokens,
                                       run_amr_sm=args.run_amr_sm,
                                       modify_arcact_score=args.modify_arcact_score,
-                                      use_pred_rules=args.use_pred_rules)
+                                      use_pred_rules=args.use_pred_rules,
+                                      adaptive_max_len=args.adaptive_max_len)
 
     def max_positions(self):
         """Return the max sentence length allowed by the task."""
@@ -0,0 +1,67 @@
+import sys
+
+import torch
+from tqdm import tqdm
+from fairseq.data import Dictionary
+
+from transition_amr_parser.amr_machine import AMRStateMachine, peel_pointer
+from transition_amr_parser.io import read_tokenized_sentences
+from fairseq_ext.amr_spec.batched_state_machine import BatchedAMRStateMachine
+
+
+if __name__ == '__main__':
+    # compare the batched valid action masks with the ones from the machine, running all the oracle action
+    # sequences in lockstep
+    if len(sys.argv) > 1:
+        oracle_folder = sys.argv[1]
+    else:
+        oracle_folder = 'DATA/wiki25/oracles/cofill_o10_act-states/'
+
+    split = 'train'
+    en_file = f'{oracle_folder}/{split}.en'
+    actions_file = f'{oracle_folder}/{split}.actions'
+    machine_config = f'{oracle_folder}/machine_config.json'
+
+    sentences = read_tokenized_sentences(en_file, '\t')
+    action_sequences = [actions + ['CLOSE'] for actions in read_tokenized_sentences(actions_file, '\t')]
+
+    # action dictionary without pointers
+    actions_dict = Dictionary()
+    for actions in action_sequences:
+        for act in actions[:-1]:
+            actions_dict.add_symbol(peel_pointer(act)[0])
+
+    machines = []
+    for tokens in sentences:
+        machine = AMRStateMachine.from_config(machine_config)
+        machine.reset(tokens)
+        machines.append(machine)
+    canonical_act_ids = machines[0].canonical_action_to_dict(actions_dict)
+
+    batched_machine = BatchedAMRStateMachine(machines[0], actions_dict)
+    batched_machine.reset(torch.tensor([len(tokens) for tokens in sentences]))
+
+    for step in tqdm(range(max(map(len, action_sequences)))):
+        allowed_mask = batched_machine.get_valid_actions_mask()
+        action_ids = []
+        update_mask = []
+        for i, (machine, actions) in enumerate(zip(machines, action_sequences)):
+            if step >= len(actions):
+                action_ids.append(actions_dict.pad())
+                update_mask.append(False)
+                continue
+            vocab_ids_allowed = set().union(*[set(canonical_act_ids[act]) for act in machine.get_valid_actions()])
+            assert set(allowed_mask[i].nonzero().view(-1).tolist()) == vocab_ids_allowed
+            assert batched_machine.tok_cursors[i].item() == machine.tok_cursor
+            act = actions[step]
+            action_ids.append(actions_dict.eos() if act == 'CLOSE' else actions_dict.index(peel_pointer(act)[0]))
+            update_mask.append(True)
+            machine.update(act)
+        batched_machine.update(torch.tensor(action_ids), torch.tensor(update_mask))
+
+        # reverse the order of the hypotheses to check reordering
+        machines = machines[::-1]
+        action_sequences = action_sequences[::-1]
+        batched_machine.reorder(torch.arange(len(machines) - 1, -1, -1))
+
+    print(f'valid action masks match for {len(sentences)} sentences')
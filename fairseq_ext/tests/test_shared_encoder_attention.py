@@ -0,0 +1,83 @@
+"""
+Checks that encoder-decoder attention over an encoder output shared by the beams of each sentence (kv_index) gives the
+same results as attention over the encoder output repeated for every beam, as in beam search: incremental decoding
+with beams reordered within their sentence, dropped beams and finished sentences removed from the batch.
+
+python fairseq_ext/tests/test_shared_encoder_attention.py
+"""
+import torch
+
+from fairseq_ext.modules.multihead_attention import MultiheadAttention, SharedKVIndex
+
+
+def check_beam_search(attention, embed_dim, src_len=11, bsz=3, beam_size=5, num_steps=6):
+    encoder_out = torch.randn(src_len, bsz, embed_dim)
+    padding_mask = torch.zeros(bsz, src_len, dtype=torch.bool)
+    padding_mask[1, :3] = True
+    padding_mask[2, :1] = True
+
+    # sentence of each hypothesis
+    index = torch.arange(bsz).repeat_interleave(beam_size)
+    encoder_out_rep, padding_mask_rep = encoder_out.index_select(1, index), padding_mask.index_select(0, index)
+    state_rep, state_shared = {}, {}
+    max_diff = 0
+    for step in range(num_steps):
+        query = torch.randn(1, index.numel(), embed_dim)
+        with torch.no_grad():
+            attn_rep, weights_rep = attention(
+                query, encoder_out_rep, encoder_out_rep, key_padding_mask=padding_mask_rep,
+                incremental_state=state_rep, static_kv=True, need_weights=True
+            )
+            attn_shared, weights_shared = attention(
+                query, encoder_out, encoder_out, key_padding_mask=padding_mask,
+                incremental_state=state_shared, static_kv=True, need_weights=True,
+                kv_index=SharedKVIndex.from_index(index)
+            )
+        max_diff = max(max_diff, (attn_rep - attn_shared).abs().max().item(),
+                       (weights_rep - weights_shared).abs().max().item())
+
+        # reorder the beams within each sentence
+        num_hyps = index.numel()
+        new_order = torch.arange(num_hyps)
+        if step < 2:
+            new_order = (new_order // beam_size) * beam_size + torch.randint(0, beam_size, (num_hyps,))
+        # drop some beams
+        if step == 2:
+            new_order = new_order[torch.tensor([i for i in range(num_hyps) if i not in (1, 7)])]
+        # first sentence finished
+        if step == 3:
+            new_order = new_order[index[new_order] != 0]
+        attention.reorder_incremental_state(state_rep, new_order)
+        attention.reorder_incremental_state(state_shared, new_order)
+        encoder_out_rep = encoder_out_rep.index_select(1, new_order)
+        padding_mask_rep = padding_mask_rep.index_select(0, new_order)
+        index = index.index_select(0, new_order)
+
+    return max_diff
+
+
+def check_unordered_index(attention, embed_dim, src_len=7):
+    # groups out of order, repeated and with unused rows of the keys
+    encoder_out = torch.randn(src_len, 4, embed_dim)
+    index = torch.tensor([2, 2, 0, 3, 3, 3, 2])
+    query = torch.randn(1, index.numel(), embed_dim)
+    with torch.no_grad():
+        encoder_out_rep = encoder_out.index_select(1, index)
+        attn_rep, _ = attention(query, encoder_out_rep, encoder_out_rep, static_kv=True)
+        attn_shared, _ = attention(query, encoder_out, encoder_out, static_kv=True, incremental_state={},
+                                   kv_index=SharedKVIndex.from_index(index))
+    return (attn_rep - attn_shared).abs().max().item()
+
+
+if __name__ == '__main__':
+    torch.manual_seed(0)
+    embed_dim, num_heads = 64, 4
+    attention = MultiheadAttention(embed_dim, num_heads, encoder_decoder_attention=True).eval()
+
+    max_diff = check_beam_search(attention, embed_dim)
+    print(f'beam search, max difference shared vs repeated: {max_diff:.2e}')
+    assert max_diff < 1e-5
+
+    max_diff = check_unordered_index(attention, embed_dim)
+    print(f'unordered index, max difference shared vs repeated: {max_diff:.2e}')
+    assert max_diff < 1e-5
@@ -0,0 +1,60 @@
+import sys
+import time
+
+import torch
+from tqdm import tqdm
+
+from fairseq_ext.roberta.pretrained_embeddings import get_wordpiece_to_word_map
+
+
+def get_wordpiece_to_word_map_decode(sentence, roberta_bpe):
+    """Previous implementation, decoding the growing wordpiece sequence after each wordpiece (quadratic on the length
+    of the words)"""
+    word_tokens = sentence.split()
+    wordpiece_bpe_ids = roberta_bpe.bpe.encode(sentence)
+
+    w_index = 0
+    word_to_wordpiece = []
+    subword_sequence = []
+    bpe_id_sequence = []
+    for wp_index, bpe_id in enumerate(wordpiece_bpe_ids):
+        word = word_tokens[w_index]
+        if w_index > 0:
+            word = ' ' + word
+        subword_sequence.append(wp_index)
+        bpe_id_sequence.append(bpe_id)
+        if word == roberta_bpe.bpe.decode(bpe_id_sequence):
+            word_to_wordpiece.append(subword_sequence)
+            w_index += 1
+            subword_sequence = []
+            bpe_id_sequence = []
+
+    return word_to_wordpiece
+
+
+if __name__ == '__main__':
+    # check that the wordpiece to word mapping is the same as with the previous implementation and compare speed, on
+    # the tokenized sentences of a file (one per line)
+    if len(sys.argv) > 1:
+        sentences_file = sys.argv[1]
+    else:
+        sentences_file = 'DATA/AMR3.0/oracles/cofill_bartsv-nodesplit_o10_act-states/train.en'
+
+    roberta = torch.hub.load('pytorch/fairseq', 'roberta.base')
+
+    with open(sentences_file) as fid:
+        sentences = [line.rstrip() for line in fid if line.strip()]
+
+    times = {}
+    mappings = {}
+    for name, function in [('decode', get_wordpiece_to_word_map_decode), ('bytes', get_wordpiece_to_word_map)]:
+        start = time.time()
+        mappings[name] = [function(sentence, roberta.bpe) for sentence in tqdm(sentences, desc=name)]
+        times[name] = time.time() - start
+
+    for sentence, mapping_decode, mapping in zip(sentences, mappings['decode'], mappings['bytes']):
+        assert mapping_decode == mapping, sentence
+
+    print(f'same wordpiece to word mapping for {len(sentences)} sentences')
+    for name, seconds in times.items():
+        print(f'{name}: {seconds:.2f}s ({1e6 * seconds / len(sentences):.1f} us/sentence)')
@@ -1,5 +1,6 @@
 import time
 import math
+from copy import deepcopy
 
 from fairseq.tokenizer import tokenize_line
 
@@ -135,6 +136,32 @@ def clean_pointer_arcs(actions_nopos, actions_pos, actions):
     return actions_nopos_new, actions_pos_new, actions_new, invalid_idx
 
 
+def reorder_state_machines(state_machines, new_order):
+    """Reorder the state machines of the beams after a search step.
+
+    The first new beam continuing a previous beam takes over its machine, the others get a copy. Machines with a
+    `fork()` method (copy-on-write) share their history with the original, the rest are deep copied.
+
+    Args:
+        state_machines (List): state machines, one for each previous beam
+        new_order (List[int]): index of the previous beam for each new beam
+
+    Return:
+        reordered (List): state machines, one for each new beam
+    """
+    reordered = []
+    taken = set()
+    for i in new_order:
+        sm = state_machines[i]
+        if i in taken:
+            # NOTE the machine taken over is not updated before all beams are reordered, so copying it here is safe
+            sm = sm.fork() if hasattr(sm, 'fork') else deepcopy(sm)
+        else:
+            taken.add(i)
+        reordered.append(sm)
+    return reordered
+
+
 def time_since(start):
     now = time.time()
     s = now - start
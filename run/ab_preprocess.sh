@@ -184,6 +184,14 @@ else
 
     fi
 
+    # optionally consolidate all the indexed data files of each split into a
+    # single file, loaded by the tasks instead of the original files
+    if [ "${CONSOLIDATE_DATA:-0}" == "1" ]; then
+        python fairseq_ext/consolidate_data.py \
+            --data-dir $DATA_FOLDER \
+            --emb-dir $EMB_FOLDER
+    fi
+
     touch $DATA_FOLDER/.done
     touch $EMB_FOLDER/.done
 
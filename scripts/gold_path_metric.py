@@ -1,5 +1,6 @@
 import argparse
 from collections import defaultdict
+from itertools import zip_longest
 import re
 # pip install
 from ipdb import set_trace
@@ -7,27 +8,25 @@ import penman
 from penman.layout import Push
 
 
-def read_amr(file_path, ibm_format=False, tokenize=False):
+def iter_amr(file_path, ibm_format=False, tokenize=False):
+    """Yield AMRs from file one by one as they are parsed"""
     with open(file_path) as fid:
         raw_amr = []
-        raw_amrs = []
-        # for line in tqdm(fid.readlines(), desc='Reading AMR'):
-        for line in fid.readlines():
+        for line in fid:
             if line.strip() == '':
                 if ibm_format:
                     # From ::node, ::edge etc
-                    raw_amrs.append(
-                        AMR.from_metadata(raw_amr, tokenize=tokenize)
-                    )
+                    yield AMR.from_metadata(raw_amr, tokenize=tokenize)
                 else:
                     # From penman
-                    raw_amrs.append(
-                        AMR.from_penman(raw_amr, tokenize=tokenize)
-                    )
+                    yield AMR.from_penman(raw_amr, tokenize=tokenize)
                 raw_amr = []
             else:
                 raw_amr.append(line)
-    return raw_amrs
+
+
+def read_amr(file_path, ibm_format=False, tokenize=False):
+    return list(iter_amr(file_path, ibm_format=ibm_format, tokenize=tokenize))
 
 
 alignment_regex = re.compile('(-?[0-9]+)-(-?[0-9]+)')
@@ -480,9 +479,9 @@ def path_filter(amr, gid):
     return new_gid
 
 
-def save_print_path(out_paths, amrs, print_paths):
+def save_print_path(out_paths, amrs_print_paths):
     with open(out_paths, 'w') as fid:
-        for amr, ppaths in zip(amrs, print_paths):
+        for amr, ppaths in amrs_print_paths:
             tokens = amr.tokens
             if '<ROOT>' in tokens:
                 tokens.remove('<ROOT>')
@@ -494,13 +493,12 @@ def save_print_path(out_paths, amrs, print_paths):
 
 
 def get_print_paths_corpus(amrs, kb_only):
-    print_paths = []
+    """Yield each AMR with its print paths"""
     for amr in amrs:
         gid = get_path_ids(amr)
         if kb_only:
             gid = path_filter(amr, gid)
-        print_paths.append(get_print_paths(amr, gid))
-    return print_paths
+        yield amr, get_print_paths(amr, gid)
 
 
 def get_print_paths(amr, paths):
@@ -707,13 +705,17 @@ def compute_scores(pred_amrs, gold_amrs, kb_only):
         num_gold_paths=0,
         hits=0,
         misses=0,
-        exact_paths=[],
-        exact_unknowns=[]
+        num_amrs=0,
+        exact_paths=0,
+        exact_unknowns=0
     )
-    for index in range(len(gold_amrs)):
+    # AMRs may be read as they are needed, so lengths are checked at the end
+    missing = object()
+    for pred_amr, gold_amr in zip_longest(pred_amrs, gold_amrs,
+                                          fillvalue=missing):
 
-        pred_amr = pred_amrs[index]
-        gold_amr = gold_amrs[index]
+        assert pred_amr is not missing and gold_amr is not missing, \
+            "predicted and gold AMRs differ in number"
 
         # if gold_amr.tokens[0] == 'Whichd':
         #    set_trace(context=30)
@@ -740,14 +742,15 @@ def compute_scores(pred_amrs, gold_amrs, kb_only):
         stats['num_gold_paths'] += len(print_gold_paths)
         stats['hits'] += len(hits)
         stats['misses'] += len(misses)
-        stats['exact_paths'].append(len(hits) == len(print_gold_paths))
-        stats['exact_unknowns'].append(len(gold_unk_ids) == len(pred_unk_ids))
+        stats['num_amrs'] += 1
+        stats['exact_paths'] += len(hits) == len(print_gold_paths)
+        stats['exact_unknowns'] += len(gold_unk_ids) == len(pred_unk_ids)
 
     hits = stats['hits']
     tries = stats['num_pred_paths']
-    em = sum(stats['exact_paths']) / len(stats['exact_paths'])
-    euh = sum(stats['exact_unknowns'])
-    eut = len(stats['exact_unknowns'])
+    em = stats['exact_paths'] / stats['num_amrs']
+    euh = stats['exact_unknowns']
+    eut = stats['num_amrs']
     if kb_only:
         print(f'GPGA-KB: {hits/tries:.3f} (EM {em:.3f})')
         print(f'Unknowns: {euh}/{eut} (EM {euh/eut:.3f})')
@@ -779,20 +782,17 @@ def argument_parser():
 
 def main(args):
 
-    # Read files
-    amrs = read_amr(args.in_amr, ibm_format=True)
-    num_amrs = len(amrs)
-    if args.in_gold_amr:
-        gold_amrs = read_amr(args.in_gold_amr, ibm_format=True)
-        assert len(gold_amrs) == num_amrs
+    # Read files, AMRs are parsed as they are needed
+    amrs = iter_amr(args.in_amr, ibm_format=True)
 
     if args.in_gold_amr:
         # Compute and print scores
+        gold_amrs = iter_amr(args.in_gold_amr, ibm_format=True)
         compute_scores(amrs, gold_amrs, args.kb_only)
     elif args.out_paths:
         # save paths
         print_paths = get_print_paths_corpus(amrs, args.kb_only)
-        save_print_path(args.out_paths, amrs, print_paths)
+        save_print_path(args.out_paths, print_paths)
 
 
 if __name__ == '__main__':
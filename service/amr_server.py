@@ -1,5 +1,8 @@
 from concurrent import futures
 import logging
+import queue
+import threading
+import time
 
 import grpc
 import torch
@@ -32,6 +35,53 @@ def argument_parser():
         help="GRPC port",
         type=str
     )
+    parser.add_argument(
+        "--batched",
+        help="coalesce concurrent requests into batches, --in-model is then"
+             " an action-pointer checkpoint",
+        action='store_true'
+    )
+    parser.add_argument(
+        "--max-batch-size",
+        help="max number of sentences parsed together (--batched)",
+        default=128,
+        type=int
+    )
+    parser.add_argument(
+        "--max-wait-ms",
+        help="max time a request waits for others to fill a batch (--batched)",
+        default=10,
+        type=float
+    )
+    parser.add_argument(
+        "--roberta-batch-size",
+        help="batch size for roberta computation (--batched)",
+        default=10,
+        type=int
+    )
+    parser.add_argument(
+        "--embedding-cache-dir",
+        help="folder to cache the roberta embeddings of parsed sentences (--batched)",
+        type=str
+    )
+    parser.add_argument(
+        "--embedding-cache-memory-mb",
+        help="size of the in-memory cache of roberta embeddings in MB, 1024 by"
+             " default with --embedding-cache-dir (--batched)",
+        type=int
+    )
+    parser.add_argument(
+        "--embedding-cache-disk-mb",
+        help="max size of --embedding-cache-dir in MB, no limit by default (--batched)",
+        type=int
+    )
+    parser.add_argument(
+        "--max-workers",
+        help="number of threads serving RPCs, this bounds the number of"
+             " concurrent single sentence requests that can share a batch",
+        default=10,
+        type=int
+    )
     args = parser.parse_args()
 
     # Sanity checks
@@ -54,15 +104,166 @@ class Parser():
         amr = self.parser.parse_sentence(tokens)
         return amr_pb2.AMRResponse(amr_parse=amr.toJAMRString())
 
+    def processBatch(self, request, context):
+        return amr_pb2.AMRBatchResponse(
+            responses=[self.process(amr_input, context) for amr_input in request.inputs]
+        )
+
+    def processStream(self, request_iterator, context):
+        for amr_input in request_iterator:
+            yield self.process(amr_input, context)
+
+
+class BatchedParser():
+    """
+    Coalesces the sentences of concurrent requests into batches for the
+    batched action-pointer parser
+
+    A single thread runs the model. It waits for the first sentence, then
+    for up to max_wait_ms for more sentences, up to max_batch_size, and
+    parses them together. Each request waits on a future for its result.
+    If a batch fails, its sentences are parsed again one by one, so that
+    only the requests with offending sentences fail.
+    """
+
+    def __init__(self, checkpoint, roberta_cache_path=None, max_batch_size=128, max_wait_ms=10,
+                 roberta_batch_size=10, embedding_cache=None):
+        # NOTE: imported here, as the non batched server does not need fairseq_ext
+        from transition_amr_parser.action_pointer.parse import AMRParser as BatchAMRParser
+        self.parser = BatchAMRParser.from_checkpoint(checkpoint, roberta_cache_path=roberta_cache_path,
+                                                     embedding_cache=embedding_cache)
+        self.embedding_cache = embedding_cache
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.roberta_batch_size = roberta_batch_size
+        # (tokens, future) to be parsed
+        self.requests = queue.Queue()
+        self.batcher = threading.Thread(target=self.run_batches, daemon=True)
+        self.batcher.start()
+
+    def submit(self, tokens):
+        future = futures.Future()
+        # reject malformed sentences here, rather than failing their batch
+        if not tokens or not all(isinstance(token, str) and token.strip() for token in tokens):
+            future.set_exception(ValueError(f'expected a non empty list of non empty tokens, got {tokens!r}'))
+        else:
+            self.requests.put((tokens, future))
+        return future
+
+    def get_batch(self):
+        # block until there is some work, then fill the batch until timeout
+        batch = [self.requests.get()]
+        deadline = time.time() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - time.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(self.requests.get(timeout=timeout))
+            except queue.Empty:
+                break
+        return batch
+
+    def parse(self, batch):
+        annotations, _ = self.parser.parse_sentences(
+            [list(tokens) for tokens, _ in batch],
+            batch_size=self.max_batch_size,
+            roberta_batch_size=self.roberta_batch_size,
+            quiet=True
+        )
+        for (_, future), annotation in zip(batch, annotations):
+            future.set_result(annotation)
+
+    def run_batches(self):
+        while True:
+            batch = self.get_batch()
+            try:
+                self.parse(batch)
+            except Exception as exception:
+                if len(batch) == 1:
+                    batch[0][1].set_exception(exception)
+                else:
+                    # parse one sentence at a time, fail only the offending
+                    # requests and keep serving
+                    logging.warning(f'failed to parse a batch of {len(batch)} sentences ({exception!r}), '
+                                    'retrying one by one')
+                    for request in batch:
+                        try:
+                            self.parse([request])
+                        except Exception as exception:
+                            request[1].set_exception(exception)
+            if self.embedding_cache is not None:
+                logging.info(self.embedding_cache.report())
+
+    def close(self):
+        # stop the post-processing workers of the parser, if any
+        self.parser.close()
+
+    @staticmethod
+    def get_tokens(request):
+        return [word_token.token for word_token in request.word_infos]
+
+    def process(self, request, context):
+        amr = self.submit(self.get_tokens(request)).result()
+        return amr_pb2.AMRResponse(amr_parse=amr)
+
+    def processBatch(self, request, context):
+        # submit all, so that they can share batches
+        results = [self.submit(self.get_tokens(amr_input)) for amr_input in request.inputs]
+        return amr_pb2.AMRBatchResponse(
+            responses=[amr_pb2.AMRResponse(amr_parse=result.result()) for result in results]
+        )
+
+    def processStream(self, request_iterator, context):
+        # read the requests in a separate thread, so that sentences are
+        # submitted as they arrive while results are sent back in order
+        results = queue.Queue()
+
+        def read_requests():
+            try:
+                for amr_input in request_iterator:
+                    results.put(self.submit(self.get_tokens(amr_input)))
+            finally:
+                results.put(None)
+
+        threading.Thread(target=read_requests, daemon=True).start()
+        while True:
+            result = results.get()
+            if result is None:
+                break
+            yield amr_pb2.AMRResponse(amr_parse=result.result())
+
+
 def serve():
     # Argument handling
     args = argument_parser()
 
-    server = grpc.server(futures.ThreadPoolExecutor(max_workers=10))
-    amr_pb2_grpc.add_AMRServerServicer_to_server(Parser(model_path=args.in_model, roberta_cache_path=args.roberta_cache_path), server)
+    if args.batched:
+        embedding_cache = None
+        if args.embedding_cache_dir or args.embedding_cache_memory_mb:
+            # NOTE: imported here, as the non batched server does not need fairseq_ext
+            from fairseq_ext.roberta.embedding_cache import EmbeddingCache
+            embedding_cache = EmbeddingCache(
+                cache_dir=args.embedding_cache_dir,
+                max_memory_bytes=(1024 if args.embedding_cache_memory_mb is None
+                                  else args.embedding_cache_memory_mb) * 2**20,
+                max_disk_bytes=args.embedding_cache_disk_mb * 2**20 if args.embedding_cache_disk_mb else None
+            )
+        parser = BatchedParser(args.in_model, roberta_cache_path=args.roberta_cache_path,
+                               max_batch_size=args.max_batch_size, max_wait_ms=args.max_wait_ms,
+                               roberta_batch_size=args.roberta_batch_size, embedding_cache=embedding_cache)
+    else:
+        parser = Parser(model_path=args.in_model, roberta_cache_path=args.roberta_cache_path)
+
+    server = grpc.server(futures.ThreadPoolExecutor(max_workers=args.max_workers))
+    amr_pb2_grpc.add_AMRServerServicer_to_server(parser, server)
     server.add_insecure_port('[::]:' + args.port)
     server.start()
-    server.wait_for_termination()
+    try:
+        server.wait_for_termination()
+    finally:
+        if args.batched:
+            parser.close()
 
 if __name__ == '__main__':
     logging.basicConfig()
@@ -0,0 +1,94 @@
+"""
+Micro-benchmark of AMRStateMachine forks, as used in beam search
+
+Runs the oracle actions of each sentence and forks the machine at every step,
+the way beam search branches hypotheses. Compares fork() against deep
+copying the same state held in plain lists and dicts, as the machine did
+before, in time and in memory per hypothesis.
+
+python tests/amr_machine_benchmark.py \
+    DATA/wiki25/oracles/cofill_o10_act-states/
+"""
+import sys
+import time
+import tracemalloc
+from copy import deepcopy
+
+from transition_amr_parser.amr_machine import AMRStateMachine
+from transition_amr_parser.io import read_tokenized_sentences
+
+
+def plain_state(machine):
+    # state of the machine as stored before it used __slots__ and shared
+    # lists
+    return dict(
+        tokens=list(machine.tokens),
+        tok_cursor=machine.tok_cursor,
+        node_stack=list(machine.node_stack),
+        action_history=list(machine.action_history),
+        nodes=machine.nodes,
+        edges=list(machine.edges),
+        root=machine.root,
+        alignments=machine.alignments,
+        is_closed=machine.is_closed,
+        actions_tokcursor=list(machine.actions_tokcursor)
+    )
+
+
+def run(sentences, action_sequences, machine_config, copy_fn,
+        state_fn=None):
+    """Run all sentences keeping a copy of the machine at every step
+
+    state_fn builds the state to copy from the machine, outside of the timed
+    copy
+    """
+    copies = []
+    start = time.time()
+    copy_time = 0
+    for tokens, actions in zip(sentences, action_sequences):
+        machine = AMRStateMachine.from_config(machine_config)
+        machine.reset(tokens)
+        for action in actions:
+            machine.update(action)
+            state = machine if state_fn is None else state_fn(machine)
+            copy_start = time.time()
+            copies.append(copy_fn(state))
+            copy_time += time.time() - copy_start
+    return copies, copy_time, time.time() - start
+
+
+def main(oracle_folder, split='train'):
+
+    sentences = read_tokenized_sentences(f'{oracle_folder}/{split}.en', '\t')
+    action_sequences = [
+        actions + ['CLOSE'] for actions in
+        read_tokenized_sentences(f'{oracle_folder}/{split}.actions', '\t')
+    ]
+    machine_config = f'{oracle_folder}/machine_config.json'
+
+    for name, copy_fn, state_fn in [
+        ('deepcopy of plain state', deepcopy, plain_state),
+        ('AMRStateMachine.fork()', lambda m: m.fork(), None),
+    ]:
+        tracemalloc.start()
+        copies, copy_time, total_time = run(
+            sentences, action_sequences, machine_config, copy_fn, state_fn
+        )
+        memory, _ = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        num_copies = len(copies)
+        print(
+            f'{name}: {num_copies} copies, '
+            f'{1e6 * copy_time / num_copies:.1f} us/copy, '
+            f'{memory / num_copies / 1024:.2f} KB/hypothesis '
+            f'(total {total_time:.2f}s)'
+        )
+        del copies
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        oracle_folder = sys.argv[1]
+    else:
+        oracle_folder = 'DATA/wiki25/oracles/cofill_o10_act-states/'
+    main(oracle_folder)
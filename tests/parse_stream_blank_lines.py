@@ -0,0 +1,43 @@
+"""
+Checks that AMRParser.parse_stream skips empty and whitespace-only lines of
+the input file, as well as empty sentences, and parses the other sentences in
+order and in chunks. The decoding itself is replaced by a function returning
+the tokens of each sentence, so no model is needed.
+
+python tests/parse_stream_blank_lines.py
+"""
+import os
+import tempfile
+
+from transition_amr_parser.io import iter_tokenized_sentences
+from transition_amr_parser.action_pointer.parse import AMRParser
+
+
+def fake_parse_chunk(chunk, batch_size, roberta_batch_size, max_tokens=None):
+    assert all(tokens[-1] == '<ROOT>' for tokens in chunk)
+    fake_parse_chunk.chunk_sizes.append(len(chunk))
+    return [' '.join(tokens[:-1]) for tokens in chunk], None
+
+
+if __name__ == '__main__':
+
+    lines = ['the boy wants to go', '', 'the girl sleeps', '   ', '\t', 'he runs <ROOT>', '']
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        file_path = os.path.join(tmp_dir, 'sentences.tokens')
+        with open(file_path, 'w') as fid:
+            fid.write('\n'.join(lines) + '\n')
+
+        # parser without a model, only the streaming logic is used
+        parser = AMRParser.__new__(AMRParser)
+        parser.to_amr = True
+        parser.parse_chunk = fake_parse_chunk
+        fake_parse_chunk.chunk_sizes = []
+        annotations = list(parser.parse_stream(iter_tokenized_sentences(file_path), batch_size=2, chunk_size=2))
+
+    assert annotations == ['the boy wants to go', 'the girl sleeps', 'he runs'], annotations
+    assert fake_parse_chunk.chunk_sizes == [2, 1], fake_parse_chunk.chunk_sizes
+
+    # empty token lists, e.g. from a tokenizer, are skipped as well
+    annotations = list(parser.parse_stream([[], ['she', 'sings'], [' '], []]))
+    assert annotations == ['she sings'], annotations
+    print('parse_stream skips blank lines: OK')
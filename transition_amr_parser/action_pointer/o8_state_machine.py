@@ -3,6 +3,7 @@ import os
 import re
 from collections import Counter
 from copy import deepcopy
+from functools import lru_cache
 
 from transition_amr_parser.amr import AMR
 
@@ -310,8 +311,12 @@ class AMRStateMachine:
             return action_label, props
 
     @classmethod
+    @lru_cache(maxsize=2**17)
     def canonical_action_form(cls, action):
-        """Get the canonical form of an action with labels/properties."""
+        """Get the canonical form of an action with labels/properties.
+
+        Results are cached, as this is called for every action when binarizing the data and at every decoding step.
+        """
         if action in cls.canonical_actions:
             return action
         action, properties = cls.read_action(action)
@@ -322,8 +327,12 @@ class AMRStateMachine:
         return action
 
     @classmethod
+    @lru_cache(maxsize=2**17)
     def canonical_action_form_ptr(cls, action):
-        """Get the canonical form of an action with labels/properties, and return the pointer value for arcs."""
+        """Get the canonical form of an action with labels/properties, and return the pointer value for arcs.
+
+        Results are cached, see canonical_action_form().
+        """
         if action in cls.canonical_actions:
             return action, None
         action, properties = cls.read_action(action)
@@ -2,10 +2,11 @@
 
 import os
 import time
-import math
 import copy
 import signal
 import argparse
+import multiprocessing
+from itertools import islice
 from datetime import timedelta
 
 from ipdb import set_trace
@@ -17,13 +18,14 @@ from fairseq.tokenizer import tokenize_line
 
 from fairseq_ext import options    # this is key to recognizing the customized arguments
 from fairseq_ext.roberta.pretrained_embeddings import PretrainedEmbeddings
+from fairseq_ext.roberta.embedding_cache import EmbeddingCache
 from fairseq_ext.data.amr_action_pointer_dataset import collate
 # OR (same results) from fairseq_ext.data.amr_action_pointer_graphmp_dataset import collate
 from fairseq_ext.utils import post_process_action_pointer_prediction, clean_pointer_arcs
 from transition_amr_parser.amr_state_machine import AMRStateMachine, get_spacy_lemmatizer
 from transition_amr_parser.amr import InvalidAMRError, get_duplicate_edges
 from transition_amr_parser.utils import yellow_font
-from transition_amr_parser.io import read_config_variables, read_tokenized_sentences
+from transition_amr_parser.io import read_config_variables, iter_tokenized_sentences
 
 
 def argument_parsing():
@@ -65,6 +67,35 @@ def argument_parsing():
         default=128,
         help='Batch size for decoding (excluding roberta)'
     )
+    parser.add_argument(
+        '--num-workers',
+        type=int,
+        default=0,
+        help='Number of processes building the AMRs from the actions, while'
+             ' decoding continues (0 for doing it after each batch)'
+    )
+    parser.add_argument(
+        '--embedding-cache-dir',
+        type=str,
+        help='Folder to cache the roberta embeddings of parsed sentences'
+    )
+    parser.add_argument(
+        '--embedding-cache-memory-mb',
+        type=int,
+        help='Size of the in-memory cache of roberta embeddings (MB), 1024'
+             ' by default with --embedding-cache-dir'
+    )
+    parser.add_argument(
+        '--embedding-cache-disk-mb',
+        type=int,
+        help='Max size of --embedding-cache-dir (MB), no limit by default'
+    )
+    parser.add_argument(
+        '--max-tokens',
+        type=int,
+        help='Max number of (padded) tokens per batch, for decoding and'
+             ' roberta'
+    )
     # step by step parameters
     parser.add_argument(
         "--step-by-step",
@@ -147,6 +178,64 @@ def load_roberta(name=None, roberta_cache_path=None, roberta_use_gpu=False):
     return roberta
 
 
+def plan_batches(lengths, batch_size, max_tokens=None):
+    """Group sentences of similar length into batches.
+
+    Sentences are sorted by length and packed with at most `batch_size` sentences and, if given, at most `max_tokens`
+    tokens per batch, padding included. A sentence longer than `max_tokens` gets its own batch.
+
+    Args:
+        lengths (List[int]): length of each sentence.
+        batch_size (int): max number of sentences per batch.
+        max_tokens (int, optional): max number of tokens per batch, counted as number of sentences times the longest
+            one.
+
+    Returns:
+        List[List[int]]: indices of the sentences in each batch; use them to restore the original order.
+    """
+    batches = []
+    batch = []
+    for index in sorted(range(len(lengths)), key=lambda i: lengths[i]):
+        # sorted by length, so the new sentence is the longest
+        if batch and (
+            len(batch) == batch_size
+            or (max_tokens is not None and (len(batch) + 1) * lengths[index] > max_tokens)
+        ):
+            batches.append(batch)
+            batch = []
+        batch.append(index)
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+# AMR post-processing state of each worker process
+postprocess_worker = {}
+
+
+def init_postprocess_worker(entities_with_preds, entity_rules):
+    # Initialize lemmatizer as this is slow
+    postprocess_worker['lemmatizer'] = get_spacy_lemmatizer()
+    postprocess_worker['entities_with_preds'] = entities_with_preds
+    postprocess_worker['entity_rules'] = entity_rules
+
+
+def postprocess_amr(src_tokens, actions):
+    """Build the AMR annotation from the predicted actions in a worker process.
+
+    Returns:
+        str: AMR annotation
+        duplicated edges, for the sanity check
+    """
+    machine = AMRStateMachine(tokens=src_tokens, amr_graph=True,
+                              spacy_lemmatizer=postprocess_worker['lemmatizer'],
+                              entities_with_preds=postprocess_worker['entities_with_preds'],
+                              entity_rules=postprocess_worker['entity_rules'])
+    # CLOSE action is internally managed
+    machine.apply_actions(actions if actions[-1] == 'CLOSE' else actions + ['CLOSE'])
+    return machine.get_annotations(), get_duplicate_edges(machine.amr)
+
+
 class AMRParser:
     def __init__(
         self,
@@ -163,7 +252,8 @@ class AMRParser:
         entities_with_preds=None,        # special entities in the data oracle
         entity_rules=None,               # entity rules file path for postprocessing to recover amr
         embeddings=None,  # PyTorch RoBERTa model (if dealing with token input)
-        inspector=None    # function to call after each step
+        inspector=None,   # function to call after each step
+        num_workers=0     # processes building the AMRs while decoding
     ):
 
         # member variables
@@ -190,6 +280,33 @@ class AMRParser:
             self.entities_with_preds = entities_with_preds
             self.entity_rules = entity_rules
 
+        # AMR post-processing in worker processes, overlapped with decoding
+        # NOTE: the inspector needs the machines in this process. The workers
+        # only return the annotations, the 'machine' of the predictions is
+        # then None. Stop them with close(), or use the parser as a context
+        # manager
+        self.pool = None
+        if to_amr and num_workers > 0 and inspector is None:
+            # spawn, as forking a process that uses CUDA is not safe
+            self.pool = multiprocessing.get_context('spawn').Pool(
+                num_workers,
+                initializer=init_postprocess_worker,
+                initargs=(entities_with_preds, entity_rules)
+            )
+
+    def close(self):
+        """Stop the AMR post-processing workers"""
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
     @classmethod
     def default_args(cls, checkpoint=None, fp16=False):
         """Default args for generation"""
@@ -215,7 +332,7 @@ class AMRParser:
     @classmethod
     def from_checkpoint(cls, checkpoint, dict_dir=None, roberta_cache_path=None,
                         fp16=False,
-                        inspector=None):
+                        inspector=None, num_workers=0, embedding_cache=None):
         '''
         Initialize model from checkpoint
         '''
@@ -271,9 +388,14 @@ class AMRParser:
         roberta = load_roberta(name=pretrained_embed,
                                roberta_cache_path=roberta_cache_path,
                                roberta_use_gpu=use_cuda)
+        roberta_checkpoint = None
+        if roberta_cache_path:
+            roberta_checkpoint = os.path.join(roberta_cache_path, 'model.pt')
         embeddings = PretrainedEmbeddings(name=pretrained_embed,
                                           bert_layers=bert_layers,
-                                          model=roberta)
+                                          model=roberta,
+                                          cache=embedding_cache,
+                                          checkpoint=roberta_checkpoint)
 
         print("Finished loading models")
 
@@ -291,23 +413,26 @@ class AMRParser:
         return cls(models,task, task.src_dict, task.tgt_dict, machine_rules, machine_type,
                    use_cuda, args, model_args, to_amr=True, entities_with_preds=entities_with_preds,
                    entity_rules=entity_rules,
-                   embeddings=embeddings, inspector=inspector)
-
-    def get_bert_features_batched(self, sentences, batch_size):
-        bert_data = []
-        num_batches = math.ceil(len(sentences)/batch_size)
-        for i in tqdm(range(0, num_batches), desc='roberta'):
-            batch = sentences[i * batch_size: i * batch_size + batch_size]
+                   embeddings=embeddings, inspector=inspector, num_workers=num_workers)
+
+    def get_bert_features_batched(self, sentences, batch_size, max_tokens=None, quiet=False):
+        # batch sentences of similar length to reduce padding, results are
+        # returned in the original order
+        bert_data = [None] * len(sentences)
+        batches = plan_batches([len(sentence.split()) for sentence in sentences], batch_size, max_tokens)
+        for batch_indices in tqdm(batches, desc='roberta', disable=quiet):
+            batch = [sentences[index] for index in batch_indices]
             batch_data = self.embeddings.extract_batch(batch)
-            for i in range(0, len(batch)):
-                bert_data.append((
+            for i, index in enumerate(batch_indices):
+                bert_data[index] = (
                     copy.deepcopy(batch_data["word_features"][i]),
                     copy.deepcopy(batch_data["wordpieces_roberta"][i]),
                     copy.deepcopy(
                         batch_data["word2piece_scattered_indices"][i]
                     )
-                ))
-        print(len(bert_data))
+                )
+        if not quiet:
+            print(len(bert_data))
         assert len(bert_data) == len(sentences)
         return bert_data
 
@@ -321,11 +446,13 @@ class AMRParser:
         )
 
     def convert_sentences_to_data(self, sentences, batch_size,
-                                  roberta_batch_size):
+                                  roberta_batch_size, max_tokens=None,
+                                  quiet=False):
 
         # extract RoBERTa features
         roberta_features = \
-            self.get_bert_features_batched(sentences, roberta_batch_size)
+            self.get_bert_features_batched(sentences, roberta_batch_size,
+                                           max_tokens, quiet=quiet)
 
         # organize data into a fairseq batch
         data = []
@@ -343,10 +470,12 @@ class AMRParser:
             })
         return data
 
-    def get_iterator(self, samples, batch_size):
+    def get_iterator(self, samples, batch_size, max_tokens=None):
+        # batch sentences of similar length to reduce padding (and decoding
+        # steps), samples keep their 'id' to restore the original order
         batches = []
-        for i in range(0, math.ceil(len(samples)/batch_size)):
-            sample = samples[i * batch_size: i * batch_size + batch_size]
+        for batch_indices in plan_batches([len(sample['source']) for sample in samples], batch_size, max_tokens):
+            sample = [samples[index] for index in batch_indices]
             batch = collate(
                 sample, pad_idx=self.tgt_dict.pad(),
                 eos_idx=self.tgt_dict.eos(),
@@ -405,33 +534,87 @@ class AMRParser:
 
         return predictions
 
-    def parse_sentences(self, batch, batch_size=128, roberta_batch_size=10):
+    def parse_sentences(self, batch, batch_size=128, roberta_batch_size=10, max_tokens=None, quiet=False):
         """parse a list of sentences.
 
         Args:
             batch (List[List[str]]): list of tokenized sentences.
             batch_size (int, optional): batch size. Defaults to 128.
             roberta_batch_size (int, optional): RoBerta batch size. Defaults to 10.
+            max_tokens (int, optional): max number of tokens per batch, padding included. Defaults to None.
+            quiet (bool, optional): no progress bars or prints, e.g. when serving requests. Defaults to False.
+
+        Returns:
+            List[str]: AMR annotations, in input order.
+            List[dict]: predictions of the last decoded batch only, in the length sorted order of the batch (see
+                parse_chunk()).
         """
         # max batch_size
         if len(batch) < batch_size:
             batch_size = len(batch)
-        print("Running on batch size: " + str(batch_size))
+        if not quiet:
+            print("Running on batch size: " + str(batch_size))
 
-        sentences = []
         # The model expects <ROOT> token at the end of the input sentence
         for tokens in batch:
             if tokens[-1] != "<ROOT>":
                 tokens.append("<ROOT>")
-            sentences.append(" ".join(tokens))
+
+        return self.parse_chunk(batch, batch_size, roberta_batch_size, max_tokens, quiet=quiet)
+
+    def parse_stream(self, sentences, batch_size=128, roberta_batch_size=10, chunk_size=None, max_tokens=None):
+        """parse an iterable of sentences in chunks, yielding the AMR annotations in order as each chunk is done.
+
+        Sentences are read, embedded, batched and decoded one chunk of `chunk_size` at a time, so that memory does not
+        grow with the number of sentences and the first annotations are available after the first chunk. The stages
+        run one after the other within a chunk, and chunks one after the other; they are not overlapped. Empty or
+        whitespace-only sentences (e.g. blank lines of a file) are skipped, as in interactive mode.
+
+        Args:
+            sentences (Iterable[List[str]]): tokenized sentences, e.g. a generator over a file.
+            batch_size (int, optional): batch size. Defaults to 128.
+            roberta_batch_size (int, optional): RoBerta batch size. Defaults to 10.
+            chunk_size (int, optional): number of sentences processed at a time; sentences are grouped by length within
+                each chunk. Defaults to 10 * batch_size.
+            max_tokens (int, optional): max number of tokens per batch, padding included. Defaults to None.
+
+        Yields:
+            str: AMR annotation of each non-empty sentence, in input order.
+        """
+        assert self.to_amr, 'streaming parse only outputs AMR annotations'
+        chunk_size = chunk_size or 10 * batch_size
+        sentences = (tokens for tokens in sentences if any(token.strip() for token in tokens))
+        while True:
+            # The model expects <ROOT> token at the end of the input sentence
+            # NOTE copies, input sentences are not modified
+            chunk = [tokens if tokens[-1] == "<ROOT>" else tokens + ["<ROOT>"]
+                     for tokens in islice(sentences, chunk_size)]
+            if not chunk:
+                break
+            annotations, _ = self.parse_chunk(chunk, min(batch_size, len(chunk)), roberta_batch_size, max_tokens)
+            yield from annotations
+
+    def parse_chunk(self, batch, batch_size, roberta_batch_size, max_tokens=None, quiet=False):
+        """parse a list of sentences ending in <ROOT>, all at once.
+
+        Returns:
+            List[str]: AMR annotations in input order, with to_amr
+            List[dict]: predictions of the last decoded batch only, in the order of that batch, which groups sentences
+                by length; use their 'sample_id' (index in the input) to match them with the input. Their 'machine' is
+                None when the AMRs are built in worker processes (num_workers > 0)
+        """
+        sentences = [" ".join(tokens) for tokens in batch]
 
         data = self.convert_sentences_to_data(sentences, batch_size,
-                                              roberta_batch_size)
-        data_iterator = self.get_iterator(data, batch_size)
+                                              roberta_batch_size, max_tokens,
+                                              quiet=quiet)
+        data_iterator = self.get_iterator(data, batch_size, max_tokens)
 
         # Loop over batches of sentences
         amr_annotations = {}
-        for sample in tqdm(data_iterator, desc='decoding'):
+        # AMRs being built in the workers, as (prediction, async result)
+        pending = []
+        for sample in tqdm(data_iterator, desc='decoding', disable=quiet):
             # move to device
             sample = utils.move_to_cuda(sample) if self.use_cuda else sample
 
@@ -440,29 +623,38 @@ class AMRParser:
                 continue
 
             # parse for this data batch
-            predictions = self.parse_batch(sample, to_amr=self.to_amr)
+            predictions = self.parse_batch(sample, to_amr=self.to_amr and self.pool is None)
 
             # collect all annotations
             if not self.to_amr:
                 continue
 
+            if self.pool is not None:
+                # build the AMRs in the workers and move on to the next batch
+                for pred_dict in predictions:
+                    pending.append((pred_dict, self.pool.apply_async(
+                        postprocess_amr, (pred_dict['src_tokens'], pred_dict['actions'])
+                    )))
+                continue
+
             for pred_dict in predictions:
-                sample_id = pred_dict['sample_id']
                 machine = pred_dict['machine']
                 try:
-                    amr_annotations[sample_id] = machine.get_annotations()
+                    annotation = machine.get_annotations()
                 except InvalidAMRError as exception:
-                    print(f'\nFailed at sentence {sample_id}\n')
+                    print(f'\nFailed at sentence {pred_dict["sample_id"]}\n')
                     raise exception
-
-                # sanity check annotations
-                dupes = get_duplicate_edges(machine.amr)
-                if any(dupes):
-                    msg = yellow_font('WARNING:')
-                    message = f'{msg} duplicated edges in sent {sample_id}'
-                    print(message, end=' ')
-                    print(dict(dupes))
-                    print(' '.join(pred_dict['src_tokens']))
+                self.add_annotation(amr_annotations, pred_dict, annotation, get_duplicate_edges(machine.amr))
+
+        # wait for the workers, results are stored by sentence id so order is
+        # deterministic
+        for pred_dict, result in pending:
+            try:
+                annotation, dupes = result.get()
+            except InvalidAMRError as exception:
+                print(f'\nFailed at sentence {pred_dict["sample_id"]}\n')
+                raise exception
+            self.add_annotation(amr_annotations, pred_dict, annotation, dupes)
 
         # return the AMRs in order
         results = []
@@ -471,6 +663,19 @@ class AMRParser:
 
         return results, predictions
 
+    @staticmethod
+    def add_annotation(amr_annotations, pred_dict, annotation, dupes):
+        sample_id = pred_dict['sample_id']
+        amr_annotations[sample_id] = annotation
+
+        # sanity check annotations
+        if any(dupes):
+            msg = yellow_font('WARNING:')
+            message = f'{msg} duplicated edges in sent {sample_id}'
+            print(message, end=' ')
+            print(dict(dupes))
+            print(' '.join(pred_dict['src_tokens']))
+
 
 def simple_inspector(machine):
     '''
@@ -506,46 +711,69 @@ def main():
     if args.step_by_step:
         inspector = simple_inspector
 
+    # cache of roberta embeddings for repeated sentences
+    embedding_cache = None
+    if args.embedding_cache_dir or args.embedding_cache_memory_mb:
+        embedding_cache = EmbeddingCache(
+            cache_dir=args.embedding_cache_dir,
+            max_memory_bytes=(1024 if args.embedding_cache_memory_mb is None
+                              else args.embedding_cache_memory_mb) * 2**20,
+            max_disk_bytes=args.embedding_cache_disk_mb * 2**20
+            if args.embedding_cache_disk_mb else None
+        )
+
     # load parser
     start = time.time()
-    parser = AMRParser.from_checkpoint(args.in_checkpoint, inspector=inspector)
+    parser = AMRParser.from_checkpoint(args.in_checkpoint, inspector=inspector,
+                                       num_workers=args.num_workers,
+                                       embedding_cache=embedding_cache)
     end = time.time()
     time_secs = timedelta(seconds=float(end-start))
     print(f'Total time taken to load parser: {time_secs}')
 
-    # TODO: max batch sizes could be computed from max sentence length
-    if args.service:
+    # stop the post-processing workers on exit, also with ordered_exit()
+    with parser:
+        # TODO: max batch sizes could be computed from max sentence length
+        if args.service:
+
+            # set orderd exit
+            signal.signal(signal.SIGINT, ordered_exit)
+            signal.signal(signal.SIGTERM, ordered_exit)
+
+            while True:
+                sentence = input("Write sentence:\n")
+                os.system('clear')
+                if not sentence.strip():
+                    continue
+                result = parser.parse_sentences(
+                    [sentence.split()],
+                    batch_size=args.batch_size,
+                    roberta_batch_size=args.roberta_batch_size,
+                )
+                #
+                os.system('clear')
+                print('\n')
+                print(''.join(result[0]))
+                if embedding_cache is not None:
+                    print(embedding_cache.report())
 
-        # set orderd exit
-        signal.signal(signal.SIGINT, ordered_exit)
-        signal.signal(signal.SIGTERM, ordered_exit)
+        else:
 
-        while True:
-            sentence = input("Write sentence:\n")
-            os.system('clear')
-            if not sentence.strip():
-                continue
-            result = parser.parse_sentences(
-                [sentence.split()],
+            # Parse sentences, reading the input and writing the AMRs one chunk
+            # at a time
+            annotations = parser.parse_stream(
+                iter_tokenized_sentences(args.in_tokenized_sentences),
                 batch_size=args.batch_size,
                 roberta_batch_size=args.roberta_batch_size,
+                max_tokens=args.max_tokens
             )
-            #
-            os.system('clear')
-            print('\n')
-            print(''.join(result[0]))
 
-    else:
-
-        # Parse sentences
-        result = parser.parse_sentences(
-            read_tokenized_sentences(args.in_tokenized_sentences),
-            batch_size=args.batch_size,
-            roberta_batch_size=args.roberta_batch_size
-        )
+            with open(args.out_amr, 'w') as fid:
+                for annotation in annotations:
+                    fid.write(annotation)
 
-        with open(args.out_amr, 'w') as fid:
-            fid.write(''.join(result[0]))
+            if embedding_cache is not None:
+                print(embedding_cache.report())
 
 
 if __name__ == '__main__':
@@ -15,7 +15,7 @@
 # This file is standalone and intended to be used as well separately of the
 # repository, hence the attached license above.
 
-from collections import defaultdict
+from collections import defaultdict, Counter
 import re
 # need to be installed with pip install penman
 import penman
@@ -38,16 +38,6 @@ class AMR():
         self.alignments = alignments
         self.id = id
 
-        # edges by parent
-        self.edges_by_parent = defaultdict(list)
-        for (source, edge_name, target) in edges:
-            self.edges_by_parent[source].append((target, edge_name))
-
-        # edges by child
-        self.edges_by_child = defaultdict(list)
-        for (source, edge_name, target) in edges:
-            self.edges_by_child[target].append((source, edge_name))
-
         # root
         self.root = root
 
@@ -59,10 +49,24 @@ class AMR():
         if connect:
             self.connect_graph()
 
+        # index edges by parent and by child, once the edges are final
+        self.index_edges()
+
         # if self.root is None:
         #     # breakpoint()
         #     self.connect_graph()
 
+    def index_edges(self):
+        """
+        Index the edges by parent and by child for parents() and children().
+        Needs to be called again if self.edges is modified
+        """
+        self.edges_by_parent = defaultdict(list)
+        self.edges_by_child = defaultdict(list)
+        for (source, edge_name, target) in self.edges:
+            self.edges_by_parent[source].append((target, edge_name))
+            self.edges_by_child[target].append((source, edge_name))
+
     def clean_amr(self):
         # empty graph
         if not self.nodes:
@@ -189,10 +193,12 @@ class AMR():
                 if self.nodes[n] == 'multi-sentence' or n == assigned_root:
                     self.root = n
         else:
+            # node with most children minus parents
+            num_children = Counter(e[0] for e in self.edges)
+            num_parents = Counter(e[2] for e in self.edges)
             self.root = max(
                 self.nodes.keys(),
-                key=lambda x: len([e for e in self.edges if e[0] == x])
-                - len([e for e in self.edges if e[2] == x])
+                key=lambda x: num_children[x] - num_parents[x]
             )
 
         # connect graph
@@ -1113,10 +1113,14 @@ def main(args):
 
     # files
     if args.in_amr:
-        amrs = read_amr(args.in_amr, tokenize=args.tokenize)
+        amrs = read_amr(args.in_amr, tokenize=args.tokenize,
+                        num_workers=args.read_workers,
+                        cache_dir=args.amr_cache_dir)
     else:
         amrs = read_amr(args.in_aligned_amr, ibm_format=True,
-                         tokenize=args.tokenize)
+                        tokenize=args.tokenize,
+                        num_workers=args.read_workers,
+                        cache_dir=args.amr_cache_dir)
     # normalize tokens for matching purposes, but keep the original for writing
     original_tokens = []
     for amr in amrs:
@@ -1203,6 +1207,18 @@ def argument_parser():
              "(::node, etc). Graph read from the latter and not penman",
         type=str
     )
+    parser.add_argument(
+        "--read-workers",
+        help="Number of processes to parse the input AMR file",
+        type=int,
+        default=1
+    )
+    parser.add_argument(
+        "--amr-cache-dir",
+        help="Folder to cache the parsed input AMRs, reused while the file "
+             "does not change",
+        type=str,
+    )
     parser.add_argument(
         "--alignment-format",
         help="stack alignes all nodes in the NER subgraph to entire span",
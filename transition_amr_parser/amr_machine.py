@@ -2,18 +2,21 @@ from collections import defaultdict, Counter
 import json
 import argparse
 import os
-from functools import partial
+from functools import partial, lru_cache
 import re
-from copy import deepcopy
-from itertools import chain
+from itertools import chain, islice, count
+from multiprocessing import Pool
 
 from tqdm import tqdm
 import numpy as np
 from transition_amr_parser.io import (
     AMR,
     read_amr,
-    read_tokenized_sentences,
-    write_tokenized_sentences
+    iter_amr,
+    read_raw_amrs,
+    parse_amr,
+    writer,
+    read_tokenized_sentences
 )
 from transition_amr_parser.clbar import yellow_font, clbar
 from ipdb import set_trace
@@ -27,16 +30,124 @@ ra_nopointer_regex = re.compile(r'>RA\((.*)\)')
 arc_nopointer_regex = re.compile(r'>[RL]A\((.*)\)')
 
 
+@lru_cache(maxsize=2**17)
+def parse_action(action):
+    """
+    Decode the arc information of an action string
+
+    Results are cached, so that the regular expressions are run only once for
+    each symbol of the action vocabulary (pointer included)
+
+    Returns (arc, pointer, label), with arc '>LA' or '>RA' for arc actions
+    with or without pointer, and None otherwise. pointer is None for actions
+    without pointer
+    """
+    fetch = arc_regex.match(action)
+    if fetch:
+        pointer, label = fetch.groups()
+        try:
+            pointer = int(pointer)
+        except ValueError:
+            # leave it to the caller to fail
+            pass
+        return action[:3], pointer, label
+    fetch = arc_nopointer_regex.match(action)
+    if fetch:
+        return action[:3], None, fetch.groups()[0]
+    return None, None, None
+
+
 def red_background(string):
     return "\033[101m%s\033[0m" % string
 
 
+class PersistentList():
+    """
+    Append-only list that can be copied in O(1)
+
+    Copies share one buffer and only differ in their size. Appending to a copy
+    that reaches the end of the buffer extends it in place, appending to a
+    shorter one (e.g. a sibling beam that took a different action) first
+    copies the shared prefix. Elements in the buffer are never overwritten, so
+    all copies remain valid.
+    """
+
+    __slots__ = ('_buffer', '_size')
+
+    def __init__(self, items=()):
+        self._buffer = list(items)
+        self._size = len(self._buffer)
+
+    def copy(self):
+        new = PersistentList.__new__(PersistentList)
+        new._buffer = self._buffer
+        new._size = self._size
+        return new
+
+    def _own(self):
+        # detach from the shared buffer before a non-append modification
+        self._buffer = self._buffer[:self._size]
+
+    def append(self, item):
+        if len(self._buffer) != self._size:
+            self._own()
+        self._buffer.append(item)
+        self._size += 1
+
+    def pop(self, index=-1):
+        if index in (-1, self._size - 1):
+            item = self[-1]
+            # the item stays in the buffer for other copies
+            self._size -= 1
+            return item
+        self._own()
+        item = self._buffer.pop(index)
+        self._size -= 1
+        return item
+
+    def remove(self, item):
+        self._own()
+        self._buffer.remove(item)
+        self._size -= 1
+
+    def index(self, item):
+        return self._buffer.index(item, 0, self._size)
+
+    def __len__(self):
+        return self._size
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return self._buffer[:self._size][index]
+        if index < 0:
+            index += self._size
+        if not 0 <= index < self._size:
+            raise IndexError('PersistentList index out of range')
+        return self._buffer[index]
+
+    def __iter__(self):
+        return islice(self._buffer, self._size)
+
+    def __contains__(self, item):
+        return item in self._buffer[:self._size]
+
+    def __eq__(self, other):
+        if isinstance(other, (list, PersistentList)):
+            return list(self) == list(other)
+        return NotImplemented
+
+    def __repr__(self):
+        return repr(list(self))
+
+
 def graph_alignments(unaligned_nodes, amr):
     """
     Shallow alignment fixer: Inherit the alignment of the last child or first
     parent. If none of these is aligned the node is left unaligned
     """
 
+    # set for constant time membership, as this loops over all edges
+    unaligned_nodes = set(unaligned_nodes)
     fix_alignments = {}
     for (src, _, tgt) in amr.edges:
         if (
@@ -180,13 +291,21 @@ class AMROracle():
         # Loop over edges not yet created
         top_node_id = machine.node_stack[-1]
         current_id = self.node_reverse_map[top_node_id]
+        if self.reduce_nodes:
+            # nodes below the top of the stack, other nodes may be reduced
+            in_stack = set(machine.node_stack)
+            in_stack.discard(top_node_id)
+        else:
+            # without REDUCE every created node stays in the stack, so there
+            # is no need to search it at every step
+            in_stack = None
         for (src, label, tgt) in self.pend_edges_by_node[current_id]:
             # skip if it involves nodes not yet created
             if src not in self.node_map or tgt not in self.node_map:
                 continue
             if (
                 self.node_map[src] == top_node_id
-                and self.node_map[tgt] in machine.node_stack[:-1]
+                and self.below_top(self.node_map[tgt], top_node_id, in_stack)
             ):
                 # LA <--
                 if self.absolute_stack_pos:
@@ -206,7 +325,7 @@ class AMROracle():
 
             elif (
                 self.node_map[tgt] == top_node_id
-                and self.node_map[src] in machine.node_stack[:-1]
+                and self.below_top(self.node_map[src], top_node_id, in_stack)
             ):
                 # RA -->
                 # note stack position 0 is closest to current node
@@ -225,6 +344,16 @@ class AMROracle():
                 assert label[0] == ':'
                 return [f'>RA({index},{label})'], [1.0]
 
+    @staticmethod
+    def below_top(node_id, top_node_id, in_stack):
+        """
+        True if a created node is in the stack below the top, in_stack is None
+        if all created nodes are in the stack
+        """
+        if in_stack is None:
+            return node_id != top_node_id
+        return node_id in in_stack
+
     def get_reduce_action(self, machine, top=True):
         """
         If last action is an arc, check if any involved node (top or not top)
@@ -233,14 +362,13 @@ class AMROracle():
         if machine.action_history == []:
             return False
         action = machine.action_history[-1]
-        fetch = arc_regex.match(action)
-        if fetch is None:
+        _, index, _ = parse_action(action)
+        if index is None:
             return False
         if top:
             node_id = machine.node_stack[-1]
         else:
-            # index = int(fetch.groups()[1])
-            index = int(fetch.groups()[0])
+            index = int(index)
             if self.absolute_stack_pos:
                 node_id = index
             else:
@@ -309,6 +437,18 @@ class AMROracle():
 
 class AMRStateMachine():
 
+    # NOTE: Add here any new attribute, there is no __dict__. The state is
+    # scalars plus append-only PersistentList, so that snapshot() and fork()
+    # are O(1) and forks share the memory of their common history
+    __slots__ = (
+        # non state variables
+        'reduce_nodes', 'absolute_stack_pos', 'use_copy',
+        'base_action_vocabulary',
+        # state
+        'tokens', 'tok_cursor', 'node_stack', 'action_history', 'node_ids',
+        'edges', 'root', 'is_closed', 'actions_tokcursor'
+    )
+
     def __init__(self, reduce_nodes=None, absolute_stack_pos=False,
                  use_copy=True):
 
@@ -380,22 +520,24 @@ class AMRStateMachine():
         Reset state variables and set a new sentence
         '''
         # state
+        # NOTE: tokens are never modified and lists are append-only
+        # PersistentList, so that fork() can share them
         self.tokens = list(tokens)
         self.tok_cursor = 0
-        self.node_stack = []
-        self.action_history = []
+        self.node_stack = PersistentList()
+        self.action_history = PersistentList()
         # AMR as we construct it
         # NOTE: We will use position of node generating action in action
-        # history as node_id
-        self.nodes = {}
-        self.edges = []
+        # history as node_id. Node names and alignments are recovered from
+        # the action history, see nodes and alignments below
+        self.node_ids = PersistentList()
+        self.edges = PersistentList()
         self.root = None
-        self.alignments = defaultdict(list)
         # set to true when machine finishes
         self.is_closed = False
 
         # state info useful in the model
-        self.actions_tokcursor = []
+        self.actions_tokcursor = PersistentList()
 
     @classmethod
     def from_config(cls, config_path):
@@ -412,28 +554,86 @@ class AMRStateMachine():
                 use_copy=self.use_copy
             )))
 
-    def __deepcopy__(self, memo):
+    def snapshot(self):
         """
-        Manual deep copy of the machine
+        Return the current state, to be set back with restore()
+
+        O(1), the lists are shared with the machine until it modifies them
+        """
+        return (
+            self.tokens, self.tok_cursor, self.node_stack.copy(),
+            self.action_history.copy(), self.node_ids.copy(),
+            self.edges.copy(), self.root, self.is_closed,
+            self.actions_tokcursor.copy()
+        )
 
-        avoid deep copying heavy files
+    def restore(self, snapshot):
+        """Set a state returned by snapshot()"""
+        (
+            self.tokens, self.tok_cursor, node_stack, action_history,
+            node_ids, edges, self.root, self.is_closed, actions_tokcursor
+        ) = snapshot
+        # copy again so that the snapshot can be restored more than once
+        self.node_stack = node_stack.copy()
+        self.action_history = action_history.copy()
+        self.node_ids = node_ids.copy()
+        self.edges = edges.copy()
+        self.actions_tokcursor = actions_tokcursor.copy()
+
+    def fork(self):
+        """
+        Copy of the machine sharing state with this one
+
+        Used to branch hypotheses in beam search. The cost does not grow with
+        the length of the history, see snapshot()
         """
         cls = self.__class__
         result = cls.__new__(cls)
-        # DEBUG: usew this to detect very heavy constants that can be referred
-        # import time
+        for name in (
+            'reduce_nodes', 'absolute_stack_pos', 'use_copy',
+            'base_action_vocabulary'
+        ):
+            setattr(result, name, getattr(self, name))
+        if hasattr(self, '__dict__'):
+            # subclasses without __slots__
+            result.__dict__.update(self.__dict__)
+        result.restore(self.snapshot())
+        return result
+
+    def __deepcopy__(self, memo):
+        """
+        Manual deep copy of the machine
+
+        State lists are never modified in place, so a fork is independent of
+        the original machine
+        """
+        result = self.fork()
         memo[id(self)] = result
-        for k, v in self.__dict__.items():
-            # start = time.time()
-            # if k in ['actions_by_stack_rules']:
-            #     setattr(result, k, v)
-            # else:
-            #     setattr(result, k, deepcopy(v, memo))
-            setattr(result, k, deepcopy(v, memo))
-            # print(k, time.time() - start)
-        # import ipdb; ipdb.set_trace(context=30)
         return result
 
+    @property
+    def nodes(self):
+        """Node names by node id"""
+        nodes = {}
+        for node_id in self.node_ids:
+            action = self.action_history[node_id]
+            if action == 'COPY':
+                # surface symbol under cursor at the time of the COPY
+                nodes[node_id] = normalize(
+                    self.tokens[self.actions_tokcursor[node_id]]
+                )
+            else:
+                nodes[node_id] = action
+        return nodes
+
+    @property
+    def alignments(self):
+        """Token positions aligned to each node id"""
+        alignments = defaultdict(list)
+        for node_id in self.node_ids:
+            alignments[node_id].append(self.actions_tokcursor[node_id])
+        return alignments
+
     def get_current_token(self):
         return self.tokens[self.tok_cursor]
 
@@ -444,8 +644,9 @@ class AMRStateMachine():
         # remaining ones are ['>LA', '>RA', 'NODE']
         # NOTE need to deal with both '>LA(pos,label)' and '>LA(label)', as in
         # the vocabulary the pointers are peeled off
-        if arc_regex.match(action) or arc_nopointer_regex.match(action):
-            return action[:3]
+        arc, _, _ = parse_action(action)
+        if arc:
+            return arc
         return 'NODE'
 
     def get_valid_actions(self, max_1root=True):
@@ -507,10 +708,13 @@ class AMRStateMachine():
 
         self.actions_tokcursor.append(self.tok_cursor)
 
-        if re.match(r'CLOSE', action):
+        arc, index, label = parse_action(action)
+
+        # NOTE: prefix match, as re.match(r'CLOSE', action)
+        if action.startswith('CLOSE'):
             self.is_closed = True
 
-        elif re.match(r'ROOT', action):
+        elif action.startswith('ROOT'):
             self.root = self.node_stack[-1]
 
         elif action in ['SHIFT']:
@@ -527,10 +731,9 @@ class AMRStateMachine():
             # eliminate the other node involved in last arc not on top
             assert self.reduce_nodes
             assert self.action_history[-1]
-            fetch = arc_regex.match(self.action_history[-1])
-            assert fetch
-            # index = int(fetch.groups()[1])
-            index = int(fetch.groups()[0])
+            _, index, _ = parse_action(self.action_history[-1])
+            assert index is not None
+            index = int(index)
             if self.absolute_stack_pos:
                 # Absolute position and also node_id
                 self.node_stack.remove(index)
@@ -543,10 +746,9 @@ class AMRStateMachine():
             # eliminate both nodes involved in arc
             assert self.reduce_nodes
             assert self.action_history[-1]
-            fetch = arc_regex.match(self.action_history[-1])
-            assert fetch
-            # index = int(fetch.groups()[1])
-            index = int(fetch.groups()[0])
+            _, index, _ = parse_action(self.action_history[-1])
+            assert index is not None
+            index = int(index)
             if self.absolute_stack_pos:
                 # Absolute position and also node_id
                 self.node_stack.remove(index)
@@ -557,10 +759,8 @@ class AMRStateMachine():
             self.node_stack.pop()
 
         # Edge generation
-        elif la_regex.match(action):
+        elif arc == '>LA' and index is not None:
             # Left Arc <--
-            # label, index = la_regex.match(action).groups()
-            index, label = la_regex.match(action).groups()
             if self.absolute_stack_pos:
                 tgt = int(index)
             else:
@@ -570,10 +770,8 @@ class AMRStateMachine():
             src = self.node_stack[-1]
             self.edges.append((src, f'{label}', tgt))
 
-        elif ra_regex.match(action):
+        elif arc == '>RA' and index is not None:
             # Right Arc -->
-            # label, index = ra_regex.match(action).groups()
-            index, label = ra_regex.match(action).groups()
             if self.absolute_stack_pos:
                 src = int(index)
             else:
@@ -586,10 +784,11 @@ class AMRStateMachine():
         # Node generation
         elif action == 'COPY':
             # copy surface symbol under cursor to node-name
+            # NOTE: name and alignment are recovered from action_history and
+            # actions_tokcursor, see nodes and alignments
             node_id = len(self.action_history)
-            self.nodes[node_id] = normalize(self.tokens[self.tok_cursor])
+            self.node_ids.append(node_id)
             self.node_stack.append(node_id)
-            self.alignments[node_id].append(self.tok_cursor)
 
         else:
 
@@ -597,16 +796,18 @@ class AMRStateMachine():
             # Note that the node_id is the position of the action that
             # generated it
             node_id = len(self.action_history)
-            self.nodes[node_id] = action
+            self.node_ids.append(node_id)
             self.node_stack.append(node_id)
-            self.alignments[node_id].append(self.tok_cursor)
 
         # Action for each time-step
         self.action_history.append(action)
 
     def get_annotation(self):
-        amr = AMR(self.tokens, self.nodes, self.edges, self.root,
-                  alignments=self.alignments, clean=True, connect=True)
+        # NOTE: AMR cleaning modifies its inputs in place, pass copies as
+        # these may be shared with other machines
+        amr = AMR(list(self.tokens), self.nodes, list(self.edges),
+                  self.root, alignments=self.alignments, clean=True,
+                  connect=True)
         return amr.__str__()
 
 
@@ -628,9 +829,7 @@ class Stats():
         # alignment stats
         self.unaligned_node_count = Counter()
         self.node_count = 0
-        # token/action stats
-        self.tokens = []
-        self.action_sequences = []
+        # action stats
         self.action_count = Counter()
 
         self.ngram_stats = ngram_stats
@@ -642,6 +841,22 @@ class Stats():
             self.trigram_count = Counter()
             self.fourgram_count = Counter()
 
+    def merge(self, other):
+        """
+        Add the stats of the AMRs that follow, computed separately. Their
+        ignore_indices are relative to their first AMR
+        """
+        self.stack_size_count.update(other.stack_size_count)
+        self.pointer_positions_count.update(other.pointer_positions_count)
+        self.unaligned_node_count.update(other.unaligned_node_count)
+        self.node_count += other.node_count
+        self.action_count.update(other.action_count)
+        if self.ngram_stats:
+            self.bigram_count.update(other.bigram_count)
+            self.trigram_count.update(other.trigram_count)
+            self.fourgram_count.update(other.fourgram_count)
+        self.index += other.index
+
     def update_machine_stats(self, machine):
 
         if self.breakpoint:
@@ -656,18 +871,15 @@ class Stats():
             #    set_trace(context=30)
 
         action = machine.action_history[-1]
-        fetch = arc_regex.match(action)
-        if fetch:
-            # stack_pos = int(fetch.groups()[1])
-            stack_pos = int(fetch.groups()[0])
+        _, stack_pos, _ = parse_action(action)
+        if stack_pos is not None:
+            stack_pos = int(stack_pos)
             self.stack_size_count.update([len(machine.node_stack)])
             self.pointer_positions_count.update([stack_pos])
 
     def update_sentence_stats(self, oracle, machine):
 
         # Note that we do not ignore this one either way
-        self.tokens.append(machine.tokens)
-        self.action_sequences.append(machine.action_history)
         base_actions = [x.split('(')[0] for x in machine.action_history]
         self.action_count.update(base_actions)
 
@@ -695,8 +907,9 @@ class Stats():
     def stop_if_error(self, oracle, machine):
 
         # Check node name match
+        machine_nodes = machine.nodes
         for nid, node_name in oracle.gold_amr.nodes.items():
-            node_name_machine = machine.nodes[oracle.node_map[nid]]
+            node_name_machine = machine_nodes[oracle.node_map[nid]]
             if normalize(node_name_machine) != normalize(node_name):
                 set_trace(context=30)
                 print()
@@ -768,17 +981,12 @@ class Stats():
 
 def peel_pointer(action, pad=-1):
     """Peel off the pointer value from arc actions"""
-    if arc_regex.match(action):
+    arc, pos, label = parse_action(action)
+    if pos is not None:
         # LA(pos,label) or RA(pos,label)
-        action, properties = action.split('(')
-        properties = properties[:-1]    # remove the ')' at last position
-        # split to pointer value and label
-        properties = properties.split(',')
-        pos = int(properties[0].strip())
         # remove any leading and trailing white spaces
-        label = properties[1].strip()
-        action_label = action + '(' + label + ')'
-        return (action_label, pos)
+        action_label = arc + '(' + label.strip() + ')'
+        return (action_label, int(pos))
     else:
         return (action, pad)
 
@@ -804,18 +1012,29 @@ class StatsForVocab:
         self.right_arcs = Counter()
         self.control = Counter()
 
+    def merge(self, other):
+        """
+        Add the stats of the AMRs that follow, computed separately. Merging in
+        corpus order keeps the order of the counters as if computed at once
+        """
+        self.nodes.update(other.nodes)
+        self.left_arcs.update(other.left_arcs)
+        self.right_arcs.update(other.right_arcs)
+        self.control.update(other.control)
+
     def update(self, action, machine):
         if self.no_close:
             if action in ['CLOSE', '_CLOSE_']:
                 return
 
-        if la_regex.match(action) or la_nopointer_regex.match(action):
+        arc, _, _ = parse_action(action)
+        if arc == '>LA':
             # LA(pos,label) or LA(label)
             action, pos = peel_pointer(action)
             # NOTE should be an iterable instead of a string; otherwise it'll
             # be character based
             self.left_arcs.update([action])
-        elif ra_regex.match(action) or ra_nopointer_regex.match(action):
+        elif arc == '>RA':
             # RA(pos,label) or RA(label)
             action, pos = peel_pointer(action)
             self.right_arcs.update([action])
@@ -856,27 +1075,116 @@ class StatsForVocab:
                 print(f'{k}\t{v}', file=f)
 
 
-def oracle(args):
+# broken annotations that we ignore in stats
+# 'DATA/AMR2.0/aligned/cofill/train.txt'
+ORACLE_IGNORE_INDICES = [
+    8372,   # (49, ':time', 49), (49, ':condition', 49)
+    17055,  # (3, ':mod', 7), (3, ':mod', 7)
+    27076,  # '0.0.2.1.0.0' is on ::edges but not ::nodes
+    # for AMR 3.0 data: DATA/AMR3.0/aligned/cofill/train.txt
+    # self-loop:
+    # "# ::edge vote-01 condition vote-01 0.0.2 0.0.2",
+    # "# ::edge vote-01 time vote-01 0.0.2 0.0.2"
+    9296,
+]
+# NOTE we add indices to ignore for both amr2.0 and amr3.0 in the same list
+# and used for both oracles, since: this would NOT change the oracle
+# actions, but only ignore sanity checks and displayed stats after oracle
+# run
+
+
+def run_oracle(amr, machine, oracle, stats, stats_vocab):
+    """
+    Run the oracle over one AMR, updating the stats, and return its action
+    sequence (without CLOSE) and tokens
+    """
+
+    # spawn new machine for this sentence
+    machine.reset(amr.tokens)
+
+    # initialize new oracle for this AMR
+    oracle.reset(amr)
 
-    # Read AMR
-    amrs = read_amr(args.in_aligned_amr, ibm_format=True)
+    # proceed left to right throught the sentence generating nodes
+    while not machine.is_closed:
 
-    # broken annotations that we ignore in stats
-    # 'DATA/AMR2.0/aligned/cofill/train.txt'
+        # get valid actions
+        _ = machine.get_valid_actions()
+
+        # oracle
+        actions, scores = oracle.get_actions(machine)
+        # actions = [a for a in actions if a in valid_actions]
+        # most probable
+        action = actions[np.argmax(scores)]
+
+        # if it is node generation, keep track of original id in gold amr
+        if isinstance(action, tuple):
+            action, gold_node_id = action
+            node_id = len(machine.action_history)
+            oracle.node_map[gold_node_id] = node_id
+            oracle.node_reverse_map[node_id] = gold_node_id
+
+        # update machine,
+        machine.update(action)
+
+        # update machine stats
+        stats.update_machine_stats(machine)
+
+        # update vocabulary
+        stats_vocab.update(action, machine)
+
+    # Sanity check: We recovered the full AMR
+    stats.update_sentence_stats(oracle, machine)
+
+    # do not write 'CLOSE' in the action sequences
+    actions = list(machine.action_history)
+    close_action = actions.pop()
+    assert close_action == 'CLOSE'
+
+    return actions, list(machine.tokens)
+
+
+# machine and oracle of each worker process, see init_oracle_worker()
+_worker_oracle = {}
+
+
+def init_oracle_worker(reduce_nodes, absolute_stack_pos, use_copy):
+    _worker_oracle['machine'] = AMRStateMachine(
+        reduce_nodes=reduce_nodes,
+        absolute_stack_pos=absolute_stack_pos,
+        use_copy=use_copy
+    )
+    _worker_oracle['oracle'] = AMROracle(
+        reduce_nodes=reduce_nodes,
+        absolute_stack_pos=absolute_stack_pos,
+        use_copy=use_copy
+    )
+
+
+def run_oracle_chunk(chunk):
+    """
+    Parse and run the oracle over a chunk of consecutive raw AMRs starting at
+    corpus position start, in a worker process
+    """
+    start, raw_amrs = chunk
+    # stats of the chunk, to be merged in corpus order
     ignore_indices = [
-        8372,   # (49, ':time', 49), (49, ':condition', 49)
-        17055,  # (3, ':mod', 7), (3, ':mod', 7)
-        27076,  # '0.0.2.1.0.0' is on ::edges but not ::nodes
-        # for AMR 3.0 data: DATA/AMR3.0/aligned/cofill/train.txt
-        # self-loop:
-        # "# ::edge vote-01 condition vote-01 0.0.2 0.0.2",
-        # "# ::edge vote-01 time vote-01 0.0.2 0.0.2"
-        9296,
+        index - start for index in ORACLE_IGNORE_INDICES
+        if start <= index < start + len(raw_amrs)
     ]
-    # NOTE we add indices to ignore for both amr2.0 and amr3.0 in the same list
-    # and used for both oracles, since: this would NOT change the oracle
-    # actions, but only ignore sanity checks and displayed stats after oracle
-    # run
+    stats = Stats(ignore_indices, ngram_stats=False)
+    stats_vocab = StatsForVocab(no_close=False)
+    results = []
+    for raw_amr in raw_amrs:
+        amr = parse_amr(raw_amr, ibm_format=True)
+        results.append(run_oracle(
+            amr, _worker_oracle['machine'], _worker_oracle['oracle'], stats,
+            stats_vocab
+        ))
+    return results, stats, stats_vocab
+
+
+def oracle(args):
 
     # Initialize machine
     machine = AMRStateMachine(
@@ -894,74 +1202,75 @@ def oracle(args):
         use_copy=args.use_copy
     )
 
+    # action sequences and tokens are written as they are produced
+    actions_writer = writer(args.out_actions, add_return=True)
+    tokens_writer = writer(args.out_tokens, add_return=True)
+
     # will store statistics and check AMR is recovered
-    stats = Stats(ignore_indices, ngram_stats=False)
+    stats = Stats(ORACLE_IGNORE_INDICES, ngram_stats=False)
     stats_vocab = StatsForVocab(no_close=False)
-    for idx, amr in tqdm(enumerate(amrs), desc='Oracle'):
-
-        # debug
-        # print(idx)    # 96 for AMR2.0 test data infinit loop
-        # if idx == 96:
-        #     breakpoint()
 
-        # spawn new machine for this sentence
-        machine.reset(amr.tokens)
+    if args.num_workers > 1:
 
-        # initialize new oracle for this AMR
-        oracle.reset(amr)
-
-        # proceed left to right throught the sentence generating nodes
-        while not machine.is_closed:
+        # each worker parses and runs the oracle over chunks of consecutive
+        # AMRs. Results come back in corpus order and the stats of each chunk
+        # are merged in that order, which gives the same files as a single
+        # process
+        with open(args.in_aligned_amr) as fid:
+            raw_amr_iter = read_raw_amrs(fid)
+            chunks = iter(
+                lambda: list(islice(raw_amr_iter, args.chunk_size)), []
+            )
+            # corpus position of the first AMR of each chunk
+            positions = count(0, args.chunk_size)
+            with Pool(
+                args.num_workers,
+                initializer=init_oracle_worker,
+                initargs=(args.reduce_nodes, args.absolute_stack_positions,
+                          args.use_copy)
+            ) as pool:
+                for results, chunk_stats, chunk_stats_vocab in tqdm(
+                    pool.imap(run_oracle_chunk, zip(positions, chunks)),
+                    desc=f'Oracle (chunks of {args.chunk_size})'
+                ):
+                    for actions, tokens in results:
+                        actions_writer('\t'.join(map(str, actions)))
+                        tokens_writer('\t'.join(map(str, tokens)))
+                    stats.merge(chunk_stats)
+                    stats_vocab.merge(chunk_stats_vocab)
 
-            # get valid actions
-            _ = machine.get_valid_actions()
+    else:
 
-            # oracle
-            actions, scores = oracle.get_actions(machine)
-            # actions = [a for a in actions if a in valid_actions]
-            # most probable
-            action = actions[np.argmax(scores)]
+        # Read AMR
+        if args.read_workers > 1 or args.amr_cache_dir is not None:
+            amrs = read_amr(args.in_aligned_amr, ibm_format=True,
+                            num_workers=args.read_workers,
+                            cache_dir=args.amr_cache_dir)
+        else:
+            # parse the AMRs as they are needed, only one in memory at a time
+            amrs = iter_amr(args.in_aligned_amr, ibm_format=True)
 
-            # if it is node generation, keep track of original id in gold amr
-            if isinstance(action, tuple):
-                action, gold_node_id = action
-                node_id = len(machine.action_history)
-                oracle.node_map[gold_node_id] = node_id
-                oracle.node_reverse_map[node_id] = gold_node_id
+        for idx, amr in tqdm(enumerate(amrs), desc='Oracle'):
 
-            # update machine,
-            machine.update(action)
-
-            # update machine stats
-            stats.update_machine_stats(machine)
+            # debug
+            # print(idx)    # 96 for AMR2.0 test data infinit loop
+            # if idx == 96:
+            #     breakpoint()
 
-            # update vocabulary
-            stats_vocab.update(action, machine)
+            actions, tokens = run_oracle(
+                amr, machine, oracle, stats, stats_vocab
+            )
 
-        # Sanity check: We recovered the full AMR
-        stats.update_sentence_stats(oracle, machine)
+            # save action sequences and tokens
+            actions_writer('\t'.join(map(str, actions)))
+            tokens_writer('\t'.join(map(str, tokens)))
 
-        # do not write 'CLOSE' in the action sequences
-        # this might change the machine.action_history in place, but it is the
-        # end of this machine already
-        close_action = stats.action_sequences[-1].pop()
-        assert close_action == 'CLOSE'
+    actions_writer()
+    tokens_writer()
 
     # display statistics
     stats.display()
 
-    # save action sequences and tokens
-    write_tokenized_sentences(
-        args.out_actions,
-        stats.action_sequences,
-        '\t'
-    )
-    write_tokenized_sentences(
-        args.out_tokens,
-        stats.tokens,
-        '\t'
-    )
-
     # save action vocabulary stats
     # debug
 
@@ -1039,6 +1348,32 @@ def argument_parser():
              "(::node, etc). Graph read from the latter and not penman",
         type=str
     )
+    parser.add_argument(
+        "--read-workers",
+        help="Number of processes to parse the input AMR file",
+        type=int,
+        default=1
+    )
+    parser.add_argument(
+        "--amr-cache-dir",
+        help="Folder to cache the parsed input AMRs, reused while the file "
+             "does not change",
+        type=str,
+    )
+    parser.add_argument(
+        "--num-workers",
+        help="Number of processes to parse the AMRs and run the oracle, in "
+             "chunks of --chunk-size AMRs (ignores --read-workers and "
+             "--amr-cache-dir)",
+        type=int,
+        default=1
+    )
+    parser.add_argument(
+        "--chunk-size",
+        help="Number of consecutive AMRs sent to each oracle worker at a time",
+        type=int,
+        default=100
+    )
     # ORACLE
     parser.add_argument(
         "--reduce-nodes",
@@ -1,38 +1,200 @@
+import gc
+import os
 import re
 import json
+import pickle
+import hashlib
 import subprocess
+from array import array
+from io import TextIOWrapper
+from itertools import islice
+from multiprocessing import Pool
 import xml.etree.ElementTree as ET
 from tqdm import tqdm
 from collections import Counter
 from transition_amr_parser.amr import AMR
 
 
-def read_amr(file_path, ibm_format=False, tokenize=False, bar=True):
+# bump to invalidate the cached AMRs when the AMR class changes
+AMR_CACHE_VERSION = 2
+
+
+def read_raw_amrs(fid):
+    """
+    Yield the lines of each AMR in an open file, AMRs separated by empty lines
+    """
+    raw_amr = []
+    for line in fid:
+        if line.strip() == '':
+            yield raw_amr
+            raw_amr = []
+        else:
+            raw_amr.append(line)
+
+
+def parse_amr(raw_amr, ibm_format=False, tokenize=False):
+    if ibm_format:
+        # From ::node, ::edge etc
+        return AMR.from_metadata(raw_amr, tokenize=tokenize)
+    else:
+        # From penman
+        return AMR.from_penman(raw_amr, tokenize=tokenize)
+
+
+def parse_amr_chunk(chunk):
+    raw_amrs, ibm_format, tokenize = chunk
+    return [parse_amr(raw_amr, ibm_format, tokenize) for raw_amr in raw_amrs]
+
+
+def get_amr_cache_path(file_path, cache_dir, ibm_format, tokenize):
+    """
+    Path of the cached AMRs of a file, keyed by the hash of its content and
+    the reading options
+    """
+    sha1 = hashlib.sha1(
+        f'{AMR_CACHE_VERSION} {ibm_format} {tokenize}'.encode('utf-8')
+    )
+    with open(file_path, 'rb') as fid:
+        for block in iter(lambda: fid.read(2**20), b''):
+            sha1.update(block)
+    return os.path.join(cache_dir, f'{sha1.hexdigest()}.amrs.pkl')
+
+
+def read_amr(file_path, ibm_format=False, tokenize=False, bar=True,
+             num_workers=1, cache_dir=None, chunk_size=200):
+    """
+    Read AMRs from file, in penman notation or from the IBM graph notation
+    (::node, ::edge etc) if ibm_format is set
+
+    num_workers   parse the AMRs in this many processes, in chunks of
+                  chunk_size AMRs streamed from the file
+    cache_dir     if given, the AMRs are pickled in this folder and read from
+                  there while the file content does not change
+    """
+
+    if cache_dir is not None:
+        cache_path = get_amr_cache_path(
+            file_path, cache_dir, ibm_format, tokenize
+        )
+        if os.path.isfile(cache_path):
+            # the garbage collector would otherwise run many times while
+            # creating all the AMR objects, for nothing
+            gc.disable()
+            try:
+                with open(cache_path, 'rb') as fid:
+                    return pickle.load(fid)
+            finally:
+                gc.enable()
+
+    if bar:
+        bar = tqdm
+    else:
+        def bar(x, desc=None): return x
+
     with open(file_path) as fid:
-        raw_amr = []
-        raw_amrs = []
-        if bar:
-            bar = tqdm
+        if num_workers > 1:
+            raw_amr_iter = read_raw_amrs(fid)
+            chunks = iter(
+                lambda: list(islice(raw_amr_iter, chunk_size)), []
+            )
+            raw_amrs = []
+            with Pool(num_workers) as pool:
+                for amrs in bar(
+                    pool.imap(
+                        parse_amr_chunk,
+                        ((chunk, ibm_format, tokenize) for chunk in chunks)
+                    ),
+                    desc=f'Reading AMR (chunks of {chunk_size})'
+                ):
+                    raw_amrs.extend(amrs)
         else:
-            def bar(x, desc=None): return x
-        for line in bar(fid.readlines(), desc='Reading AMR'):
-            if line.strip() == '':
-                if ibm_format:
-                    # From ::node, ::edge etc
-                    raw_amrs.append(
-                        AMR.from_metadata(raw_amr, tokenize=tokenize)
-                    )
-                else:
-                    # From penman
-                    raw_amrs.append(
-                        AMR.from_penman(raw_amr, tokenize=tokenize)
-                    )
-                raw_amr = []
-            else:
-                raw_amr.append(line)
+            raw_amrs = [
+                parse_amr(raw_amr, ibm_format, tokenize)
+                for raw_amr in bar(read_raw_amrs(fid), desc='Reading AMR')
+            ]
+
+    if cache_dir is not None:
+        # write and rename, so that other processes never read partial files
+        os.makedirs(cache_dir, exist_ok=True)
+        tmp_path = f'{cache_path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'wb') as fid:
+            pickle.dump(raw_amrs, fid, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, cache_path)
+
     return raw_amrs
 
 
+def get_amr_offsets(file_path):
+    """
+    Byte offset of each AMR in a file, as read by read_raw_amrs()
+
+    The offsets are stored in a sidecar file (file_path + '.offsets') and
+    computed again if it is missing or older than the AMR file. If the sidecar
+    can not be written, the offsets are only kept in memory.
+    """
+
+    offsets_path = f'{file_path}.offsets'
+    if (
+        os.path.isfile(offsets_path)
+        and os.path.getmtime(offsets_path) >= os.path.getmtime(file_path)
+    ):
+        offsets = array('q')
+        with open(offsets_path, 'rb') as fid:
+            offsets.frombytes(fid.read())
+        return offsets
+
+    offsets = array('q')
+    start = 0
+    position = 0
+    with open(file_path, 'rb') as fid:
+        for line in fid:
+            position += len(line)
+            # same criteria as read_raw_amrs(), on the decoded line
+            if line.decode('utf-8', errors='replace').strip() == '':
+                offsets.append(start)
+                start = position
+
+    # write and rename, so that other processes never read partial files
+    tmp_path = f'{offsets_path}.{os.getpid()}.tmp'
+    try:
+        with open(tmp_path, 'wb') as fid:
+            offsets.tofile(fid)
+        os.replace(tmp_path, offsets_path)
+    except OSError:
+        pass
+
+    return offsets
+
+
+def iter_amr(file_path, ibm_format=False, tokenize=False, indices=None):
+    """
+    Yield AMRs from file one by one as they are parsed, in penman notation or
+    from the IBM graph notation (::node, ::edge etc) if ibm_format is set.
+    Only one AMR is in memory at a time.
+
+    indices   if given, yield only the AMRs with these positions in the file,
+              in the given order, seeking them with the offsets from
+              get_amr_offsets()
+    """
+
+    if indices is None:
+        with open(file_path) as fid:
+            for raw_amr in read_raw_amrs(fid):
+                yield parse_amr(raw_amr, ibm_format, tokenize)
+        return
+
+    offsets = get_amr_offsets(file_path)
+    with open(file_path, 'rb') as fid:
+        for index in indices:
+            fid.seek(offsets[index])
+            # decode from the offset the same way as open() in text mode
+            text_fid = TextIOWrapper(fid)
+            raw_amr = next(read_raw_amrs(text_fid))
+            # keep the binary file open for the next AMR
+            text_fid.detach()
+            yield parse_amr(raw_amr, ibm_format, tokenize)
+
+
 def read_frame(xml_file):
     '''
     Read probpank XML
@@ -184,11 +346,14 @@ def tokenized_sentences_egenerator(file_path):
 
 
 def read_tokenized_sentences(file_path, separator=' '):
-    sentences = []
+    return list(iter_tokenized_sentences(file_path, separator=separator))
+
+
+def iter_tokenized_sentences(file_path, separator=' '):
+    """Lazily read the tokenized sentences of a file, one per line"""
     with open(file_path) as fid:
         for line in fid:
-            sentences.append(line.rstrip().split(separator))
-    return sentences
+            yield line.rstrip().split(separator)
 
 
 def write_tokenized_sentences(file_path, content, separator=' '):